@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# In memory anti spam structures for the message path, each check is O(1)
+# and memory is bounded (least recently seen entries are evicted first)
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+NON_WORD = re.compile(r'\W+', re.UNICODE)
+
+
+class FloodDetector(object):
+	""" Token bucket per (chat_id, user_id), refilled at `messages` per `seconds` """
+
+	def __init__(self, max_users=50000):
+		self.max_users = max_users
+		self.buckets   = OrderedDict()
+		self.lock      = threading.Lock()
+
+	def hit(self, chat_id, user_id, messages, seconds, now=None):
+		""" Counts one message, True the first time the user goes over `messages` in `seconds` """
+		now  = time.monotonic() if now is None else now
+		key  = (chat_id, user_id)
+		rate = float(messages) / seconds
+
+		with self.lock:
+			# [tokens, last refill, already reported]
+			bucket = self.buckets.get(key)
+			if bucket is None:
+				bucket = self.buckets[key] = [float(messages), now, False]
+				if len(self.buckets) > self.max_users:
+					self.buckets.popitem(last=False)
+			else:
+				self.buckets.move_to_end(key)
+				bucket[0] = min(float(messages), bucket[0] + (now - bucket[1]) * rate)
+				bucket[1] = now
+
+			if bucket[0] >= 1:
+				bucket[0] -= 1
+				bucket[2]  = False
+				return False
+			if bucket[2]:
+				return False
+			bucket[2] = True
+			return True
+
+	def dump(self):
+		""" Buckets with wall clock times, monotonic ones don't survive a restart """
+		shift = time.time() - time.monotonic()
+		with self.lock:
+			return [(key, bucket[0], bucket[1] + shift, bucket[2]) for key, bucket in self.buckets.items()]
+
+	def load(self, buckets):
+		shift = time.monotonic() - time.time()
+		with self.lock:
+			for key, tokens, refilled, reported in buckets:
+				self.buckets[key] = [tokens, refilled + shift, reported]
+			while len(self.buckets) > self.max_users:
+				self.buckets.popitem(last=False)
+
+	def __len__(self):
+		return len(self.buckets)
+
+
+#################################
+#           DUPLICATES
+
+URL = re.compile(r'(https?://|www\.)\S+', re.IGNORECASE)
+
+# MinHash signatures of BANDS bands of ROWS values : two texts of jaccard similarity s
+# share at least one band with a probability of 1 - (1 - s ** ROWS) ** BANDS
+BANDS = 16
+ROWS  = 2
+PRIME = (1 << 61) - 1
+# Seeded, every process draws the same permutations
+_permutations = random.Random(6172)
+PERMUTATIONS  = [(_permutations.randrange(1, PRIME), _permutations.randrange(PRIME)) for i in range(BANDS * ROWS)]
+# Words of a text going into its signature, a long paste costs no more than this
+MAX_WORDS = 200
+
+
+def stable_hash(text):
+	""" 64 bit hash of a text, the same in every process (hash() of a str is salted per process) """
+	return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def normalize(text):
+	""" Lower case words without the links, so spacing / punctuation / emoji changes don't count """
+	return NON_WORD.sub(' ', URL.sub(' ', text.lower())).strip()
+
+
+def shingles(words):
+	""" Words and word pairs, a replaced word only changes three of them """
+	return set(words) | set(a+' '+b for a, b in zip(words, words[1:]))
+
+
+def signature(words):
+	""" MinHash of the shingles, one minimum per permutation """
+	hashes = [stable_hash(shingle) % PRIME for shingle in shingles(words)]
+	return tuple(min((a * h + b) % PRIME for h in hashes) for a, b in PERMUTATIONS)
+
+
+def similarity(a, b):
+	""" Estimated jaccard similarity of two signatures """
+	return sum(1 for x, y in zip(a, b) if x == y) / float(len(a))
+
+
+def shift_entry(entry, shift):
+	""" Copy of an entry with its times moved by `shift` seconds """
+	copy = dict(entry)
+	copy['seen']  = entry['seen'] + shift
+	copy['keys']  = set(entry['keys'])
+	copy['rooms'] = dict((room, [(seen + shift, message_id) for seen, message_id in sightings]) for room, sightings in entry['rooms'].items())
+	return copy
+
+
+class DuplicateDetector(object):
+	""" Time windowed index of the texts each user posted across rooms, exact hash + MinHash bands
+
+	A text is indexed under the user, its exact hash and every band of its signature, so a
+	lookup is a handful of dict hits whatever the size of the index and the candidates
+	found are kept when their signatures are `similarity` alike. Only the repeats of one
+	user count, members sharing the same news don't add up. Texts are evicted least
+	recently seen first.
+	"""
+
+	# Layout and hashes of dump(), an older snapshot is ignored
+	VERSION = 3
+
+	def __init__(self, max_entries=20000, min_length=30, similarity=0.5, max_sightings=10):
+		self.max_entries   = max_entries
+		self.min_length    = min_length
+		self.similarity    = similarity
+		self.max_sightings = max_sightings
+		# Keys of an entry, a few variants of the text at most
+		self.max_keys      = 4 * (BANDS + 1)
+		self.entries       = OrderedDict()   # entry id : entry, least recently seen first
+		self.index         = {}              # key : entry
+		self.next_id       = 0
+		self.lock          = threading.Lock()
+
+	def keys(self, user_id, exact, sig):
+		yield ('exact', user_id, exact)
+		for band in range(BANDS):
+			yield (band, user_id, sig[band * ROWS:(band + 1) * ROWS])
+
+	def find(self, user_id, exact, sig, since):
+		entry = self.index.get(('exact', user_id, exact))
+		if entry is not None and entry['seen'] >= since:
+			return entry
+		for key in self.keys(user_id, exact, sig):
+			entry = self.index.get(key)
+			if entry is not None and entry['seen'] >= since and similarity(entry['signature'], sig) >= self.similarity:
+				return entry
+		return None
+
+	def store(self, entry, keys):
+		""" Indexes `entry` under `keys` (as long as it has room for them) and evicts the oldest entries """
+		for key in keys:
+			if key not in entry['keys'] and len(entry['keys']) >= self.max_keys:
+				break
+			entry['keys'].add(key)
+			self.index[key] = entry
+		self.entries[entry['id']] = entry
+		self.entries.move_to_end(entry['id'])
+		while len(self.entries) > self.max_entries:
+			eid, old = self.entries.popitem(last=False)
+			for key in old['keys']:
+				if self.index.get(key) is old:
+					del self.index[key]
+
+	def add(self, room_id, user_id, message_id, text, rooms, window, now=None):
+		""" Records a message, returns the sightings to act on [(room_id, user_id, message_id)]
+
+		Every sighting of the last `window` seconds the first time the user's text reaches
+		`rooms` rooms, only the new one after that, an empty list while it hasn't.
+		"""
+		normalized = normalize(text)
+		if len(normalized) < self.min_length:
+			return []
+		now   = time.monotonic() if now is None else now
+		exact = stable_hash(normalized)
+		sig   = signature(normalized.split(' ', MAX_WORDS)[:MAX_WORDS])
+		since = now - window
+
+		with self.lock:
+			entry = self.find(user_id, exact, sig, since)
+			if entry is None:
+				entry = { 'id': self.next_id, 'user_id': user_id, 'signature': sig, 'keys': set(), 'seen': now, 'rooms': {}, 'reported': False }
+				self.next_id += 1
+
+			# Forget the sightings older than the window
+			for room in [r for r, sightings in entry['rooms'].items() if sightings[-1][0] < since]:
+				del entry['rooms'][room]
+			if len(entry['rooms']) == 0:
+				entry['reported'] = False
+
+			sightings = entry['rooms'].setdefault(room_id, [])
+			sightings.append((now, message_id))
+			del sightings[:-self.max_sightings]
+			entry['seen'] = now
+			self.store(entry, self.keys(user_id, exact, sig))
+
+			if entry['reported']:
+				return [(room_id, user_id, message_id)]
+			if len(entry['rooms']) >= rooms:
+				entry['reported'] = True
+				return [(room, user_id, s[1]) for room, sightings in entry['rooms'].items() for s in sightings if s[0] >= since]
+			return []
+
+	def dump(self):
+		""" Entries with wall clock times """
+		shift = time.time() - time.monotonic()
+		with self.lock:
+			return (self.VERSION, [shift_entry(entry, shift) for entry in self.entries.values()])
+
+	def load(self, dumped):
+		if not isinstance(dumped, tuple) or dumped[0] != self.VERSION:
+			return
+		shift = time.monotonic() - time.time()
+		with self.lock:
+			for entry in dumped[1]:
+				entry = shift_entry(entry, shift)
+				entry['id'] = self.next_id
+				self.next_id += 1
+				keys = entry['keys']
+				entry['keys'] = set()
+				self.store(entry, keys)
+
+	def __len__(self):
+		return len(self.entries)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Columnar archive of the chat logs : closed (UTC) days are compacted from mongo into
+# parquet files partitioned by date and room, so the analytics only read the columns
+# they need from history and query mongo for the days not archived yet (today).
+#
+#   <path>/<collection>/date=2018-01-31/room=-123456.parquet
+#   <path>/<collection>/date=2018-01-31/_SUCCESS
+#
+# Backfill from the command line : python3.6 archive.py --days 365
+import argparse
+import datetime
+import glob
+import os
+import shutil
+
+import pandas as pd
+
+import logschema
+
+# Archived collections and their columns
+COLUMNS = {
+	'natalia_textmessages': ['user_id', 'chat_id', 'message_id', 'message', 'timestamp'],
+	'natalia_stickers'    : ['user_id', 'chat_id', 'message_id', 'sticker_id', 'timestamp'],
+	'natalia_gifs'        : ['user_id', 'chat_id', 'message_id', 'file_id', 'timestamp'],
+	'room_joins'          : ['user_id', 'chat_id', 'timestamp'],
+}
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def day_start(moment):
+	return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def utc_today():
+	return day_start(datetime.datetime.utcnow())
+
+
+def parquet_engine():
+	""" Imported on first use, the bot runs without pyarrow as long as ARCHIVE has no path """
+	import pyarrow  # noqa: F401 - parquet engine used by pandas
+	return 'pyarrow'
+
+
+def day_path(root, collection, day):
+	return os.path.join(root, collection, 'date='+day.strftime('%Y-%m-%d'))
+
+
+def is_archived(root, collection, day):
+	return os.path.isfile(os.path.join(day_path(root, collection, day), '_SUCCESS'))
+
+
+def archived_until(root, collection, start, end):
+	""" First day from `start` which is not archived, `end` when they all are """
+	day = day_start(start)
+	while day < end and is_archived(root, collection, day):
+		day += ONE_DAY
+	return max(start, min(day, end))
+
+
+#################################
+#           EXPORT
+
+def export_day(db, root, collection, day):
+	""" Writes one day of a collection, one file per room, returns the number of rows """
+	columns = COLUMNS[collection]
+	engine  = parquet_engine()
+	# Either log schema, the archive keeps the long names
+	rows    = logschema.find(db[collection], day, day + ONE_DAY, names=columns)
+	frame   = pd.DataFrame(list(rows), columns=columns)
+	frame['chat_id'] = frame['chat_id'].astype(str)
+
+	# Written aside then renamed, a half written day is never read
+	path = day_path(root, collection, day)
+	tmp  = path+'.tmp'
+	shutil.rmtree(tmp, ignore_errors=True)
+	os.makedirs(tmp)
+	for chat_id, rows in frame.groupby('chat_id'):
+		rows.drop(columns=['chat_id']).to_parquet(os.path.join(tmp, 'room='+chat_id+'.parquet'), engine=engine, compression='snappy', index=False)
+	open(os.path.join(tmp, '_SUCCESS'), 'w').close()
+
+	shutil.rmtree(path, ignore_errors=True)
+	os.rename(tmp, path)
+	return len(frame)
+
+
+def export_closed_days(db, root, days_back, logger=None):
+	""" Archives every closed day of the last `days_back` days which is not archived yet """
+	today    = utc_today()
+	exported = 0
+	for collection in COLUMNS:
+		day = today - days_back * ONE_DAY
+		while day < today:
+			if not is_archived(root, collection, day):
+				rows = export_day(db, root, collection, day)
+				exported += 1
+				if logger is not None:
+					logger.info("Archived %s %s (%d rows)", collection, day.strftime('%Y-%m-%d'), rows)
+			day += ONE_DAY
+	return exported
+
+
+#################################
+#           READ
+
+def read(root, collection, start, end, columns, chat_id=None):
+	""" Archived rows of the days in [start, end), `chat_id` (str) from the room partition """
+	engine = parquet_engine()
+	frames = []
+	day = day_start(start)
+	while day < end:
+		pattern = 'room='+(str(chat_id) if chat_id is not None else '*')+'.parquet'
+		for file in glob.glob(os.path.join(day_path(root, collection, day), pattern)):
+			frame = pd.read_parquet(file, engine=engine, columns=columns)
+			frame['chat_id'] = os.path.basename(file)[len('room='):-len('.parquet')]
+			frames.append(frame)
+		day += ONE_DAY
+
+	if len(frames) == 0:
+		frame = pd.DataFrame(columns=columns + ['chat_id'])
+		if 'timestamp' in columns:
+			frame['timestamp'] = pd.to_datetime(frame['timestamp'])
+		return frame
+	return pd.concat(frames, ignore_index=True)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Archive closed days of the chat logs to parquet')
+	parser.add_argument('--days', type=int, default=30, help='how many days back to archive')
+	args = parser.parse_args()
+
+	import natalia
+	if not natalia.CONFIG.ARCHIVE_PATH:
+		natalia.logger.error("ARCHIVE path is not set in config.yaml")
+	else:
+		export_closed_days(natalia.analytics_db, natalia.CONFIG.ARCHIVE_PATH, args.days, natalia.logger)
+	natalia.log_listener.stop()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Micro benchmarks for the analytics commands on generated datasets
+#
+#   python3 bench/analytics.py --volumes 10000,100000,1000000 --output bench/results.jsonl
+#
+# Seeds mongomock, or a local mongo with --mongo mongodb://localhost:27017, with N messages
+# (and proportional joins, gifs, stickers, pm requests) spread over --days, then runs each
+# command headlessly (fake bot, stub bitfinex candles) in a forked child so wall time, peak
+# rss and mongo time (queries and cursor iteration) are measured per command.
+# Every result is appended to --output, --baseline compares against an older results file.
+import argparse
+import datetime
+import json
+import multiprocessing
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import common
+
+sys.path.insert(0, common.ROOT_PATH)
+import logschema  # noqa: E402
+
+COMMANDS = ['todayinwords', 'roomwords', 'todaysusers', 'commandstats', 'joinstats', 'topgifposters', 'whalepooloverprice']
+PM_REQUESTS = ['start', 'about', 'rules', 'admins', 'teamspeak', 'telegram', 'livestream', 'exchanges', 'donation']
+WORDS = ['btc', 'long', 'short', 'moon', 'bitmex', 'funding', 'whales', 'pump', 'dump', 'rekt', 'hodl', 'fomo', 'support', 'resistance', 'eth', 'alts', 'margin', 'liquidated', 'bear', 'bull']
+BATCH = 10000
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Benchmark the analytics commands against generated data')
+	parser.add_argument('--volumes', default='10000,100000,1000000', help='comma separated message volumes to seed')
+	parser.add_argument('--commands', default=','.join(COMMANDS), help='comma separated commands to run')
+	parser.add_argument('--days', type=int, default=30, help='days of history to spread the data over')
+	parser.add_argument('--joins', type=float, default=0.02, help='joins per message')
+	parser.add_argument('--gifs', type=float, default=0.05, help='gifs per message')
+	parser.add_argument('--stickers', type=float, default=0.1, help='stickers per message')
+	parser.add_argument('--users', type=int, default=5000, help='number of distinct users')
+	parser.add_argument('--rooms', type=int, default=3)
+	parser.add_argument('--schema', type=int, choices=[1, 2], default=2, help='log schema of the seeded documents (see logschema.py)')
+	parser.add_argument('--repeat', type=int, default=3, help='runs per command, the median is reported')
+	parser.add_argument('--mongo', default=None, help='mongo uri (its natalia_bench database is dropped), mongomock when omitted')
+	parser.add_argument('--output', default=None, help='jsonl file the results are appended to')
+	parser.add_argument('--baseline', default=None, help='jsonl results to compare against')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs the baseline (0.25 = 25%%)')
+	parser.add_argument('--seed', type=int, default=1)
+	return parser.parse_args()
+
+
+#################################
+#           SEEDING
+
+def random_timestamp(now, days):
+	return now - datetime.timedelta(seconds=random.randint(0, days * 86400))
+
+
+def insert_batched(collection, documents):
+	batch = []
+	for document in documents:
+		batch.append(document)
+		if len(batch) >= BATCH:
+			collection.insert_many(batch, ordered=False)
+			batch = []
+	if len(batch) > 0:
+		collection.insert_many(batch, ordered=False)
+
+
+def seed(db, args, volume):
+	""" Drops and fills the benchmark collections with `volume` messages """
+	now   = datetime.datetime.utcnow()
+	rooms = [str(common.ROOM_IDS[i]) for i in range(args.rooms)]
+	users = list(range(7000000, 7000000 + args.users))
+	# Generated as v1, rewritten the way the migration does for v2
+	log   = logschema.compact if args.schema == 2 else (lambda doc: doc)
+
+	for name in ['natalia_textmessages', 'natalia_stickers', 'natalia_gifs', 'room_joins', 'pm_requests', 'users', 'daily_reports']:
+		db.drop_collection(name)
+	logschema.create_indexes(db)
+
+	insert_batched(db.users, ({ 'user_id': u, 'name': 'User'+str(u), 'username': 'user'+str(u), 'last_seen': now } for u in users))
+
+	insert_batched(db.natalia_textmessages, (log({
+		'user_id'   : u,
+		'chat_id'   : random.choice(rooms),
+		'message_id': i,
+		'message'   : 'user'+str(u)+': '+' '.join(random.choice(WORDS) for _ in range(random.randint(2, 15))),
+		'timestamp' : random_timestamp(now, args.days)
+	}) for i, u in enumerate(random.choice(users) for _ in range(volume))))
+
+	insert_batched(db.natalia_stickers, (log({
+		'user_id'   : random.choice(users),
+		'chat_id'   : random.choice(rooms),
+		'message_id': i,
+		'sticker_id': 'STICKER'+str(random.randint(1, 300)),
+		'timestamp' : random_timestamp(now, args.days)
+	}) for i in range(int(volume * args.stickers))))
+
+	insert_batched(db.natalia_gifs, (log({
+		'user_id'   : random.choice(users),
+		'chat_id'   : random.choice(rooms),
+		'message_id': i,
+		'file_id'   : 'GIF'+str(random.randint(1, 2000)),
+		'timestamp' : random_timestamp(now, args.days)
+	}) for i in range(int(volume * args.gifs))))
+
+	insert_batched(db.room_joins, (log({
+		'user_id'  : random.choice(users),
+		'chat_id'  : random.choice(rooms),
+		'timestamp': random_timestamp(now, args.days)
+	}) for i in range(int(volume * args.joins))))
+
+	insert_batched(db.pm_requests, ({
+		'user_id'  : random.choice(users),
+		'request'  : random.choice(PM_REQUESTS),
+		'timestamp': random_timestamp(now, args.days)
+	} for i in range(int(volume * args.joins))))
+
+
+#################################
+#           RUNNING
+
+def stub_candles(api_timeframe, limit=200):
+	""" Deterministic random walk standing in for the bitfinex api """
+	step  = 3600 * 1000 if api_timeframe == '1h' else 86400 * 1000
+	now   = int(time.time() * 1000) // step * step
+	price = 8000.0
+	rows  = []
+	for i in range(limit):
+		close = price * (1 + random.uniform(-0.01, 0.01))
+		rows.append([now - i * step, price, close, max(price, close) * 1.003, min(price, close) * 0.997, random.uniform(10, 500)])
+		price = close
+	return rows
+
+
+def command_update(natalia, bot, command):
+	from telegram import Update
+	admin = natalia.CONFIG.ADMINS[0]
+	return Update.de_json({
+		'update_id': 1,
+		'message'  : {
+			'message_id': 1,
+			'date'      : int(time.time()),
+			'chat'      : { 'id': common.ROOM_IDS[0], 'type': 'supergroup', 'title': 'bench' },
+			'from'      : { 'id': admin, 'is_bot': False, 'first_name': 'Admin', 'username': 'admin' },
+			'text'      : '/'+command
+		}
+	}, bot)
+
+
+def run_command(args, db, command, conn):
+	""" Child process : runs one command and reports its timings """
+	import metrics
+	random.seed(args.seed)
+	# A forked child gets its own mongo connections, mongomock's data is the copy forked with it
+	database = common.mongo_database(args.mongo, drop=False) if args.mongo else db
+	natalia  = common.load_natalia(database, args.rooms)
+	natalia.fetch_candles = stub_candles
+	# Measure the rendering and upload, not a file_id cached by the previous run
+	natalia.db.drop_collection('photo_file_ids')
+
+	bot    = metrics.TimedBot(common.FakeBot())
+	update = command_update(natalia, bot, command)
+
+	rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	started    = time.perf_counter()
+	error      = None
+	try:
+		getattr(natalia, command)(bot, update)
+	except Exception as e:
+		error = repr(e)
+	wall = time.perf_counter() - started
+
+	mongo_time = sum(row[6] for row in metrics.REGISTRY.summary('natalia_backend_seconds') if row[0][0][1] == 'mongo')
+	conn.send({
+		'wall'       : wall,
+		'mongo'      : mongo_time,
+		# ru_maxrss is in kilobytes on linux
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+		'rss_growth_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024.0,
+		'error'      : error
+	})
+	conn.close()
+
+
+def measure(args, db, command):
+	runs = []
+	context = multiprocessing.get_context('fork')
+	for _ in range(args.repeat):
+		parent, child = context.Pipe()
+		process = context.Process(target=run_command, args=(args, db, command, child))
+		process.start()
+		runs.append(parent.recv())
+		process.join()
+	runs.sort(key=lambda r: r['wall'])
+	return runs[len(runs) // 2]
+
+
+def git_revision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=common.ROOT_PATH).decode().strip()
+	except Exception:
+		return None
+
+
+def load_baseline(path):
+	baseline = {}
+	with open(path) as fp:
+		for line in fp:
+			result = json.loads(line)
+			# Latest entry wins
+			baseline[(result['volume'], result['command'])] = result
+	return baseline
+
+
+def main():
+	args     = parse_args()
+	commands = args.commands.split(',')
+	volumes  = [int(v) for v in args.volumes.split(',')]
+	baseline = load_baseline(args.baseline) if args.baseline else {}
+	revision = git_revision()
+	regressions = []
+
+	db = common.mongo_database(args.mongo)
+
+	print("{:>10} {:<20} {:>10} {:>10} {:>10}  {}".format('volume', 'command', 'wall s', 'mongo s', 'rss MB', ''))
+	for volume in volumes:
+		random.seed(args.seed)
+		seeding = time.perf_counter()
+		seed(db, args, volume)
+		print("# seeded {} messages in {:.1f}s".format(volume, time.perf_counter() - seeding))
+
+		for command in commands:
+			result = measure(args, db, command)
+			result.update({ 'volume': volume, 'command': command, 'revision': revision, 'date': datetime.datetime.utcnow().isoformat() })
+
+			note = result['error'] or ''
+			previous = baseline.get((volume, command))
+			if previous is not None and previous['wall'] > 0:
+				change = result['wall'] / previous['wall'] - 1
+				note  += " {:+.0%} vs {}".format(change, previous.get('revision'))
+				if change > args.tolerance:
+					regressions.append(result)
+					note += " REGRESSION"
+
+			print("{:>10} {:<20} {:>10.3f} {:>10.3f} {:>10.1f}  {}".format(volume, command, result['wall'], result['mongo'], result['peak_rss_mb'], note))
+
+			if args.output:
+				with open(args.output, 'a') as fp:
+					fp.write(json.dumps(result)+"\n")
+
+	if len(regressions) > 0:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Shared helpers for the benchmarks : a throw away config, a fake telegram bot
+# recording calls, and loading natalia.py against a local / mock mongo
+import itertools
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter
+
+import yaml
+
+PATH      = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(PATH)
+
+# Synthetic room ids, one per generated room
+ROOM_IDS = [-1001000000001 - i for i in range(32)]
+
+
+def write_config(rooms=3):
+	""" Writes a config derived from config.sample.yaml with distinct room ids, returns its path """
+	with open(ROOT_PATH+'/config.sample.yaml') as fp:
+		config = yaml.safe_load(fp)
+
+	template = config['ROOMS'][0]
+	config['ROOMS'] = []
+	for i in range(rooms):
+		room = dict(template)
+		room['name']          = 'BenchRoom'+str(i)
+		room['id']            = str(ROOM_IDS[i])
+		room['admin_room_id'] = ROOM_IDS[-1]
+		room['forward_channel'] = ROOM_IDS[-2]
+		room['forward_hashtag'] = '#BenchRoom'+str(i)
+		# Only the first room carries the 'post here' flags
+		for flag in ['is_top_stickers', 'is_top_gifs', 'is_wordcloud', 'is_todaysusers', 'is_overprice', 'is_promotets_pin']:
+			room[flag] = 1 if i == 0 else 0
+		room['special_welcome_message'] = ''
+		config['ROOMS'].append(room)
+
+	# Keep the console quiet, the benchmark prints its own report
+	config['LOGGING'] = { 'level': 'WARNING', 'live_feed': 0 }
+	config.pop('METRICS', None)
+
+	fd, path = tempfile.mkstemp(prefix='natalia-bench-', suffix='.yaml')
+	with os.fdopen(fd, 'w') as fp:
+		yaml.safe_dump(config, fp)
+	return path
+
+
+def mongo_database(uri=None, name='natalia_bench', drop=True):
+	""" A real local mongo when an uri is given, mongomock otherwise """
+	if uri:
+		from pymongo import MongoClient
+		client = MongoClient(uri)
+		if drop:
+			client.drop_database(name)
+		return client[name]
+	try:
+		import mongomock
+	except ImportError:
+		sys.exit('mongomock is not installed, pip install mongomock or pass --mongo mongodb://localhost:27017')
+	return mongomock.MongoClient()[name]
+
+
+def load_natalia(database, rooms=3):
+	""" Imports natalia.py with a generated config and points it at the given database """
+	os.environ['NATALIA_CONFIG'] = write_config(rooms)
+	if ROOT_PATH not in sys.path:
+		sys.path.insert(0, ROOT_PATH)
+
+	import metrics
+	import natalia
+	natalia.db = natalia.log_db = natalia.analytics_db = metrics.TimedDatabase(database)
+	return natalia
+
+
+class FakeResult(object):
+	""" Stands in for the Message / UserProfilePhotos objects the handlers read back """
+
+	def __init__(self, message_id, chat_id=None):
+		self.message_id  = message_id
+		self.chat_id     = chat_id
+		self.total_count = 1
+		self.photos      = []
+		self.file_id     = 'FAKE'+str(message_id)
+		# Message.photo, the sizes of a posted photo
+		self.photo       = [self]
+
+
+class FakeBot(object):
+	""" Records every api call and sleeps `latency` (+/- jitter) seconds instead of hitting telegram """
+
+	def __init__(self, latency=0.0, jitter=0.0, username='natalia_bench_bot'):
+		self.latency     = latency
+		self.jitter      = jitter
+		self.username    = username
+		self.id          = 1
+		self.first_name  = 'Natalia'
+		self.calls       = Counter()
+		self.lock        = threading.Lock()
+		self.message_ids = itertools.count(1000000)
+
+	def call(self, method, kwargs):
+		with self.lock:
+			self.calls[method] += 1
+		if self.latency > 0:
+			time.sleep(max(0.0, random.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+		return FakeResult(next(self.message_ids), kwargs.get('chat_id'))
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+
+		def method(bot, *args, **kwargs):
+			return bot.call(name, kwargs)
+		method.__name__ = name
+		# A real bound method, so metrics.TimedBot times it like a telegram.Bot method
+		bound = types.MethodType(method, self)
+		self.__dict__[name] = bound
+		return bound
+
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Load test : replays a synthetic mix of telegram updates through natalia's dispatcher
+#
+#   python3 bench/loadtest.py --rate 200 --duration 30 --latency 80
+#
+# Telegram is replaced by a fake bot (recording calls, sleeping --latency ms per call)
+# and mongo by mongomock, or a real local mongo with --mongo mongodb://localhost:27017
+import argparse
+import itertools
+import random
+import threading
+import time
+from queue import Queue
+
+import common
+
+MIX_DEFAULT = 'text=60,sticker=12,gif=8,url=15,join=5'
+
+WORDS = ['btc', 'long', 'short', 'moon', 'bitmex', 'funding', 'whales', 'pump', 'dump', 'rekt', 'hodl', 'fomo', 'support', 'resistance']
+URLS  = ['https://www.bloomberg.com/news/articles/2018-01-01/bitcoin', 'https://www.coindesk.com/markets/', 'https://www.tradingview.com/x/AbCdEf/', 'https://example.com/blog', 'https://www.bitmex.com/register/AbC123']
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Replay synthetic updates through the natalia dispatcher')
+	parser.add_argument('--rate', type=float, default=100, help='updates per second to push')
+	parser.add_argument('--duration', type=float, default=20, help='seconds to push updates for')
+	parser.add_argument('--latency', type=float, default=50, help='fake telegram api latency in ms')
+	parser.add_argument('--jitter', type=float, default=20, help='+/- ms of jitter on the api latency')
+	parser.add_argument('--mix', default=MIX_DEFAULT, help='update mix, weights per type (text, sticker, gif, url, join)')
+	parser.add_argument('--rooms', type=int, default=3, help='number of rooms to spread updates over')
+	parser.add_argument('--users', type=int, default=500, help='number of distinct users')
+	parser.add_argument('--mongo', default=None, help='mongo uri, mongomock when omitted')
+	parser.add_argument('--outbox-timeout', type=float, default=60, help='seconds to let the outbox drain after the run')
+	parser.add_argument('--seed', type=int, default=1)
+	return parser.parse_args()
+
+
+class UpdateFactory(object):
+	""" Builds raw telegram api update payloads """
+
+	def __init__(self, rooms, users):
+		self.rooms       = [common.ROOM_IDS[i] for i in range(rooms)]
+		self.users       = [{ 'id': 5000000 + i, 'is_bot': False, 'first_name': 'User'+str(i), 'username': 'user'+str(i) } for i in range(users)]
+		self.update_ids  = itertools.count(1)
+		self.message_ids = itertools.count(1)
+
+	def message(self, **fields):
+		message = {
+			'message_id': next(self.message_ids),
+			'date'      : int(time.time()),
+			'chat'      : { 'id': random.choice(self.rooms), 'type': 'supergroup', 'title': 'bench' },
+			'from'      : random.choice(self.users)
+		}
+		message.update(fields)
+		return { 'update_id': next(self.update_ids), 'message': message }
+
+	def text(self):
+		return self.message(text=' '.join(random.choice(WORDS) for _ in range(random.randint(2, 20))))
+
+	def sticker(self):
+		file_id = 'STICKER'+str(random.randint(1, 50))
+		return self.message(sticker={ 'file_id': file_id, 'file_unique_id': file_id, 'width': 512, 'height': 512, 'is_animated': False, 'is_video': False, 'type': 'regular' })
+
+	def gif(self):
+		file_id = 'GIF'+str(random.randint(1, 200))
+		return self.message(document={ 'file_id': file_id, 'file_unique_id': file_id, 'mime_type': 'video/mp4', 'file_name': 'giphy.mp4' })
+
+	def url(self):
+		url  = random.choice(URLS)
+		text = random.choice(WORDS)+' '+url
+		return self.message(text=text, entities=[{ 'type': 'url', 'offset': len(text) - len(url), 'length': len(url) }])
+
+	def join(self):
+		user   = random.choice(self.users)
+		update = self.message(new_chat_members=[user], new_chat_member=user, new_chat_participant=user)
+		# Joins come from the joining user
+		update['message']['from'] = user
+		return update
+
+
+def parse_mix(mix):
+	kinds, weights = [], []
+	for part in mix.split(','):
+		kind, weight = part.split('=')
+		kinds.append(kind.strip())
+		weights.append(float(weight))
+	return kinds, weights
+
+
+def main():
+	args = parse_args()
+	random.seed(args.seed)
+
+	natalia = common.load_natalia(common.mongo_database(args.mongo), args.rooms)
+	import metrics
+	from telegram import Update
+	from telegram.ext import Dispatcher
+
+	fake_bot = common.FakeBot(args.latency / 1000.0, args.jitter / 1000.0)
+	bot      = metrics.TimedBot(fake_bot)
+
+	update_queue = Queue()
+	dp = Dispatcher(bot, update_queue, workers=natalia.WORKERS)
+	natalia.register_handlers(dp)
+	# Api calls go through the outbox's sender threads and rate limits, as in production
+	natalia.OUTBOX.start()
+	dispatcher_thread = threading.Thread(target=dp.start, name='dispatcher', daemon=True)
+	dispatcher_thread.start()
+
+	factory        = UpdateFactory(args.rooms, args.users)
+	kinds, weights = parse_mix(args.mix)
+	sent           = dict((k, 0) for k in kinds)
+	total          = int(args.rate * args.duration)
+
+	print("Pushing {} updates at {:.0f}/s ({})".format(total, args.rate, args.mix))
+	max_depth = 0
+	started   = time.perf_counter()
+	for i in range(total):
+		# Pace against the schedule rather than sleeping a fixed interval
+		delay = started + i / args.rate - time.perf_counter()
+		if delay > 0:
+			time.sleep(delay)
+		kind = random.choices(kinds, weights)[0]
+		update_queue.put(Update.de_json(getattr(factory, kind)(), bot))
+		sent[kind] += 1
+		max_depth = max(max_depth, update_queue.qsize())
+	pushed = time.perf_counter() - started
+
+	# Wait for the backlog to drain
+	while update_queue.qsize() > 0 or metrics.REGISTRY.get_gauge('natalia_handlers_in_flight') > 0:
+		time.sleep(0.01)
+	elapsed = time.perf_counter() - started
+	dp.stop()
+
+	# Then for the api calls they queued
+	deadline = time.perf_counter() + args.outbox_timeout
+	while natalia.OUTBOX.pending() > 0 and time.perf_counter() < deadline:
+		time.sleep(0.01)
+	outbox_left = natalia.OUTBOX.pending()
+	# Waits for the calls being sent, the ones left fail
+	natalia.OUTBOX.stop(0)
+	outbox_done = time.perf_counter() - started
+
+	handlers = metrics.REGISTRY.summary('natalia_handler_seconds', 'natalia_handler_errors_total')
+	backends = metrics.REGISTRY.summary('natalia_backend_seconds', 'natalia_backend_errors_total')
+	handled  = sum(row[1] for row in handlers)
+
+	print("")
+	print("Sent        : "+", ".join(k+"="+str(v) for k, v in sent.items()))
+	print("Push time   : {:.2f}s, drained after {:.2f}s".format(pushed, elapsed))
+	print("Throughput  : {:.1f} updates/s (target {:.0f}/s)".format(handled / elapsed, args.rate))
+	print("Max backlog : "+str(max_depth)+" queued updates")
+	print("Outbox      : drained after {:.2f}s, {} calls left at the timeout".format(outbox_done, outbox_left))
+	print("")
+	print("{:<28} {:>8} {:>7} {:>10} {:>10} {:>10}".format('handler', 'count', 'errors', 'p50 ms', 'p99 ms', 'total s'))
+	for labels, count, errors, mean, p50, p99, total_time in handlers:
+		print("{:<28} {:>8} {:>7} {:>10.2f} {:>10.2f} {:>10.2f}".format(labels[0][1], count, errors, p50 * 1000, p99 * 1000, total_time))
+	print("")
+	print("{:<10} {:<36} {:>8} {:>7} {:>10} {:>10}".format('backend', 'op', 'count', 'errors', 'p50 ms', 'total s'))
+	for labels, count, errors, mean, p50, p99, total_time in backends:
+		print("{:<10} {:<36} {:>8} {:>7} {:>10.2f} {:>10.2f}".format(labels[0][1], labels[1][1], count, errors, p50 * 1000, total_time))
+	print("")
+	print("Mongo ops   : "+str(sum(row[1] for row in backends if row[0][0][1] == 'mongo')))
+	print("Api calls   : "+str(sum(fake_bot.calls.values())))
+
+
+if __name__ == '__main__':
+	main()
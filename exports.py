@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Streaming exports of the logs and stats (the /export admin command) : documents are read
+# from a mongo cursor, formatted a line at a time (CSV or NDJSON) and gzipped into a
+# temporary file, so months of rows only ever hold one cursor batch in memory.
+import csv
+import datetime
+import gzip
+import io
+import json
+import tempfile
+
+FORMATS = ['csv', 'json']
+
+# Telegram refuses bigger uploads from bots
+MAX_BYTES = 50 * 1024 * 1024
+
+
+def value(v):
+	if isinstance(v, datetime.datetime):
+		return v.isoformat()
+	return v
+
+
+def csv_lines(docs, columns):
+	""" Header then one line per document """
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	writer.writerow(columns)
+	yield buffer.getvalue()
+	for doc in docs:
+		buffer.seek(0)
+		buffer.truncate()
+		writer.writerow([value(doc.get(column)) for column in columns])
+		yield buffer.getvalue()
+
+
+def json_lines(docs, columns):
+	""" One json object per line and document """
+	for doc in docs:
+		yield json.dumps(dict((column, value(doc.get(column))) for column in columns), ensure_ascii=False)+"\n"
+
+
+def lines(docs, columns, format):
+	return csv_lines(docs, columns) if format == 'csv' else json_lines(docs, columns)
+
+
+def too_large(max_bytes):
+	return ValueError("more than "+str(max_bytes // (1024 * 1024))+"MB compressed, narrow the rooms or dates")
+
+
+def write(rows, max_bytes=MAX_BYTES):
+	""" Gzips the lines of `rows` into a temporary file, returns it rewound with the number of lines """
+	fp    = tempfile.TemporaryFile()
+	count = 0
+	try:
+		with gzip.GzipFile(fileobj=fp, mode='wb') as gz:
+			for line in rows:
+				gz.write(line.encode('utf-8'))
+				count += 1
+				if count % 10000 == 0 and fp.tell() > max_bytes:
+					raise too_large(max_bytes)
+	except Exception:
+		fp.close()
+		raise
+	if fp.tell() > max_bytes:
+		fp.close()
+		raise too_large(max_bytes)
+	fp.seek(0)
+	return fp, count
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Links forwarded to the feed channels : urls are normalized (scheme, www., tracking
+# parameters, fragment...) so every copy of an article gets the same key, and the keys
+# forwarded to each channel are remembered for a while in a bounded LRU (in mongo, shared
+# by the worker processes, in sharded mode).
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from pymongo.errors import DuplicateKeyError
+
+# Query parameters only telling where the click came from
+TRACKING_PARAMS = frozenset(['fbclid', 'gclid', 'dclid', 'msclkid', 'igshid', 'mc_cid', 'mc_eid', 'cmpid', 'ref', 'ref_src', 'ref_url', 'src', 'srnd', 'smid', 'share', 'sh', 'ncid', 'guccounter', '_ga', '_hsenc', '_hsmi', 'amp'])
+TRACKING_PREFIXES = ('utm_', 'at_', 'pk_', 'mkt_')
+
+# Mobile / www flavours of a host
+HOST_PREFIXES = ('www.', 'm.', 'mobile.', 'amp.')
+
+
+def normalize(url):
+	""" Key of a url, the same for its http / www / tracked / amp copies """
+	if '://' not in url:
+		url = 'http://'+url
+	parts = urlsplit(url.strip())
+
+	host = (parts.hostname or '').rstrip('.')
+	for prefix in HOST_PREFIXES:
+		if host.startswith(prefix):
+			host = host[len(prefix):]
+			break
+
+	path = parts.path.rstrip('/')
+	if path.endswith('/amp'):
+		path = path[:-len('/amp')]
+
+	query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PREFIXES))
+	return host+path+('?'+urlencode(query) if len(query) > 0 else '')
+
+
+class RecentLinks(object):
+	""" Links forwarded per channel, forgotten after `window` seconds or when the LRU is full """
+
+	def __init__(self, max_entries=20000):
+		self.max_entries = max_entries
+		self.seen        = OrderedDict()   # (channel, key) : forwarded at
+		self.lock        = threading.Lock()
+
+	def claim(self, channel, urls, window, now=None):
+		""" Records the urls not forwarded to `channel` in the last `window` seconds and returns
+		their keys, an empty list when they all were. A copy posted while the forward is on its
+		way finds them claimed, release() hands them back if it fails """
+		now     = time.monotonic() if now is None else now
+		claimed = []
+		with self.lock:
+			for key in set(normalize(url) for url in urls):
+				seen = self.seen.get((channel, key))
+				if seen is None or seen < now - window:
+					claimed.append(key)
+					self.seen[(channel, key)] = now
+				self.seen.move_to_end((channel, key))
+			while len(self.seen) > self.max_entries:
+				self.seen.popitem(last=False)
+		return claimed
+
+	def release(self, channel, keys):
+		""" Forgets claimed keys, their forward didn't go out """
+		with self.lock:
+			for key in keys:
+				self.seen.pop((channel, key), None)
+
+	def dump(self):
+		""" Entries with wall clock times, for the restart snapshot """
+		shift = time.time() - time.monotonic()
+		with self.lock:
+			return [(key, seen + shift) for key, seen in self.seen.items()]
+
+	def load(self, entries):
+		shift = time.monotonic() - time.time()
+		with self.lock:
+			for key, seen in entries:
+				self.seen[key] = seen + shift
+			while len(self.seen) > self.max_entries:
+				self.seen.popitem(last=False)
+
+	def __len__(self):
+		return len(self.seen)
+
+
+class SharedLinks(object):
+	""" RecentLinks kept in a mongo collection, the rooms forwarding to a channel may be handled by
+	different processes. A link is one document claimed by its insert, a TTL index removes it
+	once expired (the LRU bound is the window itself) """
+
+	def __init__(self, collection):
+		self.collection = collection
+
+	def create_indexes(self):
+		self.collection.create_index('expires', expireAfterSeconds=0)
+
+	def claim(self, channel, urls, window, now=None):
+		now     = datetime.datetime.utcnow() if now is None else now
+		expires = now + datetime.timedelta(seconds=window)
+		claimed = []
+		for key in set(normalize(url) for url in urls):
+			try:
+				self.collection.insert_one({ '_id': str(channel)+' '+key, 'expires': expires })
+			except DuplicateKeyError:
+				# Expired but not removed yet, the TTL monitor runs once a minute
+				if self.collection.update_one({ '_id': str(channel)+' '+key, 'expires': { '$lte': now } }, { '$set': { 'expires': expires } }).modified_count == 0:
+					continue
+			claimed.append(key)
+		return claimed
+
+	def release(self, channel, keys):
+		if len(keys) > 0:
+			self.collection.delete_many({ '_id': { '$in': [str(channel)+' '+key for key in keys] } })
+
+	def dump(self):
+		# Nothing to snapshot, mongo keeps them
+		return []
+
+	def load(self, entries):
+		pass
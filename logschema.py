@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Compact schema (v2) of the chat logs : short keys, integer chat ids, the username apart
+# from the text and a `ts` field indexed on its own and per room.
+#
+#   v1 { user_id, chat_id: '-1001234', message_id, message: 'username: text', timestamp }
+#   v2 { u, c: -1001234, m, n: 'username', t: 'text', ts }
+#
+# The bot writes v2. The analytics read both schemas through match() / field() / find(),
+# which hand back the long names (chat ids as strings, like the config's room ids), so the
+# existing documents can be rewritten in the background while the bot runs (until then
+# partial indexes on timestamp and (chat_id, timestamp) serve the v1 branch of the queries) :
+#
+#   python3.6 logschema.py --batch 1000 --pause 0.1     (resumes where it stopped)
+import argparse
+import datetime
+import time
+
+from pymongo import ReplaceOne
+from pymongo.errors import OperationFailure
+
+# Long name : short key
+KEYS = {
+	'user_id'   : 'u',
+	'chat_id'   : 'c',
+	'message_id': 'm',
+	'username'  : 'n',
+	'text'      : 't',
+	'sticker_id': 's',
+	'file_id'   : 'f',
+	'timestamp' : 'ts',
+}
+NAMES = dict((key, name) for name, key in KEYS.items())
+
+# Collections written with this schema
+COLLECTIONS = ['natalia_textmessages', 'natalia_stickers', 'natalia_gifs', 'room_joins']
+
+
+def chat_id(value):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		# @channelusername
+		return value
+
+
+def document(**fields):
+	""" v2 document from the long names, document(user_id=1, chat_id='-1001', timestamp=now) """
+	doc = {}
+	for name, value in fields.items():
+		doc[KEYS[name]] = chat_id(value) if name == 'chat_id' else value
+	return doc
+
+
+def is_v1(doc):
+	return 'timestamp' in doc
+
+
+def compact(doc):
+	""" v2 version of a v1 document, same _id """
+	v2 = {}
+	for name, value in doc.items():
+		if name == 'message':
+			# Telegram usernames have no ':' in them
+			v2['n'], _, v2['t'] = value.partition(': ')
+		elif name in KEYS:
+			v2[KEYS[name]] = chat_id(value) if name == 'chat_id' else value
+		elif name == '_id':
+			v2['_id'] = value
+	return v2
+
+
+def expand(doc):
+	""" Long names view of a v1 or v2 document """
+	expanded = {}
+	for key, value in doc.items():
+		expanded[NAMES.get(key, key)] = value
+	if 'chat_id' in expanded:
+		expanded['chat_id'] = str(expanded['chat_id'])
+	if 'message' in expanded:
+		expanded['username'], _, expanded['text'] = expanded['message'].partition(': ')
+	elif 'username' in expanded or 'text' in expanded:
+		expanded['message'] = expanded.get('username', '')+': '+expanded.get('text', '')
+	return expanded
+
+
+#################################
+#           QUERIES
+
+def match(start=None, end=None, chat=None):
+	""" Filter on both schemas, each branch of the $or uses its own index """
+	v1 = {}
+	v2 = {}
+	span = {}
+	if start is not None:
+		span['$gte'] = start
+	if end is not None:
+		span['$lt'] = end
+	if len(span) > 0:
+		v1['timestamp'] = v2['ts'] = span
+	else:
+		# Only the v1 documents are in the partial indexes of the v1 branch
+		v1['timestamp'] = { '$exists': True }
+	if chat is not None:
+		v1['chat_id'] = str(chat)
+		v2['c']       = chat_id(chat)
+	return { '$or': [ v2, v1 ] }
+
+
+def projection(names):
+	""" Projection of the long names on both schemas """
+	fields = { '_id': 0 }
+	for name in names:
+		if name in ('username', 'text', 'message'):
+			fields['message'] = fields['n'] = fields['t'] = 1
+		else:
+			fields[name] = fields[KEYS[name]] = 1
+	return fields
+
+
+def field(name):
+	""" Aggregation expression of a field whichever the schema, chat ids are int or str """
+	return { '$ifNull': [ '$'+KEYS[name], '$'+name ] }
+
+
+def find(collection, start=None, end=None, chat=None, names=None, batch_size=10000):
+	""" Expanded documents of a log collection, streamed from the cursor """
+	cursor = collection.find(match(start, end, chat), projection(names) if names else None).batch_size(batch_size)
+	for doc in cursor:
+		yield expand(doc)
+
+
+def create_indexes(db):
+	""" Indexes of both branches of match(), the v1 ones are partial (only the documents not
+	migrated yet are in them, they are empty once the collection is) """
+	v1 = { 'partialFilterExpression': { 'timestamp': { '$exists': True } } }
+	for collection in COLLECTIONS:
+		db[collection].create_index([('ts', 1)])
+		db[collection].create_index([('c', 1), ('ts', 1)])
+		for name, keys in [('v1_timestamp', [('timestamp', 1)]), ('v1_chat_id_timestamp', [('chat_id', 1), ('timestamp', 1)])]:
+			try:
+				db[collection].create_index(keys, name=name, **v1)
+			except OperationFailure:
+				# An older full index on the same keys, it serves the v1 branch just as well
+				pass
+
+
+#################################
+#           MIGRATION
+
+def migrate(db, collection, batch=1000, pause=0.0, logger=None):
+	""" Rewrites the v1 documents of a collection in _id order, resumes from the last batch """
+	state    = db.migrations.find_one({ '_id': 'logschema:'+collection }) or {}
+	last_id  = state.get('last_id')
+	migrated = state.get('migrated', 0)
+
+	while True:
+		query = {} if last_id is None else { '_id': { '$gt': last_id } }
+		docs  = list(db[collection].find(query).sort('_id', 1).limit(batch))
+		if len(docs) == 0:
+			break
+
+		# Only if it is still v1, the bot may be writing meanwhile
+		requests = [ReplaceOne({ '_id': doc['_id'], 'timestamp': { '$exists': True } }, compact(doc)) for doc in docs if is_v1(doc)]
+		if len(requests) > 0:
+			db[collection].bulk_write(requests, ordered=False)
+
+		last_id   = docs[-1]['_id']
+		migrated += len(requests)
+		db.migrations.update_one({ '_id': 'logschema:'+collection }, { '$set': { 'last_id': last_id, 'migrated': migrated, 'updated': datetime.datetime.utcnow() } }, upsert=True)
+		if logger is not None:
+			logger.info("Migrated %s : %d documents (up to %s)", collection, migrated, str(last_id))
+
+		# Leaves mongo some room for the bot
+		if pause > 0:
+			time.sleep(pause)
+	return migrated
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Rewrite the chat logs to the compact schema (v2)')
+	parser.add_argument('--collections', default=','.join(COLLECTIONS), help='comma separated collections to migrate')
+	parser.add_argument('--batch', type=int, default=1000, help='documents rewritten per batch')
+	parser.add_argument('--pause', type=float, default=0.1, help='seconds to sleep between batches')
+	args = parser.parse_args()
+
+	import natalia
+	create_indexes(natalia.log_db)
+	for name in args.collections.split(','):
+		total = migrate(natalia.log_db, name, args.batch, args.pause, natalia.logger)
+		natalia.logger.info("%s migrated (%d documents)", name, total)
+	natalia.log_listener.stop()
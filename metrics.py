@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# In process metrics for Natalia : latency histograms, counters and gauges
+# exposed as prometheus text and as a short summary for the /perfstats command
+import bisect
+import inspect
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds (seconds) of the latency buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+	""" Cumulative latency histogram, prometheus style """
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = tuple(buckets)
+		self.counts  = [0] * (len(self.buckets) + 1)
+		self.sum     = 0.0
+		self.count   = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum       += value
+		self.count     += 1
+
+	def quantile(self, q):
+		""" Approximate quantile, interpolated inside the matching bucket """
+		if self.count == 0:
+			return 0.0
+		rank  = q * self.count
+		seen  = 0
+		lower = 0.0
+		for i, bound in enumerate(self.buckets):
+			if seen + self.counts[i] >= rank:
+				if self.counts[i] == 0:
+					return bound
+				return lower + (bound - lower) * ((rank - seen) / self.counts[i])
+			seen  += self.counts[i]
+			lower  = bound
+		return self.buckets[-1]
+
+
+class Registry(object):
+	""" Thread safe store of every metric, keyed by (name, labels) """
+
+	def __init__(self):
+		self.lock       = threading.Lock()
+		self.histograms = {}
+		self.counters   = {}
+		self.gauges     = {}
+		self.help       = {}
+		# Handlers running now, thread id : (handler, started)
+		self.running    = {}
+
+	def describe(self, name, text):
+		self.help[name] = text
+
+	def observe(self, name, labels, value):
+		key = (name, labels)
+		with self.lock:
+			hist = self.histograms.get(key)
+			if hist is None:
+				hist = self.histograms[key] = Histogram()
+			hist.observe(value)
+
+	def inc(self, name, labels=(), amount=1):
+		key = (name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + amount
+
+	def set_gauge(self, name, labels, value):
+		with self.lock:
+			self.gauges[(name, labels)] = value
+
+	def add_gauge(self, name, labels, delta):
+		key = (name, labels)
+		with self.lock:
+			self.gauges[key] = self.gauges.get(key, 0) + delta
+
+	def get_gauge(self, name, labels=()):
+		return self.gauges.get((name, labels), 0)
+
+	def busiest_handler(self):
+		""" (handler, seconds) of the handler running for the longest, None when none is """
+		now = time.monotonic()
+		with self.lock:
+			running = list(self.running.values())
+		if len(running) == 0:
+			return None
+		handler, started = min(running, key=lambda r: r[1])
+		return handler, now - started
+
+	def render(self):
+		""" Prometheus text exposition format """
+		out   = []
+		typed = set()
+
+		def header(name, kind):
+			if name in typed:
+				return
+			typed.add(name)
+			if name in self.help:
+				out.append("# HELP "+name+" "+self.help[name])
+			out.append("# TYPE "+name+" "+kind)
+
+		with self.lock:
+			for (name, labels), value in sorted(self.counters.items()):
+				header(name, 'counter')
+				out.append(name+format_labels(labels)+" "+str(value))
+
+			for (name, labels), value in sorted(self.gauges.items()):
+				header(name, 'gauge')
+				out.append(name+format_labels(labels)+" "+str(value))
+
+			for (name, labels), hist in sorted(self.histograms.items()):
+				header(name, 'histogram')
+				cumulative = 0
+				for i, bound in enumerate(hist.buckets):
+					cumulative += hist.counts[i]
+					out.append(name+"_bucket"+format_labels(labels + (('le', repr(bound)),))+" "+str(cumulative))
+				out.append(name+"_bucket"+format_labels(labels + (('le', '+Inf'),))+" "+str(hist.count))
+				out.append(name+"_sum"+format_labels(labels)+" "+repr(hist.sum))
+				out.append(name+"_count"+format_labels(labels)+" "+str(hist.count))
+
+		return "\n".join(out)+"\n"
+
+	def summary(self, name, errors_name=None):
+		""" Rows of (labels, count, errors, mean, p50, p99, total) for one histogram, slowest total first """
+		rows = []
+		with self.lock:
+			for (hname, labels), hist in self.histograms.items():
+				if hname != name:
+					continue
+				errors = self.counters.get((errors_name, labels), 0) if errors_name else 0
+				mean   = hist.sum / hist.count if hist.count else 0.0
+				rows.append((labels, hist.count, errors, mean, hist.quantile(0.5), hist.quantile(0.99), hist.sum))
+		rows.sort(key=lambda r: r[6], reverse=True)
+		return rows
+
+
+def format_labels(labels):
+	if not labels:
+		return ""
+	return "{"+",".join(k+'="'+str(v).replace('\\', '\\\\').replace('"', '\\"')+'"' for k, v in labels)+"}"
+
+
+REGISTRY = Registry()
+REGISTRY.describe('natalia_handler_seconds', 'Time spent in a dispatcher handler')
+REGISTRY.describe('natalia_handler_errors_total', 'Exceptions raised by a dispatcher handler')
+REGISTRY.describe('natalia_backend_seconds', 'Time spent in a telegram or mongo call')
+REGISTRY.describe('natalia_backend_errors_total', 'Exceptions raised by a telegram or mongo call')
+REGISTRY.describe('natalia_handlers_in_flight', 'Handlers currently running')
+
+
+#################################
+#    HANDLER / BACKEND TIMERS
+
+def timed_handler(func, name=None, registry=REGISTRY):
+	""" Wrap a dispatcher callback to record its latency and errors """
+	labels = (('handler', name or func.__name__),)
+
+	@wraps(func)
+	def wrapped(*args, **kwargs):
+		registry.add_gauge('natalia_handlers_in_flight', (), 1)
+		thread = threading.get_ident()
+		with registry.lock:
+			registry.running[thread] = (labels[0][1], time.monotonic())
+		started = time.perf_counter()
+		try:
+			return func(*args, **kwargs)
+		except Exception:
+			registry.inc('natalia_handler_errors_total', labels)
+			raise
+		finally:
+			registry.observe('natalia_handler_seconds', labels, time.perf_counter() - started)
+			with registry.lock:
+				registry.running.pop(thread, None)
+			registry.add_gauge('natalia_handlers_in_flight', (), -1)
+	return wrapped
+
+
+def timed_call(func, backend, op, registry=REGISTRY):
+	labels = (('backend', backend), ('op', op))
+
+	@wraps(func)
+	def wrapped(*args, **kwargs):
+		started = time.perf_counter()
+		try:
+			return func(*args, **kwargs)
+		except Exception:
+			registry.inc('natalia_backend_errors_total', labels)
+			raise
+		finally:
+			registry.observe('natalia_backend_seconds', labels, time.perf_counter() - started)
+	return wrapped
+
+
+# Collection methods handing back a cursor, the queries run while it is iterated
+CURSOR_METHODS = frozenset(['find', 'aggregate', 'find_raw_batches', 'aggregate_raw_batches'])
+
+
+def timed_cursor(func, backend, op, registry=REGISTRY):
+	""" Wraps a method returning a cursor, the call and the iteration are recorded as one operation """
+	labels = (('backend', backend), ('op', op))
+
+	@wraps(func)
+	def wrapped(*args, **kwargs):
+		started = time.perf_counter()
+		try:
+			cursor = func(*args, **kwargs)
+		except Exception:
+			registry.inc('natalia_backend_errors_total', labels)
+			registry.observe('natalia_backend_seconds', labels, time.perf_counter() - started)
+			raise
+		return TimedCursor(cursor, labels, registry, time.perf_counter() - started)
+	return wrapped
+
+
+class TimedCursor(object):
+	""" Proxy around a pymongo cursor adding up the time spent fetching its batches (and in its
+	count / distinct...), recorded once exhausted or dropped """
+
+	def __init__(self, cursor, labels, registry, elapsed=0.0):
+		self._cursor   = cursor
+		self._labels   = labels
+		self._registry = registry
+		self._elapsed  = elapsed
+		self._recorded = False
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		started = time.perf_counter()
+		try:
+			document = next(self._cursor)
+		except StopIteration:
+			self._elapsed += time.perf_counter() - started
+			self.record()
+			raise
+		except Exception:
+			self._elapsed += time.perf_counter() - started
+			self._registry.inc('natalia_backend_errors_total', self._labels)
+			self.record()
+			raise
+		self._elapsed += time.perf_counter() - started
+		return document
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		attr = getattr(self._cursor, name)
+		if not callable(attr):
+			return attr
+
+		def call(*args, **kwargs):
+			started = time.perf_counter()
+			try:
+				result = attr(*args, **kwargs)
+			finally:
+				self._elapsed += time.perf_counter() - started
+			# sort(), limit(), batch_size()... return the cursor itself
+			return self if result is self._cursor else result
+		return call
+
+	def record(self):
+		if not self._recorded:
+			self._recorded = True
+			self._registry.observe('natalia_backend_seconds', self._labels, self._elapsed)
+
+	def __del__(self):
+		# Left before the end (a find().limit(1) loop returning early...)
+		self.record()
+
+
+class TimedBot(object):
+	""" Proxy around telegram.Bot timing every api method (bot.sendMessage, bot.delete_message...) """
+
+	def __init__(self, bot, registry=REGISTRY):
+		self.__dict__['_bot']      = bot
+		self.__dict__['_registry'] = registry
+
+	def __getattr__(self, name):
+		attr = getattr(self._bot, name)
+		if name.startswith('_') or not inspect.ismethod(attr):
+			return attr
+		wrapped = timed_call(attr, 'telegram', name, self._registry)
+		# Cache so later lookups skip __getattr__
+		self.__dict__[name] = wrapped
+		return wrapped
+
+	def __setattr__(self, name, value):
+		setattr(self._bot, name, value)
+
+
+class TimedCollection(object):
+	""" Proxy around a pymongo collection timing every operation (insert, find, aggregate...) """
+
+	def __init__(self, collection, registry=REGISTRY):
+		self.__dict__['_collection'] = collection
+		self.__dict__['_registry']   = registry
+
+	def __getattr__(self, name):
+		attr = getattr(self._collection, name)
+		if name.startswith('_') or not inspect.ismethod(attr):
+			return attr
+		timer   = timed_cursor if name in CURSOR_METHODS else timed_call
+		wrapped = timer(attr, 'mongo', self._collection.name+'.'+name, self._registry)
+		self.__dict__[name] = wrapped
+		return wrapped
+
+
+class TimedDatabase(object):
+	""" Proxy around a pymongo database handing out timed collections (db.natalia_gifs, db['users']) """
+
+	def __init__(self, database, registry=REGISTRY):
+		self.__dict__['_database']    = database
+		self.__dict__['_registry']    = registry
+		self.__dict__['_collections'] = {}
+
+	def __getitem__(self, name):
+		collection = self._collections.get(name)
+		if collection is None:
+			collection = self._collections[name] = TimedCollection(self._database[name], self._registry)
+		return collection
+
+	def __getattr__(self, name):
+		# Database methods / properties (command, client, name...) pass through untouched
+		if name.startswith('_') or hasattr(type(self._database), name):
+			return getattr(self._database, name)
+		return self[name]
+
+
+#################################
+#    PROMETHEUS ENDPOINT
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+	registry = REGISTRY
+
+	def do_GET(self):
+		if self.path.split('?')[0] != '/metrics':
+			self.send_error(404)
+			return
+		body = self.registry.render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		# Scrapes every few seconds would flood the console
+		pass
+
+
+def start_http_server(port, host='127.0.0.1'):
+	""" Serve /metrics from a daemon thread """
+	server = HTTPServer((host, port), MetricsRequestHandler)
+	thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+	thread.start()
+	return server
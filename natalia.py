@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # A Simple way to send a message to telegram
+import atexit
 import datetime
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import os
+import pickle
+import queue
 import random
 import re
+import signal
 import sys
+import threading
+import time
+from collections import Counter, OrderedDict
 from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from pprint import pprint
 
 import matplotlib
 import numpy as np
@@ -21,7 +31,7 @@ import telegram
 import yaml
 from PIL import Image
 from dateutil.relativedelta import relativedelta
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, WriteConcern
 from telegram import MessageEntity
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 from wordcloud import WordCloud, STOPWORDS
@@ -34,100 +44,283 @@ from matplotlib.patches import Rectangle
 
 import talib as ta
 
+import antispam
+import archive
+import exports
+import links
+import logschema
+import metrics
+import outbox
+import retention
+
 PATH = os.path.dirname(os.path.abspath(__file__))
 
 """
 # Configure Logging
+# Handler threads only push records onto a queue, the listener thread formats
+# and writes them so a slow stdout never blocks message handling
 """
-FORMAT = '%(asctime)s -- %(levelname)s -- %(module)s %(lineno)d -- %(message)s'
-logging.basicConfig(level=logging.INFO, format=FORMAT)
+FORMAT = '%(asctime)s -- %(levelname)s -- %(threadName)s -- %(module)s %(lineno)d -- %(message)s'
+
+class JsonFormatter(logging.Formatter):
+	""" One json object per line, for the log shipper """
+	def format(self, record):
+		entry = {
+			'time'   : self.formatTime(record),
+			'level'  : record.levelname,
+			'logger' : record.name,
+			'thread' : record.threadName,
+			'line'   : record.lineno,
+			'message': record.getMessage()
+		}
+		if record.exc_info:
+			entry['exc_info'] = self.formatException(record.exc_info)
+		return json.dumps(entry)
+
+class DeferredQueueHandler(QueueHandler):
+	""" Queues the raw record, the %-args are only merged on the listener thread (so only pass immutable args) """
+	def prepare(self, record):
+		return record
+
+log_queue    = queue.Queue(-1)
+log_output   = logging.StreamHandler()
+log_output.setFormatter(logging.Formatter(FORMAT))
+log_listener = QueueListener(log_queue, log_output, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logging.basicConfig(level=logging.INFO, handlers=[DeferredQueueHandler(log_queue)])
 logger = logging.getLogger('root')
-logger.info("Running "+sys.argv[0])
-
-
-"""
-# Mongodb 
-"""
-client  = MongoClient('mongodb://localhost:27017')
-db      = client.natalia_tg_bot
-db.softlog.insert({'comment' : 'Natalia started', 'timestamp' :datetime.datetime.utcnow()})
+# Live feed of the messages the bot sees, debug level & sampled (see LOGGING in the config)
+feed_logger = logging.getLogger('natalia.feed')
+logger.info("Running %s", sys.argv[0])
 
 
 """
 #   Load the config file
 #   Set the Botname / Token
+#   load_config() parses & validates it, apply_config() swaps the CONFIG object
+#   (at boot, then on SIGHUP or /reload without restarting the bot)
 """
-config_file = PATH+'/config.yaml'
-my_file     = Path(config_file)
-if my_file.is_file():
-	with open(config_file) as fp:
-		config = yaml.load(fp)
-else:
-	pprint('config.yaml file does not exists. Please make one from config.sample.yaml file')
+config_file = os.environ.get('NATALIA_CONFIG', PATH+'/config.yaml')
+if not Path(config_file).is_file():
+	logger.error('config.yaml file does not exists. Please make one from config.sample.yaml file')
+	log_listener.stop()
 	sys.exit()
 
+# Keys every room needs
+ROOM_KEYS = ['name', 'id', 'prior_welcome_message_id', 'lastuncompressed_image_message_id', 'forward_hashtag', 'is_log', 'is_welcome', 'special_welcome_message', 'is_countershill', 'days_restriction_on_join', 'admin_room_id', 'forward_channel']
+# Runtime state of a room (Config.state), carried over when the config is reloaded
+ROOM_STATE_KEYS = ['prior_welcome_message_id', 'prior_join_message_id', 'lastuncompressed_image_message_id']
+# Messages the handlers use
+MESSAGE_KEYS = ['welcome', 'pmme', 'start', 'admin_start', 'about', 'admins_json', 'rules', 'teamspeak', 'teamspeakbadges', 'telegram', 'livestream', 'fomobot', 'exchanges', 'shill', 'uncompressedImage',
+	'countershillReplyStart', 'countershillReplyCenter', 'countershillAdminWarning', 'topstickersWarning', 'topstickersStart', 'topstickersCenter', 'topstickersEnd',
+	'topgifsStart', 'topgifsEnd', 'topgifpostersStart', 'topgifpostersCenter', 'topgifpostersEnd', 'todayinWords', 'todaysusers']
+# Messages picked at random from a list, every other one but admins_json is a string
+MESSAGE_LISTS = ['welcome', 'goodbye', 'pmme']
 
-BOTNAME                     = config['NATALIA_BOT_USERNAME']
-TELEGRAM_BOT_TOKEN          = config['NATALIA_BOT_TOKEN']
-FORWARD_PRIVATE_MESSAGES_TO = config['BOT_OWNER_ID'] 
-ADMINS                      = config['ADMINS']
-
-EXTRA_STOPWORDS    = config['WORDCLOUD_STOPWORDS']
-FORWARD_URLS       = r""+config['FORWARD_URLS']
-SHILL_DETECTOR     = r""+config['SHILL_DETECTOR']
-COUNTER_SHILL      = []
-
-for s in config['COUNTER_SHILL']:
-	COUNTER_SHILL.append({
-	'title': s['title'],
-	'regex': r""+s['match'],
-	'link' : s['link']
-	})
-
-ADMINS_JSON                 = config['MESSAGES']['admins_json']
-
-# Feed the messages from the config file
-MESSAGES = {}
-for MESSAGE in config['MESSAGES']:
-	MESSAGES[MESSAGE] = config['MESSAGES'][MESSAGE]
-logger.info("Configured messages :")
-logger.info(MESSAGES)
-
-# Feed rooms from the config file 
-ROOMS = {}
-LOG_ROOMS = []
-# For each room from the config
-for ROOM_ITEM in config['ROOMS']:
-	# For each variable of the room
-	for ROOM_VAR_KEY in ROOM_ITEM:
-		# Create the room in the dict
-		if ROOM_VAR_KEY == 'name':
-			room_name = ROOM_ITEM[ROOM_VAR_KEY]
-			ROOMS[room_name] = ROOM_ITEM
+config_lock = threading.Lock()
+
+def compile_regex(name, pattern):
+	try:
+		return re.compile(r""+pattern)
+	except re.error as e:
+		raise ValueError("Invalid regex for "+name+" : "+str(e))
+
+def load_config(config_file):
+	""" Parses and validates the config file into the module settings, raises ValueError if it can't be used """
+	with open(config_file) as fp:
+		config = yaml.safe_load(fp)
+
+	if not isinstance(config, dict):
+		raise ValueError("The config is empty")
+	for key in ['NATALIA_BOT_USERNAME', 'NATALIA_BOT_TOKEN', 'BOT_OWNER_ID', 'ADMINS', 'ROOMS', 'MESSAGES', 'WORDCLOUD_STOPWORDS', 'FORWARD_URLS', 'SHILL_DETECTOR', 'COUNTER_SHILL']:
+		if key not in config:
+			raise ValueError("Missing "+key)
+	for key in MESSAGE_KEYS:
+		if key not in config['MESSAGES']:
+			raise ValueError("Missing MESSAGES "+key)
+	# An unquoted message with ' : ' in it is read as a mapping by yaml
+	for key, message in config['MESSAGES'].items():
+		if key == 'admins_json':
+			continue
+		if key in MESSAGE_LISTS:
+			if not isinstance(message, list) or not all(isinstance(m, str) for m in message):
+				raise ValueError("MESSAGES "+key+" must be a list of strings")
+		elif not isinstance(message, str):
+			raise ValueError("MESSAGES "+key+" must be a string, quote it")
+
+	settings = {}
+	settings['BOTNAME']                     = config['NATALIA_BOT_USERNAME']
+	settings['TELEGRAM_BOT_TOKEN']          = config['NATALIA_BOT_TOKEN']
+	settings['FORWARD_PRIVATE_MESSAGES_TO'] = config['BOT_OWNER_ID']
+	settings['ADMINS']                      = config['ADMINS']
+	settings['METRICS_CONFIG']              = config.get('METRICS') or {}
+	settings['QUEUE_MONITOR']               = config.get('QUEUE_MONITOR') or {}
+	settings['LOGGING']                     = config.get('LOGGING') or {}
+	settings['SHARDING']                    = config.get('SHARDING') or {}
+	settings['ARCHIVE']                     = config.get('ARCHIVE') or {}
+	settings['FLOOD']                       = config.get('FLOOD') or {}
+	settings['DUPLICATES']                  = config.get('DUPLICATES') or {}
+	settings['OUTBOX_CONFIG']               = config.get('OUTBOX') or {}
+	settings['REPORTS_CONFIG']              = config.get('REPORTS') or {}
+	settings['MONGO_CONFIG']                = config.get('MONGO') or {}
+	settings['RETENTION_CONFIG']            = config.get('RETENTION') or {}
+	settings['RESTART']                     = config.get('RESTART') or {}
+	settings['FORWARD_DEDUP']               = config.get('FORWARD_DEDUP') or {}
+	settings['ARCHIVE_PATH']                = os.path.join(PATH, settings['ARCHIVE']['path']) if settings['ARCHIVE'].get('path') else None
+	settings['SNAPSHOT_PATH']               = os.path.join(PATH, settings['RESTART']['snapshot']) if settings['RESTART'].get('snapshot') else None
+	settings['LIVE_FEED_SAMPLE']            = float(settings['LOGGING'].get('live_feed_sample', 1.0))
+	if settings['ARCHIVE_PATH']:
+		try:
+			archive.parquet_engine()
+		except ImportError:
+			raise ValueError("ARCHIVE needs pyarrow (pip install pyarrow), or remove its path")
+
+	settings['WORDCLOUD_STOPWORDS'] = frozenset(STOPWORDS | set(str(w) for w in config['WORDCLOUD_STOPWORDS']))
+	settings['FORWARD_URLS']    = compile_regex('FORWARD_URLS', config['FORWARD_URLS'])
+	settings['SHILL_DETECTOR']  = compile_regex('SHILL_DETECTOR', config['SHILL_DETECTOR'])
+	settings['COUNTER_SHILL']   = []
+	for s in config['COUNTER_SHILL']:
+		settings['COUNTER_SHILL'].append({
+		'title': s['title'],
+		'regex': compile_regex('COUNTER_SHILL '+s['title'], s['match']),
+		'link' : s['link']
+		})
+
+	settings['ADMINS_JSON'] = config['MESSAGES']['admins_json']
+
+	# Feed the messages from the config file
+	settings['MESSAGES'] = dict(config['MESSAGES'])
+
+	# Feed rooms from the config file
+	rooms     = {}
+	log_rooms = []
+	# Hashtag routing table, '#hashtag' (lower case) : feed channels of the rooms using it
+	forward_hashtags = {}
+	for room in config['ROOMS']:
+		for key in ROOM_KEYS:
+			if key not in room:
+				raise ValueError("Room "+str(room.get('name'))+" is missing "+key)
+		if room['special_welcome_message'] != '' and room['special_welcome_message'] not in settings['MESSAGES']:
+			raise ValueError("Room "+room['name']+" special welcome message "+room['special_welcome_message']+" is not in MESSAGES")
+		rooms[room['name']] = room
+		if room['forward_hashtag'] and room['forward_channel']:
+			channels = forward_hashtags.setdefault(room['forward_hashtag'].lower(), [])
+			if room['forward_channel'] not in channels:
+				channels.append(room['forward_channel'])
 		# Add the room to logged_rooms is needed
-		if ROOM_VAR_KEY == 'is_log' and ROOM_ITEM[ROOM_VAR_KEY] == 1:
-			LOG_ROOMS.append(room_name)
-		# Add the Room Variable from the config to the Room in our dict
-		ROOMS[room_name][ROOM_VAR_KEY] = ROOM_ITEM[ROOM_VAR_KEY]
-logger.info("Configured rooms :")
-logger.info(ROOMS)
+		if room['is_log'] == 1:
+			log_rooms.append(room['name'])
+	settings['ROOMS']           = rooms
+	settings['LOG_ROOMS']       = log_rooms
+	settings['FORWARD_HASHTAGS'] = forward_hashtags
+	settings['ROOM_ID_TO_NAME'] = dict((rooms[ROOM]['id'], ROOM) for ROOM in rooms)
+
+	return settings
+
+class Config(object):
+	""" One parsed config file, settings as attributes (CONFIG.ROOMS, CONFIG.MESSAGES...)
+
+	apply_config() swaps the whole object with a single assignment, so a handler reading
+	CONFIG once sees the rooms and the messages of the same file. The rooms' runtime state
+	lives apart in `states`, the same dicts from one config to the next.
+	"""
+
+	def __init__(self, settings, states=None):
+		self.__dict__.update(settings)
+		self.states = {} if states is None else states
+
+	def state(self, room):
+		""" Runtime state of a room (ROOM_STATE_KEYS), starting from the config values """
+		state = self.states.get(room['id'])
+		if state is None:
+			state = self.states.setdefault(room['id'], dict((key, int(room.get(key, 0))) for key in ROOM_STATE_KEYS))
+		return state
+
+CONFIG = None
+
+def apply_config(settings):
+	""" Swaps new settings in, keeping the rooms' runtime state """
+	global CONFIG
+	with config_lock:
+		previous = CONFIG
+
+		if previous is not None and previous.TELEGRAM_BOT_TOKEN != settings['TELEGRAM_BOT_TOKEN']:
+			logger.warning("NATALIA_BOT_TOKEN changed, the new token is only used after a restart")
+			settings['TELEGRAM_BOT_TOKEN'] = previous.TELEGRAM_BOT_TOKEN
+
+		# Apply the logging settings
+		logging.getLogger().setLevel(settings['LOGGING'].get('level', 'INFO'))
+		log_output.setFormatter(JsonFormatter() if settings['LOGGING'].get('format') == 'json' else logging.Formatter(FORMAT))
+		feed_logger.setLevel(logging.DEBUG if settings['LOGGING'].get('live_feed', 0) == 1 else logging.INFO)
+
+		CONFIG = Config(settings, previous.states if previous is not None else None)
+
+	logger.info("Configured %d messages", len(settings['MESSAGES']))
+	logger.debug("Configured messages : %s", settings['MESSAGES'])
+	logger.info("Configured rooms : %s", ", ".join(settings['ROOMS']))
+	logger.debug("Configured rooms : %s", settings['ROOMS'])
+
+try:
+	apply_config(load_config(config_file))
+except ValueError as e:
+	logger.error("Invalid config : %s", str(e))
+	log_listener.stop()
+	sys.exit()
+
+"""
+# Mongodb (MONGO in the config, read at start)
+"""
+MONGO_URI = CONFIG.MONGO_CONFIG.get('uri', 'mongodb://localhost:27017')
+DATABASE  = CONFIG.MONGO_CONFIG.get('database', 'natalia_tg_bot')
+client    = MongoClient(MONGO_URI, **(CONFIG.MONGO_CONFIG.get('options') or {}))
+# State (users, reports, caches) and the chat logs, each with its own write concern
+db        = metrics.TimedDatabase(client.get_database(DATABASE, write_concern=WriteConcern(**(CONFIG.MONGO_CONFIG.get('state_write_concern') or {}))))
+log_db    = metrics.TimedDatabase(client.get_database(DATABASE, write_concern=WriteConcern(**(CONFIG.MONGO_CONFIG.get('log_write_concern') or {}))))
+# The admin commands' scans get their own pool (and a secondary if configured), away from the logging writes
+ANALYTICS_MONGO  = CONFIG.MONGO_CONFIG.get('analytics') or {}
+analytics_client = MongoClient(ANALYTICS_MONGO.get('uri', MONGO_URI), **(ANALYTICS_MONGO.get('options') or {})) if ANALYTICS_MONGO else client
+analytics_db     = metrics.TimedDatabase(analytics_client[DATABASE])
 
 #################################
 # Begin bot.. 
 
-bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
+# Every api call made through the bot is timed (see /perfstats)
+bot = metrics.TimedBot(telegram.Bot(token=CONFIG.TELEGRAM_BOT_TOKEN))
+
+# Outgoing calls, moderation first then welcomes then reports (see outbox.py)
+OUTBOX = outbox.Outbox(
+	workers        = int(CONFIG.OUTBOX_CONFIG.get('workers', 4)),
+	chat_interval  = float(CONFIG.OUTBOX_CONFIG.get('chat_interval', 1.0)),
+	group_interval = float(CONFIG.OUTBOX_CONFIG.get('group_interval', 3.0)),
+	global_rate    = float(CONFIG.OUTBOX_CONFIG.get('global_rate', 30)),
+	retries        = int(CONFIG.OUTBOX_CONFIG.get('retries', 5)))
+
+# Flood counters of every (room, user), kept across config reloads
+FLOOD_DETECTOR = antispam.FloodDetector(int(CONFIG.FLOOD.get('max_tracked_users', 50000)))
+metrics.REGISTRY.describe('natalia_flood_mutes_total', 'Users muted for flooding')
+
+# Texts each user posted across the rooms, to catch the same spam pasted in several of them
+# (per process, a sharded worker only compares the rooms routed to it)
+DUPLICATE_DETECTOR = antispam.DuplicateDetector(int(CONFIG.DUPLICATES.get('max_entries', 20000)), int(CONFIG.DUPLICATES.get('min_length', 30)), float(CONFIG.DUPLICATES.get('similarity', 0.5)))
+metrics.REGISTRY.describe('natalia_duplicate_bans_total', 'Users banned for posting the same text in several rooms')
+
+# Links already forwarded to each feed channel (shared through mongo by the sharded workers, see sharding.py)
+FORWARDED_LINKS = links.RecentLinks(int(CONFIG.FORWARD_DEDUP.get('max_urls', 20000)))
+metrics.REGISTRY.describe('natalia_forward_duplicates_total', 'Links not forwarded again to a feed channel')
 
 # Bot error handler
 def error(bot, update, error):
-	logger.warn('Update "%s" caused error "%s"' % (update, error))
+	logger.warning('Update "%s" caused error "%s"', str(update), str(error))
 
 # Restrict bot functions to admins
 def restricted(func):
 	@wraps(func)
 	def wrapped(bot, update, *args, **kwargs):
 		user_id = update.effective_user.id
-		if user_id not in ADMINS:
-			print("Unauthorized access denied for {}.".format(user_id))
+		if user_id not in CONFIG.ADMINS:
+			logger.warning("Unauthorized access denied for %s.", user_id)
 			return
 		return func(bot, update, *args, **kwargs)
 	return wrapped
@@ -135,6 +328,58 @@ def restricted(func):
 #################################
 #           UTILS   
 
+# Sampled live feed, only pays for the formatting when enabled
+def live_feed(text):
+	config = CONFIG
+	if feed_logger.isEnabledFor(logging.DEBUG) and (config.LIVE_FEED_SAMPLE >= 1 or random.random() < config.LIVE_FEED_SAMPLE):
+		feed_logger.debug(text)
+
+# Mutes a user going over the room's flood threshold, True when this message tripped it
+def check_flood(bot, info):
+	config   = info.config
+	room     = info.room
+	messages = room.get('flood_messages', config.FLOOD.get('messages', 0))
+	seconds  = room.get('flood_seconds', config.FLOOD.get('seconds', 10))
+	user_id  = info.user_id
+	if messages <= 0 or user_id in config.ADMINS:
+		return False
+	if not FLOOD_DETECTOR.hit(room['id'], user_id, messages, seconds):
+		return False
+
+	name    = info.name
+	minutes = int(config.FLOOD.get('mute_minutes', 60))
+	OUTBOX.send(bot, outbox.MODERATION, 'restrict_chat_member', chat_id=room['id'], user_id=user_id, until_date=(datetime.datetime.now() + relativedelta(minutes=minutes)), can_send_messages=False, can_send_media_messages=False, can_send_other_messages=False, can_add_web_page_previews=False)
+	# Plain text, a name with _ or * in it would make telegram refuse a Markdown warning
+	text = config.MESSAGES.get('floodAdminWarning', 'User {0} from {1} was muted for {4} minutes, more than {2} messages in {3} seconds')
+	OUTBOX.send(bot, outbox.MODERATION, 'sendMessage', chat_id=room['admin_room_id'], text=text.format(name, room['name'], messages, seconds, minutes), disable_web_page_preview=1)
+	metrics.REGISTRY.inc('natalia_flood_mutes_total', (('room', room['name']),))
+	logger.info("Muted %s in %s for flooding", user_id, room['name'])
+	return True
+
+# Deletes and bans a text seen in too many rooms, True when this message was one of them
+def check_duplicate(bot, info):
+	config  = info.config
+	room    = info.room
+	rooms   = int(config.DUPLICATES.get('rooms', 0))
+	user_id = info.user_id
+	if rooms <= 0 or user_id in config.ADMINS or not info.message.text:
+		return False
+	sightings = DUPLICATE_DETECTOR.add(room['id'], user_id, info.message_id, info.message.text, rooms, float(config.DUPLICATES.get('seconds', 120)))
+	if len(sightings) == 0:
+		return False
+
+	for room_id, spammer_id, message_id in sightings:
+		OUTBOX.send(bot, outbox.MODERATION, 'delete_message', chat_id=room_id, message_id=message_id)
+		OUTBOX.send(bot, outbox.MODERATION, 'kick_chat_member', chat_id=room_id, user_id=spammer_id)
+		metrics.REGISTRY.inc('natalia_duplicate_bans_total', (('room', config.ROOM_ID_TO_NAME.get(room_id, room_id)),))
+
+	name  = info.name
+	names = ", ".join(sorted(set(config.ROOM_ID_TO_NAME.get(room_id, room_id) for room_id, spammer_id, message_id in sightings)))
+	text  = config.MESSAGES.get('duplicateAdminWarning', 'User {0} from {1} was banned for posting the same text in {2} : {3}')
+	OUTBOX.send(bot, outbox.MODERATION, 'sendMessage', chat_id=room['admin_room_id'], text=text.format(name, room['name'], names, info.message.text[:200]), disable_web_page_preview=1)
+	logger.info("Banned %d duplicate posts of %s", len(sightings), user_id)
+	return True
+
 # Resolve message data to a readable name           
 def get_name(user):
 	try:
@@ -143,446 +388,617 @@ def get_name(user):
 		try:
 			name = user.username
 		except (NameError, AttributeError):
-			error("No username or first name.. wtf")
+			logger.error("No username or first name.. wtf")
 			return  ""
 	return name
 
 # Returns the ROOM object for an id      
-def get_room(room_id):
-	for ROOM in ROOMS:
-		if ROOMS[ROOM]['id'] == str(room_id):
-			return ROOMS[ROOM]
-	error('No room matching the given id')
+def get_room(room_id, config=None):
+	config = config or CONFIG
+	for ROOM in config.ROOMS:
+		if config.ROOMS[ROOM]['id'] == str(room_id):
+			return config.ROOMS[ROOM]
+	logger.error('No room matching the given id %s', room_id)
 	return False
 
 def get_room_for_property(room_property):
-	for ROOM in ROOMS:
-		if ROOMS[ROOM][room_property] == 1:
-			return ROOMS[ROOM]
-	error('No room matching the given property :' + room_property )
+	config = CONFIG
+	for ROOM in config.ROOMS:
+		if config.ROOMS[ROOM].get(room_property) == 1:
+			return config.ROOMS[ROOM]
+	logger.error('No room matching the given property : %s', room_property)
 	return False
 
 
 def get_rooms_for_property(room_property):
+	config = CONFIG
 	VALID_ROOMS = []
-	for ROOM in ROOMS:
-		if ROOMS[ROOM][room_property] == 1:
-			VALID_ROOMS.append(ROOMS[ROOM])
+	for ROOM in config.ROOMS:
+		if config.ROOMS[ROOM].get(room_property) == 1:
+			VALID_ROOMS.append(config.ROOMS[ROOM])
 
-	if (VALID_ROOMS.length > 0):
+	if (len(VALID_ROOMS) > 0):
 		return VALID_ROOMS
 	else :
-		error('No room matching the given property :' + room_property )
+		logger.error('No room matching the given property : %s', room_property)
 		return False
 
+# Writes kept in memory by key and written together every `interval` seconds (or once
+# `max_pending` keys are waiting), off the threads making them
+class BatchedWriter(object):
+
+	def __init__(self, collection_name, interval=15, max_pending=1000):
+		self.collection_name = collection_name
+		self.interval        = interval
+		self.max_pending     = max_pending
+		self.lock            = threading.Lock()
+		self.pending         = {}
+
+	def update(self, key, change):
+		""" Applies `change` to the pending write of `key` (None if there is none yet), flushes once full """
+		with self.lock:
+			self.pending[key] = change(self.pending.get(key))
+			full = len(self.pending) >= self.max_pending
+		if full:
+			self.flush()
+
+	def write(self, pending):
+		raise NotImplementedError
+
+	def flush(self):
+		with self.lock:
+			pending      = self.pending
+			self.pending = {}
+		if len(pending) > 0:
+			self.write(pending)
+
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self.flush()
+			except Exception as e:
+				logger.error("Flushing %s failed : %s", self.collection_name, str(e))
+
+	def start(self):
+		threading.Thread(target=self.run, name=self.collection_name+'-flush', daemon=True).start()
+		atexit.register(self.flush)
+
+# Counts requests in memory and writes them with one insert per flush instead of one per request
+class BatchedCounter(BatchedWriter):
+
+	def inc(self, user_id, request):
+		def count(entry):
+			if entry is None:
+				entry = { 'user_id': user_id, 'request': request, 'timestamp': datetime.datetime.utcnow(), 'count': 0 }
+			entry['count'] += 1
+			return entry
+		self.update((user_id, request), count)
+
+	def write(self, pending):
+		log_db[self.collection_name].insert_many(list(pending.values()), ordered=False)
+
+PM_REQUESTS = BatchedCounter('pm_requests')
+
+# Keeps the last fields to $set per key and writes them with one bulk write per flush
+class BatchedUpdates(BatchedWriter):
+
+	def __init__(self, collection_name, key, interval=15, max_pending=1000):
+		BatchedWriter.__init__(self, collection_name, interval, max_pending)
+		self.key = key
+
+	def set(self, key, fields):
+		self.update(key, lambda pending: dict(pending or {}, **fields))
+
+	def discard(self, key):
+		with self.lock:
+			self.pending.pop(key, None)
+
+	def write(self, pending):
+		db[self.collection_name].bulk_write([UpdateOne({ self.key: key }, { '$set': fields }, upsert=True) for key, fields in pending.items()], ordered=False)
+
+# Profile photo checks, answered on the outbox threads which mustn't wait on mongo
+USER_UPDATES = BatchedUpdates('users', 'user_id')
+
+# Telegram file_id of the images already uploaded, by content hash or report key, so posting
+# the same image again (in any room) doesn't upload it again. Kept in mongo, unused ids expire.
+# Ids are cached from the outbox threads once telegram answers, the writes are batched
+class FileIdCache(object):
+
+	def __init__(self, collection_name, max_entries=500, ttl_days=30):
+		self.collection_name = collection_name
+		self.max_entries     = max_entries
+		self.ttl             = datetime.timedelta(days=ttl_days)
+		self.lock            = threading.Lock()
+		self.entries         = OrderedDict()
+		self.updates         = BatchedUpdates(collection_name, '_id')
+
+	def get(self, key):
+		with self.lock:
+			file_id = self.entries.get(key)
+			if file_id is not None:
+				self.entries.move_to_end(key)
+		now = datetime.datetime.utcnow()
+		if file_id is None:
+			entry = db[self.collection_name].find_one({ '_id': key, 'last_used': { '$gte': now - self.ttl } })
+			if entry is None or entry.get('file_id') is None:
+				return None
+			file_id = entry['file_id']
+			self.remember(key, file_id)
+		self.updates.set(key, { 'last_used': now })
+		return file_id
+
+	def remember(self, key, file_id):
+		with self.lock:
+			self.entries[key] = file_id
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	def put(self, key, file_id):
+		self.remember(key, file_id)
+		self.updates.set(key, { 'file_id': file_id, 'last_used': datetime.datetime.utcnow() })
+
+	def forget(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+		self.updates.discard(key)
+		db[self.collection_name].delete_one({ '_id': key })
+
+	def start(self):
+		db[self.collection_name].create_index('last_used', expireAfterSeconds=int(self.ttl.total_seconds()))
+		self.updates.start()
+
+	def flush(self):
+		self.updates.flush()
+
+PHOTO_CACHE = FileIdCache('photo_file_ids')
+
+# Posts an image from the cache, False if `key` isn't cached. The handlers don't wait for
+# telegram : `sent` gets the future once it answers, and when telegram forgot the file
+# `upload` (if any) posts the image again
+def send_cached_photo(bot, chat_id, key, caption, upload=None, sent=None):
+	file_id = PHOTO_CACHE.get(key)
+	if file_id is None:
+		return False
+	def answered(future):
+		if isinstance(future.exception(), telegram.error.BadRequest):
+			PHOTO_CACHE.forget(key)
+			if upload is not None:
+				upload()
+			else:
+				logger.warning("Telegram forgot the cached photo %s, it is rendered again next time", key)
+		elif sent is not None:
+			sent(future)
+	OUTBOX.send(bot, outbox.REPORT, 'sendPhoto', chat_id=chat_id, photo=file_id, caption=caption).add_done_callback(answered)
+	return True
+
+# Posts a generated image, uploading it only if the same content was never posted before.
+# The file is read at once (the caller can remove it), its file_id is cached once posted
+def send_photo(bot, chat_id, path, caption, key=None):
+	with open(path, 'rb') as fp:
+		content = fp.read()
+	digest = 'sha1:'+hashlib.sha1(content).hexdigest()
+
+	def sent(future):
+		if future.exception() is None:
+			file_id = future.result().photo[-1].file_id
+			PHOTO_CACHE.put(digest, file_id)
+			if key is not None:
+				PHOTO_CACHE.put(key, file_id)
+
+	def upload():
+		OUTBOX.send(bot, outbox.REPORT, 'sendPhoto', chat_id=chat_id, photo=io.BytesIO(content), caption=caption).add_done_callback(sent)
+
+	if not send_cached_photo(bot, chat_id, digest, caption, upload, sent):
+		upload()
+
 #################################
 #       BEGIN BOT COMMANDS      
 
 # Returns the user their user id 
 def getid(bot, update):
-	pprint(update.message.chat.__dict__, indent=4)
+	logger.debug("/id - %s", str(update.message.chat.to_dict()))
 	update.message.reply_text(str(update.message.chat.first_name)+" :: "+str(update.message.chat.id))
 
-# Welcome message 
-def start(bot, update):
-
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	user_id = update.message.from_user.id 
-	name = get_name(update.message.from_user)
-	logger.info("/start - "+name)
-
-	pprint(update.message.chat.type)
-
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
-		msg = MESSAGES['rules']
-
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'start', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		msg = bot.sendMessage(chat_id=room['id'], text=(MESSAGES['start'] % name),parse_mode="Markdown",disable_web_page_preview=1)
-
-		if user_id in ADMINS:
-			msg = bot.sendMessage(chat_id=room['id'], text=(MESSAGES['admin_start'] % name),parse_mode="Markdown",disable_web_page_preview=1)
-
-
-def about(bot, update):
-
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/about - "+name)
-
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
-		msg = MESSAGES['about']
-
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'about', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		bot.sendMessage(chat_id=room['id'],text=msg,parse_mode="Markdown",disable_web_page_preview=1) 
-
-
-def rules(bot, update):
-
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/rules - "+name)
-
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
-		msg = MESSAGES['rules']
-
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'rules', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		bot.sendMessage(chat_id=room['id'],text=msg,parse_mode="Markdown",disable_web_page_preview=1) 
-
-
-def admins(bot, update):
-
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/admins - "+name)
-
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
-		msg = "*Whalepool Admins*\n\n"
-		keys = list(ADMINS_JSON.keys())
-		random.shuffle(keys)
-		for k in keys: 
-			msg += ""+k+"\n"
-			msg += ADMINS_JSON[k]['adminOf']+"\n"
-			msg += "_"+ADMINS_JSON[k]['about']+"_"
-			msg += "\n\n"
-		msg += "/start - to go back to home"
-
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'admins', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		bot.sendMessage(chat_id=room['id'],text=msg,parse_mode="Markdown",disable_web_page_preview=1) 
-
-
-def teamspeak(bot, update):
-
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/teamspeak - "+name)
-
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
-		msg = MESSAGES['teamspeak']
-
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'teamspeak', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		bot.sendSticker(chat_id=room['id'], sticker="CAADBAADqgIAAndCvAiTIPeFFHKWJQI", disable_notification=False)
-		bot.sendMessage(chat_id=room['id'], text=msg,parse_mode="Markdown", disable_web_page_preview=1) 
-
-
-def teamspeakbadges(bot, update):
-
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/teamspeakbadges - "+name)
-
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
-		msg = MESSAGES['teamspeakbadges']
-
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'teamspeakbadges', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		bot.sendMessage(chat_id=room['id'],text=msg,parse_mode="Markdown",disable_web_page_preview=1) 
-
-		
-def telegram(bot, update):
-
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/telegram - "+name)
-
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
-		msg = MESSAGES['telegram']
-
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'telegram', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		bot.sendMessage(chat_id=room['id'],text=msg,parse_mode="Markdown",disable_web_page_preview=1) 
-
-
-def livestream(bot, update):
+#################################
+#       PM PAGES
+# The static info pages (/start, /about, /rules...) are pre-rendered from MESSAGES
+# at load time. A page is a list of variants, a variant the list of (bot method, kwargs)
+# calls to make, chat_id is the only argument added when sending.
+
+# Commands served as pages
+PM_PAGE_COMMANDS = [
+	'start',
+	'about',
+	'rules',
+	'admins',
+	'teamspeak',
+	'teamspeakbadges',
+	'telegram',
+	'livestream',
+	# 'fomobot',
+	'exchanges',
+	'donation',
+]
+
+# Number of pre-shuffled /admins pages to pick from
+ADMINS_PAGE_VARIANTS = 10
+
+def page_message(text, personal=False):
+	return ('sendMessage', { 'text': text, 'parse_mode': "Markdown", 'disable_web_page_preview': 1 }, personal)
+
+def render_admins_pages(ADMINS_JSON):
+	blocks = []
+	for k in ADMINS_JSON:
+		blocks.append(""+k+"\n"+ADMINS_JSON[k]['adminOf']+"\n"+"_"+ADMINS_JSON[k]['about']+"_"+"\n\n")
+
+	pages = []
+	for i in range(ADMINS_PAGE_VARIANTS):
+		random.shuffle(blocks)
+		pages.append("*Whalepool Admins*\n\n"+"".join(blocks)+"/start - to go back to home")
+	return pages
+
+def build_pages(MESSAGES, ADMINS_JSON):
+	return {
+		# '%s' in start / admin_start is the user's name
+		'start'           : [ [ page_message(MESSAGES['start'], personal=True) ] ],
+		'admin_start'     : [ [ page_message(MESSAGES['admin_start'], personal=True) ] ],
+		'about'           : [ [ page_message(MESSAGES['about']) ] ],
+		'rules'           : [ [ page_message(MESSAGES['rules']) ] ],
+		'admins'          : [ [ page_message(text) ] for text in render_admins_pages(ADMINS_JSON) ],
+		'teamspeak'       : [ [ ('sendSticker', { 'sticker': "CAADBAADqgIAAndCvAiTIPeFFHKWJQI", 'disable_notification': False }, False), page_message(MESSAGES['teamspeak']) ] ],
+		'teamspeakbadges' : [ [ page_message(MESSAGES['teamspeakbadges']) ] ],
+		'telegram'        : [ [ page_message(MESSAGES['telegram']) ] ],
+		'livestream'      : [ [ ('sendSticker', { 'sticker': "CAADBAADcwIAAndCvAgUN488HGNlggI", 'disable_notification': False }, False), page_message(MESSAGES['livestream']) ] ],
+		'fomobot'         : [ [ page_message(MESSAGES['fomobot']) ] ],
+		'exchanges'       : [ [ page_message(MESSAGES['exchanges']) ] ],
+		'donation'        : [ [ ('sendPhoto', { 'photo': "AgADBAADlasxG4uhCVPAkVD5G4AaXgtKXhkABL8N5jNhPaj1-n8CAAEC", 'caption': "Donations by bitcoin to: 175oRbKiLtdY7RVC8hSX7KD69WQs8PcRJA" }, False) ] ],
+	}
+
+# The handlers aren't running yet, reloads build the pages in reload_config()
+CONFIG.PAGES = build_pages(CONFIG.MESSAGES, CONFIG.ADMINS_JSON)
+
+def send_page(bot, chat_id, page, name):
+	variant = page[0] if len(page) == 1 else random.choice(page)
+	for method, kwargs, personal in variant:
+		if personal:
+			kwargs = dict(kwargs, text=kwargs['text'] % name)
+		OUTBOX.send(bot, outbox.WELCOME, method, chat_id=chat_id, **kwargs)
+
+# Builds the handler for one page command
+def pm_page(request):
+
+	def handler(bot, update):
+		config = CONFIG
+		message = update.message
+		user_id = message.from_user.id
+		name    = get_name(message.from_user)
+		logger.info("/%s - %s", request, name)
+
+		if (message.chat.type == 'group') or (message.chat.type == 'supergroup'):
+			msg = random.choice(config.MESSAGES['pmme']) % (name)
+			OUTBOX.send(bot, outbox.WELCOME, 'sendMessage', chat_id=message.chat_id,text=msg,reply_to_message_id=message.message_id, parse_mode="Markdown",disable_web_page_preview=1)
+			return
 
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/livestream - "+name)
+		PM_REQUESTS.inc(user_id, request)
+		send_page(bot, message.chat_id, config.PAGES[request], name)
 
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
-		msg = MESSAGES['livestream']
+		if request == 'start' and user_id in config.ADMINS:
+			send_page(bot, message.chat_id, config.PAGES['admin_start'], name)
 
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'livestream', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		bot.sendSticker(chat_id=room['id'], sticker="CAADBAADcwIAAndCvAgUN488HGNlggI", disable_notification=False)
-		bot.sendMessage(chat_id=room['id'],text=msg,parse_mode="Markdown",disable_web_page_preview=1) 
+	handler.__name__ = request
+	return handler
 
 
-def fomobot(bot, update):
+####################################################
+# ADMIN FUNCTIONS
 
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/fomobot - "+name)
+# Admin commands, routed to the analytics worker in sharded mode (see sharding.py)
+ADMIN_COMMANDS = ['topstickers', 'topgif', 'topgifposters', 'todayinwords', 'roomwords', 'todaysusers', 'promotets', 'shill', 'commandstats', 'joinstats', 'whalepooloverprice', 'perfstats', 'reload', 'special', 'export']
 
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
+#################################
+# Daily reports : the per day counts behind the leaderboards and stats, closed (UTC) days
+# are computed once and stored in daily_reports (see reports_job), today is counted live
+
+# report : (collection, counted field, amount per document)
+REPORTS = {
+	'commands'  : ('pm_requests', 'request', { "$ifNull": [ "$count", 1 ] }),
+	'joins'     : ('room_joins', 'chat_id', 1),
+	'stickers'  : ('natalia_stickers', 'sticker_id', 1),
+	'gifs'      : ('natalia_gifs', 'file_id', 1),
+	'gifposters': ('natalia_gifs', 'user_id', 1),
+}
+
+def count_day(report, day):
+	collection, field, amount = REPORTS[report]
+	if collection in logschema.COLLECTIONS:
+		match, group = logschema.match(day, day + archive.ONE_DAY), logschema.field(field)
 	else:
-		msg = MESSAGES['fomobot']
-
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'fomobot', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		bot.sendMessage(chat_id=room['id'],text=msg,parse_mode="Markdown",disable_web_page_preview=1) 
-
+		match, group = { 'timestamp': { '$gte': day, '$lt': day + archive.ONE_DAY } }, '$'+field
+	pipe = [
+		{ "$match": match },
+		{ "$group": { "_id": group, "total": { "$sum": amount } } }
+	]
+	counts = Counter()
+	for r in analytics_db[collection].aggregate(pipe):
+		if r['_id'] is not None:
+			# Chat ids are int (v2) or str (v1) until the logs are migrated, keyed like the config
+			counts[str(r['_id']) if field == 'chat_id' else r['_id']] += r['total']
+	return dict(counts)
+
+def store_day(report, day, counts):
+	# As pairs, ids aren't always valid mongo keys
+	document = { 'report': report, 'day': day, 'counts': [[k, v] for k, v in counts.items()], 'computed': datetime.datetime.utcnow() }
+	db.daily_reports.replace_one({ '_id': report+':'+day.strftime('%Y-%m-%d') }, document, upsert=True)
+
+def daily_counts(report, start):
+	""" [(day, {key: count})] from the day of `start` to today, a closed day missing from the store is computed and stored """
+	today  = archive.utc_today()
+	first  = archive.day_start(start)
+	stored = dict((d['day'], dict(d['counts'])) for d in db.daily_reports.find({ 'report': report, 'day': { '$gte': first, '$lt': today } }))
+
+	days = []
+	day  = first
+	while day < today:
+		counts = stored.get(day)
+		if counts is None:
+			counts = count_day(report, day)
+			store_day(report, day, counts)
+		days.append((day, counts))
+		day += archive.ONE_DAY
+	days.append((today, count_day(report, today)))
+	return days
+
+def total_counts(report, start):
+	totals = Counter()
+	for day, counts in daily_counts(report, start):
+		totals.update(counts)
+	return totals
+
+# The all time leaderboards cover this many days
+def leaderboard_start():
+	return archive.utc_today() - int(CONFIG.REPORTS_CONFIG.get('backfill_days', 365)) * archive.ONE_DAY
 
-def exchanges(bot, update):
+@restricted
+def topstickers(bot,update):    
 
+	config = CONFIG
 	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/exchanges - "+name)
-
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
-		msg = MESSAGES['exchanges']
-
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'exchanges', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
-
-		bot.sendMessage(chat_id=room['id'],text=msg,parse_mode="Markdown",disable_web_page_preview=1) 
-		# bot.forwardMessage(chat_id=WP_ADMIN, from_chat_id=chat_id, message_id=message_id)
+	room = get_room(update.message.chat.id, config)
+	room_to_send = get_room_for_property('is_top_stickers')
 
+	start = archive.utc_today() - relativedelta(days=3)
+	stickers = total_counts('stickers', start).most_common(3)
 
-def donation(bot, update):
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text=config.MESSAGES['topstickersWarning'])
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room_to_send['id'], text=config.MESSAGES['topstickersStart'])
+	for sticker_id, total in stickers:
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room_to_send['id'], text=config.MESSAGES['topstickersCenter'].format(str(total)))
+		OUTBOX.send(bot, outbox.REPORT, 'sendSticker', chat_id=room_to_send['id'], sticker=sticker_id, disable_notification=False)
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text=config.MESSAGES['topstickersEnd'].format(room_to_send['name']))
 
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	message_id = update.message.message_id
-	name = get_name(update.message.from_user)
-	logger.info("/donation - "+name)
 
-	if (update.message.chat.type == 'group') or (update.message.chat.type == 'supergroup'):
-		msg = random.choice(MESSAGES['pmme']) % (name)
-		bot.sendMessage(chat_id=room['id'],text=msg,reply_to_message_id=message_id, parse_mode="Markdown",disable_web_page_preview=1) 
-	else:
+@restricted
+def topgif(bot,update):
 
-		timestamp = datetime.datetime.utcnow()
-		info = { 'user_id': user_id, 'request': 'donation', 'timestamp': timestamp }
-		db.pm_requests.insert(info)
+	config = CONFIG
+	room = get_room(update.message.chat.id, config)
+	room_to_send = get_room_for_property('is_top_gifs')
 
-		bot.sendPhoto(chat_id=room['id'], photo="AgADBAADlasxG4uhCVPAkVD5G4AaXgtKXhkABL8N5jNhPaj1-n8CAAEC",caption="Donations by bitcoin to: 175oRbKiLtdY7RVC8hSX7KD69WQs8PcRJA")
+	gifs = total_counts('gifs', leaderboard_start()).most_common(5)
 
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room_to_send['id'], text=config.MESSAGES['topgifsStart'].format(str(gifs[0][1])))
+	OUTBOX.send(bot, outbox.REPORT, 'sendSticker', chat_id=room_to_send['id'], sticker=gifs[0][0], disable_notification=False)
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text=config.MESSAGES['topgifsEnd'].format(room_to_send['name']))
 
-####################################################
-# ADMIN FUNCTIONS
 
 @restricted
-def topstickers(bot,update):    
+def topgifposters(bot, update):
 
-	user_id = update.message.from_user.id 
-	room = get_room(update.message.chat.id)
-	room_to_send = get_room_for_property('is_top_stickers')
+	config = CONFIG
+	room = get_room(update.message.chat.id, config)
+	room_to_send = get_room_for_property('is_top_gifs')
 
-	start = datetime.datetime.today().replace(hour=0,minute=0,second=0)
-	start = start - relativedelta(days=3)
+	users = total_counts('gifposters', leaderboard_start()).most_common(5)
 
-	pipe = [ 
-		{ "$match": { 'timestamp': {'$gt': start } } }, 
-		{ "$group": { "_id": "$sticker_id", "total": { "$sum": 1 }  } }, 
-		{ "$sort": { "total": -1 } }, 
-		{ "$limit": 3 }   
-	]
-	stickers = list(db.natalia_stickers.aggregate(pipe))
+	msg = config.MESSAGES['topgifpostersStart'].format(room_to_send['name'])
+	for i,(user_id, total) in enumerate(users):
 
-	bot.sendMessage(chat_id=room['id'], text=MESSAGES['topstickersWarning'])
-	bot.sendMessage(chat_id=room_to_send['id'], text=MESSAGES['topstickersStart'])
-	for sticker in stickers:
-		bot.sendMessage(chat_id=room_to_send['id'], text=MESSAGES['topstickersCenter'].format(str(sticker['total'])))
-		bot.sendSticker(chat_id=room_to_send['id'], sticker=sticker['_id'], disable_notification=False)
-		time.sleep(5)
-	bot.sendMessage(chat_id=room['id'], text=MESSAGES['topstickersEnd'].format(room_to_send['name']))
+		user = list(db.users.find({ 'user_id': user_id }))
+		if len(user) > 0:
+			user = user[0]
+			msg += config.MESSAGES['topgifpostersCenter'].format(str(i+1), user['name'], str(total))
 
+	# Forwarded once posted, the handler doesn't wait for it
+	def posted(future):
+		if future.exception() is None:
+			OUTBOX.send(bot, outbox.REPORT, 'forwardMessage', chat_id=room['id'], from_chat_id=room_to_send['id'], message_id=future.result().message_id)
+			OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text= config.MESSAGES['topgifpostersCenter'].format(room_to_send['name']))
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room_to_send['id'], text=msg).add_done_callback(posted)
 
-@restricted
-def topgif(bot,update):
 
-	room = get_room(update.message.chat.id)
-	room_to_send = get_room_for_property('is_top_gifs')
+#################################
+# Render assets : decoded once and kept, a render only pays for the layout
 
-	pipe = [ { "$group": { "_id": "$file_id", "total": { "$sum": 1 }  } }, { "$sort": { "total": -1 } }, { "$limit": 5 }   ]
-	gifs = list(db.natalia_gifs.aggregate(pipe))
+PATH_MASK = PATH+"/media/wp_background_mask2.png"
+PATH_BG   = PATH+"/media/wp_background.png"
 
-	bot.sendMessage(chat_id=room_to_send['id'], text=MESSAGES['topgifsStart'].format(str(gifs[0]['total'])))
-	bot.sendSticker(chat_id=room_to_send['id'], sticker=gifs[0]['_id'], disable_notification=False)
-	bot.sendMessage(chat_id=room['id'], text=MESSAGES['topgifsEnd'].format(room_to_send['name']))
+assets_lock = threading.RLock()
+assets      = {}
+# A WordCloud keeps the layout of its last render, one render at a time
+render_lock = threading.Lock()
 
+def asset(name, load):
+	with assets_lock:
+		if name not in assets:
+			assets[name] = load()
+		return assets[name]
 
-@restricted
-def topgifposters(bot, update):
+def users_mask():
+	return asset('users_mask', lambda: np.array(Image.open(PATH_MASK)))
 
-	room = get_room(update.message.chat.id)
-	room_to_send = get_room_for_property('is_top_gifs')
+# Background sized to the cloud drawn on the mask
+def users_background():
+	mask = users_mask()
+	return asset('users_background', lambda: Image.open(PATH_BG).convert("RGBA").resize((mask.shape[1], mask.shape[0])))
 
-	pipe = [ { "$group": { "_id": "$user_id", "total": { "$sum": 1 }  } }, { "$sort": { "total": -1 } }, { "$limit": 5 }   ]
-	users = list(db.natalia_gifs.aggregate(pipe))
+# Configured WordCloud, built again only when the stopwords were reloaded
+def wordcloud(name, **options):
+	config = CONFIG
+	with assets_lock:
+		cached = assets.get(name)
+		if cached is None or cached[0] is not config.WORDCLOUD_STOPWORDS:
+			cached = assets[name] = (config.WORDCLOUD_STOPWORDS, WordCloud(stopwords=config.WORDCLOUD_STOPWORDS, **options))
+		return cached[1]
 
-	msg = MESSAGES['topgifpostersStart'].format(room_to_send['name'])
-	for i,u in enumerate(users):
+WORDS_CLOUD_OPTIONS = { 'background_color': "white", 'max_words': 2000, 'relative_scaling': 0.2, 'scale': 3 }
 
-		user = list(db.users.find({ 'user_id': u['_id'] }))
-		if len(user) > 0:
-			user = user[0]
-			msg += MESSAGES['topgifpostersCenter'].format(str(i+1), user['name'], str(u['total']))
+def words_cloud():
+	return wordcloud('words_cloud', **WORDS_CLOUD_OPTIONS)
 
-	msg = bot.sendMessage(chat_id=room_to_send['id'], text=msg )
-	bot.forwardMessage(chat_id=room['id'], from_chat_id=room_to_send['id'], message_id=msg.message_id)
-	bot.sendMessage(chat_id=room['id'], text= MESSAGES['topgifpostersCenter'].format(room_to_send['name']))
+def users_cloud():
+	return wordcloud('users_cloud', background_color=None, max_words=2000, mask=users_mask(), colormap='BuPu', mode="RGBA", width=800, height=400)
 
 
 @restricted
 def todayinwords(bot, update):
 
-	room = get_room(update.message.chat.id)
+	config = CONFIG
+	room = get_room(update.message.chat.id, config)
 	room_to_send = get_room_for_property('is_wordcloud')
 
 	logger.info("Today in words..")
 	logger.info("Fetching from db...")
 
 	start = datetime.datetime.today().replace(hour=0,minute=0,second=0)
-	pipe  = { '_id': 0, 'message': 1 }
-	msgs  = list(db.natalia_textmessages.find({ 'timestamp': {'$gt': start } }, pipe ))
+	msgs  = list(logschema.find(analytics_db.natalia_textmessages, start, names=['text']))
+
+	# Nothing new since the last one, post it again
+	key = 'todayinwords:'+start.strftime('%Y-%m-%d')+':'+str(len(msgs))
+	if send_cached_photo(bot, room_to_send['id'], key, "Today in a picture"):
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text=config.MESSAGES['todayinWords'].format(room_to_send['name']))
+		return
 
 	words = []
 	for w in msgs:
-		results = re.findall(r"(.*(?=:)): (.*)", w['message'])[0]
-		words.append(results[1].strip())
-
-	extra_stopwords = EXTRA_STOPWORDS
-	for e in extra_stopwords:
-		STOPWORDS.add(e)
-
-	stopwords = set(STOPWORDS)
+		words.append(w['text'].strip())
 
 	logger.info("Building comments pic...")
 
 	# Happening today
-	wc = WordCloud(background_color="white", max_words=2000, stopwords=stopwords, relative_scaling=0.2,scale=3)
-	# generate word cloud
-	wc.generate(' '.join(words))
-	# store to file
-	PATH_WORDCLOUD = PATH+"talkingabout_wordcloud.png"
-	wc.to_file(PATH_WORDCLOUD)
+	PATH_WORDCLOUD = PATH+"/talkingabout_wordcloud.png"
+	with render_lock:
+		wc = words_cloud()
+		# generate word cloud
+		wc.generate(' '.join(words))
+		# store to file
+		wc.to_file(PATH_WORDCLOUD)
 
-	msg = bot.sendPhoto(chat_id=room_to_send['id'], photo=open(PATH_WORDCLOUD,'rb'), caption="Today in a picture" )
-	bot.sendMessage(chat_id=room['id'], text=MESSAGES['todayinWords'].format(room_to_send['name']))
+	send_photo(bot, room_to_send['id'], PATH_WORDCLOUD, "Today in a picture", key)
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text=config.MESSAGES['todayinWords'].format(room_to_send['name']))
 
 	os.remove(PATH_WORDCLOUD)
 
 
+# Words as the wordcloud tokenizer sees them
+WORD = re.compile(r"\w[\w']+")
+
+# Runs in the render processes, the frequencies are already without the stopwords
+def render_wordcloud(frequencies, path, options):
+	WordCloud(**options).generate_from_frequencies(frequencies).to_file(path)
+
+# Processes rendering the /roomwords wordclouds, started once and kept. Spawned like the
+# sharded workers : a fork would copy the outbox, logging, flush and job queue threads'
+# locks in whatever state they are
+render_pool      = { 'pool': None }
+render_pool_lock = threading.Lock()
+
+def start_render_pool():
+	with render_pool_lock:
+		if render_pool['pool'] is None:
+			render_pool['pool'] = multiprocessing.get_context('spawn').Pool(multiprocessing.cpu_count())
+		return render_pool['pool']
+
+@restricted
+def roomwords(bot, update):
+	""" One wordcloud per logged room, from a single pass over today's messages """
+	config = CONFIG
+	chat_id = update.message.chat_id
+	start   = datetime.datetime.today().replace(hour=0,minute=0,second=0)
+	rooms   = dict((config.ROOMS[name]['id'], config.ROOMS[name]) for name in config.LOG_ROOMS)
+	counts  = dict((room_id, Counter()) for room_id in rooms)
+
+	for w in logschema.find(analytics_db.natalia_textmessages, start, names=['chat_id', 'text']):
+		words = counts.get(w['chat_id'])
+		if words is None:
+			continue
+		for word in WORD.findall(w['text'].lower()):
+			if word not in config.WORDCLOUD_STOPWORDS and not word.isdigit():
+				words[word] += 1
+
+	renders = []
+	posts   = []
+	for room_id, words in counts.items():
+		room = rooms[room_id]
+		if len(words) == 0:
+			continue
+		send_to = room['id'] if room.get('room_wordcloud', 0) == 1 else room['admin_room_id']
+		caption = "Today in a picture - "+room['name']
+		key     = 'roomwords:'+str(room_id)+':'+start.strftime('%Y-%m-%d')+':'+str(sum(words.values()))
+		if send_cached_photo(bot, send_to, key, caption):
+			continue
+		path = PATH+"/roomwords_"+str(room_id)+".png"
+		renders.append((dict(words.most_common(WORDS_CLOUD_OPTIONS['max_words'])), path, WORDS_CLOUD_OPTIONS))
+		posts.append((send_to, path, caption, key))
+
+	# Rendering is cpu bound, the rooms are drawn in parallel by the render processes
+	if len(renders) > 0:
+		start_render_pool().starmap(render_wordcloud, renders)
+
+	for send_to, path, caption, key in posts:
+		send_photo(bot, send_to, path, caption, key)
+		os.remove(path)
+
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text="Room wordclouds posted : "+", ".join(rooms[room_id]['name'] for room_id in counts if len(counts[room_id]) > 0))
+
+
 @restricted
 def todaysusers(bot, update):
-	room = get_room(update.message.chat.id)
+	config = CONFIG
+	room = get_room(update.message.chat.id, config)
 	room_to_send = get_room_for_property('is_todaysusers')
 
-	bot.sendMessage(chat_id=chat_id, text="Okay gimme a second for this one.. it takes some resources.." )
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text="Okay gimme a second for this one.. it takes some resources..")
 	logger.info("Today users..")
 	logger.info("Fetching from db...")
 
 	start = datetime.datetime.today().replace(hour=0,minute=0,second=0)
-	pipe  = { '_id': 0, 'message': 1 }
-	msgs  = list(db.natalia_textmessages.find({ 'timestamp': {'$gt': start } }, pipe ))
+	msgs  = list(logschema.find(analytics_db.natalia_textmessages, start, names=['username']))
+
+	# Nothing new since the last one, post it again
+	key = 'todaysusers:'+start.strftime('%Y-%m-%d')+':'+str(len(msgs))
+	if send_cached_photo(bot, room_to_send['id'], key, "Todays Users"):
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text=config.MESSAGES['todaysusers'].format(room_to_send['name']))
+		return
 
 	usernames = []
 	for w in msgs:
-		results = re.findall(r"(.*(?=:)): (.*)", w['message'])[0]
-		usernames.append(results[0].strip())
-
-	extra_stopwords = EXTRA_STOPWORDS
-	for e in extra_stopwords:
-		STOPWORDS.add(e)
-
-	stopwords = set(STOPWORDS)
+		usernames.append(w['username'].strip())
 
 	logger.info("Building usernames pic...")
-	PATH_MASK      = PATH+"media/wp_background_mask2.png"
-	PATH_BG        = PATH+"media/wp_background.png"
-	PATH_USERNAMES = PATH+"telegram-usernames.png"
-
-	# Usernames
-	d = os.path.dirname('__file__')
+	PATH_USERNAMES = PATH+"/telegram-usernames.png"
 
-	mask = np.array(Image.open(PATH_MASK))
+	# Usernames, drawn over the background in memory
+	with render_lock:
+		wc = users_cloud()
+		wc.generate(' '.join(usernames))
+		layer2 = wc.to_image()
 
-	wc = WordCloud(background_color=None, max_words=2000,mask=mask,colormap='BuPu',
-				   stopwords=stopwords,mode="RGBA", width=800, height=400)
-	wc.generate(' '.join(usernames))
-	wc.to_file(PATH_USERNAMES)
+	Image.alpha_composite(users_background(), layer2).save(PATH_USERNAMES)
 
-	layer1 = Image.open(PATH_BG).convert("RGBA")
-	layer2 = Image.open(PATH_USERNAMES).convert("RGBA")
-
-	Image.alpha_composite(layer1, layer2).save(PATH_USERNAMES)
-
-	msg = bot.sendPhoto(chat_id=room_to_send['id'], photo=open("telegram-usernames.png",'rb'), caption="Todays Users" )
-	bot.sendMessage(chat_id=chat_id, text="Posted today in pictures to "+room_to_send['name'] )
+	send_photo(bot, room_to_send['id'], PATH_USERNAMES, "Todays Users", key)
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text=config.MESSAGES['todaysusers'].format(room_to_send['name']))
 
 	os.remove(PATH_USERNAMES)
 
@@ -590,7 +1006,7 @@ def todaysusers(bot, update):
 @restricted 
 def promotets(bot, update):
 
-	pprint('promotets...')
+	logger.info("promotets...")
 
 	room = get_room(update.message.chat.id)
 	name = get_name(update.message.from_user)
@@ -601,83 +1017,57 @@ def promotets(bot, update):
 		for room_promotets in get_rooms_for_property('is_promotets'):
 
 			message = fmsg[0]
-			bot.sendSticker(chat_id=r, sticker="CAADBAADcwIAAndCvAgUN488HGNlggI", disable_notification=False)
-			msg = bot.sendMessage(chat_id=room_promotets['id'], parse_mode="Markdown", text=fmsg[0]+"\n-------------------\n*/announcement from "+name+"*" )
+			OUTBOX.send(bot, outbox.REPORT, 'sendSticker', chat_id=room_promotets['id'], sticker="CAADBAADcwIAAndCvAgUN488HGNlggI", disable_notification=False)
+			msg = OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room_promotets['id'], parse_mode="Markdown", text=fmsg[0]+"\n-------------------\n*/announcement from "+name+"*" )
 
-			if room in get_rooms_for_property('is_promotets_pin'): 
-				bot.pin_chat_message(room_promotets['id'], msg.message_id, disable_notification=True)
+			if room_promotets in get_rooms_for_property('is_promotets_pin'): 
+				# Pinned once posted, the handler doesn't wait for it
+				def pin(future, chat_id=room_promotets['id']):
+					if future.exception() is None:
+						OUTBOX.send(bot, outbox.REPORT, 'pin_chat_message', chat_id=chat_id, message_id=future.result().message_id, disable_notification=True)
+				msg.add_done_callback(pin)
 
-			bot.sendMessage(chat_id=r, parse_mode="Markdown", text="Message me ("+BOTNAME.replace('_','\_')+") - to see details on how to connect to [teamspeak](https://whalepool.io/connect/teamspeak) also listen in to the listream here: livestream.whalepool.io", disable_web_page_preview=True )
-			bot.sendMessage(chat_id=chat_id, parse_mode="Markdown", text="Broadcast sent to "+room_promotets['name'])
+			OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room_promotets['id'], parse_mode="Markdown", text="Message me ("+CONFIG.BOTNAME.replace('_','\_')+") - to see details on how to connect to [teamspeak](https://whalepool.io/connect/teamspeak) also listen in to the listream here: livestream.whalepool.io", disable_web_page_preview=True )
+			OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=update.message.chat_id, parse_mode="Markdown", text="Broadcast sent to "+room_promotets['name'])
 
 	else:
-		bot.sendMessage(chat_id=room['id'], text="Please incldue a message in quotes to spam/shill the teamspeak message" )
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=room['id'], text="Please incldue a message in quotes to spam/shill the teamspeak message")
 
 	 
 @restricted
 def shill(bot, update):
 
+	config = CONFIG
 	chat_id = update.message.chat_id
 	name = get_name(update.message.from_user)
 
-	bot.sendMessage(chat_id=WP_ADMIN, parse_mode="Markdown", text=name+" just shilled")
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=WP_ADMIN, parse_mode="Markdown", text=name+" just shilled")
 
 	rooms = [WP_ROOM, SP_ROOM, WP_FEED, SP_FEED]
 
 	for r in rooms:
-		bot.sendMessage(chat_id=r, parse_mode="Markdown", text=MESSAGES['shill'],disable_web_page_preview=1)
-		bot.sendMessage(chat_id=chat_id, parse_mode="Markdown", text="Shilled in "+ROOM_ID_TO_NAME[r])
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=r, parse_mode="Markdown", text=config.MESSAGES['shill'],disable_web_page_preview=1)
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, parse_mode="Markdown", text="Shilled in "+config.ROOM_ID_TO_NAME[r])
 	
 
 @restricted
 def commandstats(bot, update):
 	chat_id = update.message.chat_id
-	start = datetime.datetime.today().replace(day=1,hour=0,minute=0,second=0)
-	# start = start - relativedelta(days=30)
-
-	pipe = [ 
-		{ "$match": { 'timestamp': {'$gt': start } } }, 
-		{ "$group": { 
-			"_id": { 
-				"year" : { "$year" : "$timestamp" },        
-				"month" : { "$month" : "$timestamp" },        
-				"day" : { "$dayOfMonth" : "$timestamp" },
-				"request": "$request"
-			},
-			"total": { "$sum": 1 }  
-			} 
-		}, 
-		{ "$sort": { "total": -1  } }, 
-		# { "$limit": 3 }   
-	]
-	res = list(db.pm_requests.aggregate(pipe))
+	start = archive.utc_today().replace(day=1)
 
 	output = {}
-	totals = {}
-
-	for r in res: 
-
-		key = r['_id']['day']
-		if not(key in output):
-			output[key] = {}
-
-		request = r['_id']['request']
-		if not(request in output[key]):
-			output[key][r['_id']['request']] = 0 
-
-		if not(request in totals):
-			totals[request] = 0
-
-		output[key][r['_id']['request']] += r['total']
-		totals[request] += r['total']
-
+	totals = Counter()
+	for day, counts in daily_counts('commands', start):
+		if len(counts) > 0:
+			output[day.day] = counts
+			totals.update(counts)
 
 	reply = "*Natalia requests since the start of the month...*\n"
 	for day in sorted(output.keys()):
 		reply += "--------------------\n"
 		reply += "*"+str(day)+"*\n"
 
-		for request, count in output[day].items():
+		for request, count in sorted(output[day].items(), key=lambda r: -r[1]):
 			reply += request+" - "+str(count)+"\n"
 
 			
@@ -687,67 +1077,102 @@ def commandstats(bot, update):
 		reply += request+" - "+str(totals[request])+"\n"
 
 
-	bot.sendMessage(chat_id=chat_id, text=reply, parse_mode="Markdown" )
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text=reply, parse_mode="Markdown")
 
 
 @restricted 
 def joinstats(bot,update):
 
+	config = CONFIG
 	chat_id = update.message.chat_id
-	start = datetime.datetime.today().replace(day=1,hour=0,minute=0,second=0)
-	# start = start - relativedelta(days=30)
-
-	pipe = [ 
-		{ "$match": { 'timestamp': {'$gt': start } } }, 
-		{ "$group": { 
-			"_id": {     
-				"day" : { "$dayOfMonth" : "$timestamp" },
-				"chat_id": "$chat_id"
-			},
-			"total": { "$sum": 1 }  
-			} 
-		}, 
-		{ "$sort": { "total": -1  } }, 
-		# { "$limit": 3 }   
-	]
-	res = list(db.room_joins.aggregate(pipe))
+	start = archive.utc_today().replace(day=1)
 
 	output = {}
-	totals = {}
-
-	for r in res: 
-
-		key = r['_id']['day']
-		if not(key in output):
-			output[key] = {}
-
-		roomid = r['_id']['chat_id']
-		if not(roomid in output[key]):
-			output[key][roomid] = 0 
-
-		if not(roomid in totals):
-			totals[roomid] = 0
-
-		output[key][roomid] += r['total']
-		totals[roomid] += r['total']
-
-
+	totals = Counter()
+	for day, counts in daily_counts('joins', start):
+		if len(counts) > 0:
+			output[day.day] = counts
+			totals.update(counts)
 
 	reply = "*Channel Joins since the start of the month...*\n"
 	for day in sorted(output.keys()):
 		reply += "--------------------\n"
 		reply += "*"+str(day)+"*\n"
 
-		for room, count in output[day].items():
-			reply += ROOM_ID_TO_NAME[room]+" - "+str(count)+"\n"
+		for room, count in sorted(output[day].items(), key=lambda r: -r[1]):
+			reply += config.ROOM_ID_TO_NAME.get(room, str(room))+" - "+str(count)+"\n"
 
 
 	reply += "--------------------\n"
 	reply += "*Totals*\n"
 	for roomid in totals:
-		reply += ROOM_ID_TO_NAME[roomid]+" - "+str(totals[roomid])+"\n"
+		reply += config.ROOM_ID_TO_NAME.get(roomid, str(roomid))+" - "+str(totals[roomid])+"\n"
+
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text=reply, parse_mode="Markdown")
+
+
+# What /export can export : (collection, columns)
+EXPORTS = {
+	'messages': ('natalia_textmessages', ['timestamp', 'chat_id', 'user_id', 'message_id', 'username', 'text']),
+	'stickers': ('natalia_stickers', ['timestamp', 'chat_id', 'user_id', 'message_id', 'sticker_id']),
+	'gifs'    : ('natalia_gifs', ['timestamp', 'chat_id', 'user_id', 'message_id', 'file_id']),
+	'joins'   : ('room_joins', ['timestamp', 'chat_id', 'user_id']),
+	'commands': ('pm_requests', ['timestamp', 'user_id', 'request', 'count']),
+}
+EXPORT_USAGE = "/export <"+"|".join(sorted(EXPORTS))+"> [room name|all] [from YYYY-MM-DD] [to YYYY-MM-DD] [csv|json]"
+
+@restricted
+def export(bot, update):
+	""" Sends the rows of a collection as a gzipped CSV / NDJSON document, streamed from the cursor """
+	config = CONFIG
+	chat_id = update.message.chat_id
+	what    = None
+	room    = None
+	format  = 'csv'
+	dates   = []
+	for arg in update.message.text.split()[1:]:
+		if arg.lower() in EXPORTS:
+			what = arg.lower()
+		elif arg.lower() in exports.FORMATS:
+			format = arg.lower()
+		elif arg in config.ROOMS:
+			room = config.ROOMS[arg]
+		elif arg.lower() != 'all':
+			try:
+				dates.append(datetime.datetime.strptime(arg, '%Y-%m-%d'))
+			except ValueError:
+				OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text="Unknown "+arg+"\n"+EXPORT_USAGE)
+				return
+	if what is None or len(dates) > 2:
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text=EXPORT_USAGE)
+		return
+
+	# Since the start of the month by default, the last day is included
+	start = dates[0] if len(dates) > 0 else archive.utc_today().replace(day=1)
+	end   = (dates[1] if len(dates) > 1 else archive.utc_today()) + archive.ONE_DAY
+	collection, columns = EXPORTS[what]
+
+	if collection in logschema.COLLECTIONS:
+		docs = logschema.find(analytics_db[collection], start, end, room['id'] if room else None, names=columns)
+	else:
+		if room:
+			OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text=what+" are not per room")
+			return
+		docs = analytics_db[collection].find({ 'timestamp': { '$gte': start, '$lt': end } }, dict((c, 1) for c in columns)).batch_size(10000)
+
+	try:
+		fp, count = exports.write(exports.lines(docs, columns, format))
+	except ValueError as e:
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text="Export too big : "+str(e))
+		return
 
-	bot.sendMessage(chat_id=chat_id, text=reply, parse_mode="Markdown" )
+	if format == 'csv':
+		# The header line
+		count -= 1
+	name = '_'.join(['natalia', what, room['name'] if room else 'all', start.strftime('%Y-%m-%d'), (end - archive.ONE_DAY).strftime('%Y-%m-%d')])
+	name += '.csv.gz' if format == 'csv' else '.ndjson.gz'
+	# Uploaded by the outbox, the file is closed once telegram answered (or the outbox gave up)
+	OUTBOX.send(bot, outbox.REPORT, 'sendDocument', chat_id=chat_id, document=fp, filename=name, caption=str(count)+" rows").add_done_callback(lambda future: fp.close())
 
 
 def fooCandlestick(ax, quotes, width=0.029, colorup='#FFA500', colordown='#222', alpha=1.0):
@@ -782,16 +1207,55 @@ def fooCandlestick(ax, quotes, width=0.029, colorup='#FFA500', colordown='#222',
 
 	return lines, boxes
 
+# Rows of {'_id': period, 'count': n} for a room since `since`, periods formatted with date_group_format
+# Days past the raw retention come from their rolled up counts, closed days from the parquet
+# archive (when enabled), mongo is only queried for the rest
+def activity_rows(collection, chat_id, since, date_group_format):
+	config = CONFIG
+	mongo_since = since
+	rows = []
+
+	rolled = retention.rolled_until(db, collection)
+	if rolled is not None and rolled > since:
+		rows += retention.activity(db, collection, chat_id, since, rolled, date_group_format)
+		mongo_since = rolled
+
+	if config.ARCHIVE_PATH:
+		archive_since = mongo_since
+		mongo_since = archive.archived_until(config.ARCHIVE_PATH, collection, archive_since, archive.utc_today())
+		history = archive.read(config.ARCHIVE_PATH, collection, archive_since, mongo_since, ['timestamp'], chat_id=chat_id)
+		history = history[history['timestamp'] >= archive_since]
+		for period, count in history['timestamp'].dt.strftime(date_group_format).value_counts().items():
+			rows.append({ '_id': period, 'count': int(count) })
+
+	pipe =  [
+	  { "$match": logschema.match(mongo_since, chat=chat_id) },
+	  { "$group": {
+			"_id":    { "$dateToString": { "format": date_group_format, "date": logschema.field('timestamp') } },
+			"count":  { "$sum": 1 }
+		}   
+	  },
+	]
+	return rows + list(analytics_db[collection].aggregate(pipe))
+
+
+# Bitfinex BTCUSD candles, [[mts, open, close, high, low, volume], ...]
+def fetch_candles(api_timeframe, limit=200):
+	url = 'https://api.bitfinex.com/v2/candles/trade:'+api_timeframe+':tBTCUSD/hist?limit='+str(limit)
+	return json.loads(requests.get(url).text)
+
+
 # Special function for testing purposes 
 @restricted
 def whalepooloverprice(bot, update):
 	user_id = update.message.from_user.id 
 	chat_id = update.message.chat_id
+	room_to_send = get_room_for_property('is_overprice')
+	if room_to_send == False:
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text="No room is configured with is_overprice: 1")
+		return
 
-	bot.sendMessage(chat_id=61697695, text="Processing data" )
-
-	# Room only
-	mongo_match = { "$match": { 'chat_id': WP_ROOM } }
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text="Processing data")
 
 	do = 'hourly'
 
@@ -806,8 +1270,7 @@ def whalepooloverprice(bot, update):
 		date_group_format = "%Y-%m-%dT%H"
 
 	# Get the candles
-	url = 'https://api.bitfinex.com/v2/candles/trade:'+api_timeframe+':tBTCUSD/hist?limit=200'
-	request = json.loads(requests.get(url).text)
+	request = fetch_candles(api_timeframe)
 
 	candles = pd.read_json(json.dumps(request))
 	candles.rename(columns={0:'date', 1:'open', 2:'close', 3:'high', 4:'low', 5:'volume'}, inplace=True)
@@ -822,15 +1285,7 @@ def whalepooloverprice(bot, update):
 	candles['date'] = candles['date'].map(mdates.date2num)
 
 	# Users joins
-	pipe =  [
-	  mongo_match,
-	  { "$group": {
-			"_id":    { "$dateToString": { "format": date_group_format, "date": "$timestamp" } },
-			"count":  { "$sum": 1 }
-		}   
-	  },
-	]
-	rows = list(db.room_joins.aggregate(pipe))
+	rows = activity_rows('room_joins', room_to_send['id'], first_candlestick_date, date_group_format)
 
 	userjoins = pd.DataFrame(rows)
 	userjoins['date'] = pd.to_datetime( userjoins['_id'], format=date_group_format)
@@ -843,15 +1298,7 @@ def whalepooloverprice(bot, update):
 	userjoins = userjoins.loc[first_candlestick_date:]
 
 	# Get the messages
-	pipe =  [
-	  mongo_match,
-	  { "$group": {
-			"_id":    { "$dateToString": { "format": date_group_format, "date": "$timestamp" } },
-			"count":  { "$sum": 1 }
-		}   
-	  },
-	]
-	rows = list(db.natalia_textmessages.aggregate(pipe))
+	rows = activity_rows('natalia_textmessages', room_to_send['id'], first_candlestick_date, date_group_format)
 
 	msgs = pd.DataFrame(rows)
 	msgs['date'] = pd.to_datetime( msgs['_id'], format=date_group_format)
@@ -864,15 +1311,7 @@ def whalepooloverprice(bot, update):
 	msgs = msgs.loc[first_candlestick_date:]
 
 	# Stickers
-	pipe =  [
-	  mongo_match,
-	  { "$group": {
-			"_id":    { "$dateToString": { "format": date_group_format, "date": "$timestamp" } },
-			"count":  { "$sum": 1 }
-		}   
-	  },
-	]
-	rows = list(db.natalia_stickers.aggregate(pipe))
+	rows = activity_rows('natalia_stickers', room_to_send['id'], first_candlestick_date, date_group_format)
 
 	gifs = pd.DataFrame(rows)
 	gifs['date'] = pd.to_datetime( gifs['_id'], format='%Y-%m-%dT%H')
@@ -957,13 +1396,14 @@ def whalepooloverprice(bot, update):
 
 	#im = Image.open(LOGO_PATH) 
 	#fig.figimage(   im,   105,  (fig.bbox.ymax - im.size[1])-29)
-	PATH_MSGS_OVER_PRICE = PATH+"messages_over_price.png"
+	PATH_MSGS_OVER_PRICE = PATH+"/messages_over_price.png"
 
 	plt.savefig(PATH_MSGS_OVER_PRICE, bbox_inches='tight')
 
 
-	msg = bot.sendPhoto(chat_id=WP_ROOM, photo=open(PATH_MSGS_OVER_PRICE,'rb'), caption="Whalepool Messages, Gif & User joins per hour over price" )
-	bot.sendMessage(chat_id=chat_id, text="'Whalepool Messages, Gif & User joins per hour over price' posted to "+ROOM_ID_TO_NAME[WP_ROOM] )
+	send_photo(bot, room_to_send['id'], PATH_MSGS_OVER_PRICE, "Whalepool Messages, Gif & User joins per hour over price")
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text="'Whalepool Messages, Gif & User joins per hour over price' posted to "+room_to_send['name'])
+	plt.close(fig)
 
 	os.remove(PATH_MSGS_OVER_PRICE)
 
@@ -978,6 +1418,60 @@ def whalepooloverprice(bot, update):
 	#       pprint(photo.__dict__)
 
 
+@restricted
+def perfstats(bot, update):
+	chat_id = update.message.chat_id
+
+	reply = "*Handlers* (count / errors / p50 / p99 / total)\n"
+	for labels, count, errors, mean, p50, p99, total in metrics.REGISTRY.summary('natalia_handler_seconds', 'natalia_handler_errors_total'):
+		reply += "`"+labels[0][1]+"` "+str(count)+" / "+str(errors)+" / "+"{:.0f}ms / {:.0f}ms / {:.1f}s".format(p50*1000, p99*1000, total)+"\n"
+
+	reply += "--------------------\n"
+	reply += "*Message stages* (count / errors / p50 / p99 / total)\n"
+	for labels, count, errors, mean, p50, p99, total in metrics.REGISTRY.summary('natalia_stage_seconds', 'natalia_stage_errors_total'):
+		reply += "`"+labels[0][1]+"` "+str(count)+" / "+str(errors)+" / "+"{:.0f}ms / {:.0f}ms / {:.1f}s".format(p50*1000, p99*1000, total)+"\n"
+
+	reply += "--------------------\n"
+	reply += "*Telegram & Mongo* (count / errors / p50 / p99 / total)\n"
+	for labels, count, errors, mean, p50, p99, total in metrics.REGISTRY.summary('natalia_backend_seconds', 'natalia_backend_errors_total')[:15]:
+		reply += "`"+labels[0][1]+" "+labels[1][1]+"` "+str(count)+" / "+str(errors)+" / "+"{:.0f}ms / {:.0f}ms / {:.1f}s".format(p50*1000, p99*1000, total)+"\n"
+
+	OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text=reply, parse_mode="Markdown")
+
+
+# Reloads config.yaml, returns the error or None
+def reload_config():
+	try:
+		settings = load_config(config_file)
+		settings['PAGES'] = build_pages(settings['MESSAGES'], settings['ADMINS_JSON'])
+	except Exception as e:
+		logger.error("Config not reloaded : %s", str(e))
+		return str(e)
+	apply_config(settings)
+	logger.info("Config reloaded")
+	return None
+
+# Set by sharding.py in its worker processes
+SHARDED_WORKER = False
+SHARD_NAME     = None
+
+@restricted
+def reload(bot, update):
+	chat_id = update.message.chat_id
+
+	if SHARDED_WORKER:
+		# The ingress reloads itself and every worker
+		os.kill(os.getppid(), signal.SIGHUP)
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text="Reloading the config in every worker")
+		return
+
+	error = reload_config()
+	if error is None:
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text="Config reloaded, "+str(len(CONFIG.ROOMS))+" rooms")
+	else:
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=chat_id, text="Config not reloaded : "+error)
+
+
 # Special function for testing purposes 
 @restricted
 def special(bot, update):
@@ -998,69 +1492,125 @@ def special(bot, update):
 		# Black
 		text += '🖤'
 
-		bot.sendMessage(chat_id=61697695, text=text )
+		OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=61697695, text=text)
 
 
 #################################
 #       BOT EVENT HANDLING      
 
+# Whether users have a profile photo, shared by the rooms and kept in mongo (users collection)
+PROFILE_PHOTO_TTL = datetime.timedelta(hours=12)
+PROFILE_PHOTO_MAX = 50000
+profile_photos      = OrderedDict()   # user_id : (has photo, checked at)
+profile_photos_lock = threading.Lock()
+
+def remember_profile_photo(user_id, has_photo, checked):
+	with profile_photos_lock:
+		profile_photos[user_id] = (has_photo, checked)
+		profile_photos.move_to_end(user_id)
+		while len(profile_photos) > PROFILE_PHOTO_MAX:
+			profile_photos.popitem(last=False)
+
+# Cached answer, None when unknown or older than PROFILE_PHOTO_TTL
+def has_profile_photo(user_id):
+	now = datetime.datetime.utcnow()
+	with profile_photos_lock:
+		cached = profile_photos.get(user_id)
+	if cached is None:
+		user = db.users.find_one({ 'user_id': user_id }, { '_id': 0, 'has_profile_photo': 1, 'profile_photo_checked': 1 })
+		if user is None or 'profile_photo_checked' not in user:
+			return None
+		cached = (user['has_profile_photo'], user['profile_photo_checked'])
+		remember_profile_photo(user_id, cached[0], cached[1])
+	if cached[1] < now - PROFILE_PHOTO_TTL:
+		return None
+	return cached[0]
+
+def set_profile_photo(user_id, has_photo):
+	now = datetime.datetime.utcnow()
+	remember_profile_photo(user_id, has_photo, now)
+	USER_UPDATES.set(user_id, { 'has_profile_photo': has_photo, 'profile_photo_checked': now })
+
+# Sets a room's runtime state id, returns the one it replaces
+room_state_lock = threading.Lock()
+
+def swap_room_state(state, key, value):
+	with room_state_lock:
+		previous   = state[key]
+		state[key] = value
+	return previous
+
+def welcome(bot, room, message_id, name, has_photo):
+	# Send a welcome message (specific message for WPWOMENS, and no pic)
+	config = CONFIG
+	logger.info("welcoming - %s", name)
+	if (room['special_welcome_message'] != ''):
+		msg = (config.MESSAGES[room['special_welcome_message']] % (name))
+	else:
+		msg = random.choice(config.MESSAGES['welcome']) % (name)
+
+	if not has_photo:
+		msg += " - **Also, please set a profile pic!!**"
+	welcome = OUTBOX.send(bot, outbox.WELCOME, 'sendMessage', chat_id=room['id'],reply_to_message_id=message_id,text=msg)     
+
+	# Once out, it replaces the prior welcome. The welcomes of a join raid are sent in any
+	# order, each one deletes the one recorded before it so only the last stays
+	state = config.state(room)
+	def sent(future):
+		if future.exception() is None:
+			prior = swap_room_state(state, 'prior_welcome_message_id', int(future.result().message_id))
+			if prior > 0:
+				OUTBOX.send(bot, outbox.WELCOME, 'delete_message', chat_id=room['id'], message_id=prior)
+	welcome.add_done_callback(sent)
+
 def new_chat_member(bot, update):
 	""" Welcomes new chat member """
 
+	config = CONFIG
 	user_id = update.message.from_user.id 
 	message_id = update.message.message_id 
-	room = get_room(update.message.chat.id)
-	name = get_name(update.message._new_chat_members)
+	room = get_room(update.message.chat.id, config)
+	member = update.message.new_chat_members[0]
+	name = get_name(member)
+
+	# Bot was added to a group chat
+	if member.username == config.BOTNAME:
+		return False
+
+	# Restrict the user according to the room's settings (more than 366 days == forever(from the official doc!))
+	OUTBOX.send(bot, outbox.MODERATION, 'restrict_chat_member', chat_id=room['id'], user_id=user_id, until_date=(datetime.datetime.now() + relativedelta(days=room['days_restriction_on_join'])), can_send_messages=False, can_send_media_messages=False, can_send_other_messages=False, can_add_web_page_previews=False)
 
 	if (room['is_welcome'] == 1):
-		# Check user has a profile pic.. 
 
 		timestamp = datetime.datetime.utcnow()
 
-		info = { 'user_id': user_id, 'chat_id': room['id'], 'timestamp': timestamp }
-		db.room_joins.insert(info)
-
-		profile_pics = bot.getUserProfilePhotos(user_id=user_id)
-		if profile_pics.total_count == 0:
-			pprint("USER NEEDS A PROFILE PIC")
+		info = logschema.document(user_id=user_id, chat_id=room['id'], timestamp=timestamp)
+		log_db.room_joins.insert(info)
 
-		restricted = 0
+		# Delete the previous join message if there is one, the previous welcome goes once this one is out (see welcome())
+		prior_join = swap_room_state(config.state(room), 'prior_join_message_id', int(message_id))
+		logger.debug("Join in %s (%s), last join msg to del. : %s", room['name'], room['id'], prior_join)
+		if prior_join > 0: 
+			OUTBOX.send(bot, outbox.WELCOME, 'delete_message', chat_id=room['id'], message_id=prior_join)
 
-		# Bot was added to a group chat
-		if update.message._new_chat_members.username == BOTNAME:
-			return False
-		# Another user joined the chat
-		else:
-			pprint('Room: '+str(room['name']))
-			pprint('Chat_id: '+str(room['id']))
-			pprint('Last welcome Msg to del. : '+str(room['prior_welcome_message_id']))
-			pprint('Last Join Msg to del. : '+str(room['prior_welcome_message_id']))
+		# Check user has a profile pic..
+		has_photo = has_profile_photo(user_id)
+		if has_photo is not None:
+			welcome(bot, room, message_id, name, has_photo)
+			return
 
-			try:
-				# Delete the previous welcome and join message if there is one
-				if room['prior_welcome_message_id'] > 0: 
-					bot.delete_message(chat_id=room['id'], message_id=room['prior_welcome_message_id'])
-					bot.delete_message(chat_id=room['id'], message_id=room['prior_join_message_id'])
-			except:
-				pass
-
-			# Send a welcome message (specific message for WPWOMENS, and no pic)
-			logger.info("welcoming - "+name)
-			if (room['special_welcome_message'] != ''):
-				msg = (MESSAGES[room['special_welcome_message']] % (name))
+		# Not known, the outbox asks telegram (one photo is enough to know) and the welcome goes once answered
+		def checked(future):
+			if future.exception() is None:
+				has_photo = future.result().total_count > 0
+				set_profile_photo(user_id, has_photo)
+				if not has_photo:
+					logger.debug("User %s has no profile pic", user_id)
 			else:
-				msg = random.choice(MESSAGES['welcome']) % (name)
-
-			if profile_pics.total_count == 0:
-				msg += " - **Also, please set a profile pic!!**"
-			message = bot.sendMessage(chat_id=room['id'],reply_to_message_id=message_id,text=msg)     
-
-			# Save as the prior welcome join messages
-			room['prior_welcome_message_id'] = int(message.message_id)
-			room['prior_join_message_id'] = int(message_id)
-
-	# Restrict the user according to the room's settings (more than 366 days == forever(from the official doc!))
-	bot.restrict_chat_member(chat_id=room['id'], user_id=user_id, until_date=(datetime.datetime.now() + relativedelta(days=room['days_restriction_on_join'])), can_send_messages=False, can_send_media_messages=False, can_send_other_messages=False, can_add_web_page_previews=False)
+				# Don't nag about the photo when telegram didn't answer
+				has_photo = True
+			welcome(bot, room, message_id, name, has_photo)
+		OUTBOX.send(bot, outbox.WELCOME, 'getUserProfilePhotos', user_id=user_id, limit=1).add_done_callback(checked)
 
 
 def left_chat_member(bot, update):
@@ -1089,256 +1639,654 @@ def log_message_private(bot, update):
 
 	# msg = bot.forwardMessage(chat_id=FORWARD_PRIVATE_MESSAGES_TO, from_chat_id=chat_id, message_id=message_id)
 
-	msg = bot.sendMessage(chat_id=room['id'], text=(MESSAGES['start'] % name),parse_mode="Markdown",disable_web_page_preview=1)
+	send_page(bot, update.message.chat_id, CONFIG.PAGES['start'], name)
 
 
-# Just log/handle a normal message
-def echo(bot, update):
-	username = update.message.from_user.username 
-	user_id = update.message.from_user.id 
-	message_id = update.message.message_id 
-	room = get_room(update.message.chat.id)
+#################################
+# Message pipeline : a message is classified once (MessageInfo), then goes through the
+# PIPELINE stages in order, each reading the same features. A stage returning True stops
+# the ones after it (spam deleted, poster banned)
+
+# Kinds of messages, the first one set on the message wins (gifs are mp4 documents)
+KINDS = ['text', 'photo', 'sticker', 'video', 'document']
+
+class MessageInfo(object):
+	""" What the stages need to know about a message, computed once """
+
+	def __init__(self, update):
+		message         = update.message
+		self.update     = update
+		self.message    = message
+		self.message_id = message.message_id
+		self.private    = message.chat.type == 'private'
+		# The config of the whole pipeline, a reload meanwhile doesn't mix two of them
+		self.config     = CONFIG
+		self.room       = False if self.private else get_room(message.chat.id, self.config)
+		self.user_id    = message.from_user.id
+		self.username   = message.from_user.username
+		self.name       = get_name(message.from_user)
+		self.timestamp  = datetime.datetime.utcnow()
+
+		self.kind = next((kind for kind in KINDS if getattr(message, kind)), None)
+		if self.kind == 'document' and message.document.mime_type == 'video/mp4':
+			self.kind = 'gif'
+		self.text    = message.text or message.caption or ''
+		self.command = self.kind == 'text' and self.text.startswith('/')
+
+		# Urls and hashtags of the text (or the caption)
+		self.urls     = []
+		self.hashtags = []
+		entities = message.parse_entities() if message.text else message.parse_caption_entities()
+		for entity, value in entities.items():
+			if entity.type == MessageEntity.URL:
+				self.urls.append(value)
+			elif entity.type == MessageEntity.TEXT_LINK:
+				self.urls.append(entity.url)
+			elif entity.type == MessageEntity.HASHTAG:
+				self.hashtags.append(value.lower())
+
+
+# Texts, stickers and gifs (of the logged rooms) and their poster's last seen
+def log_message(bot, info):
+	room = info.room
+	if info.kind == 'text':
+		if info.username == None:
+			logger.debug("Person chatted without a username")
+			return False
+		live_feed(str(room['id'])+" - "+info.username+': '+info.text)
+		document = logschema.document(user_id=info.user_id, chat_id=room['id'], message_id=info.message_id, username=info.username, text=info.text, timestamp=info.timestamp)
+		log_db.natalia_textmessages.insert(document)
+
+	elif info.kind == 'sticker':
+		sticker_id = info.message.sticker.file_id
+		live_feed(str(room['id'])+" - sticker "+sticker_id)
+		if info.username == None:
+			return False
+		document = logschema.document(user_id=info.user_id, chat_id=room['id'], message_id=info.message_id, sticker_id=sticker_id, timestamp=info.timestamp)
+		log_db.natalia_stickers.insert(document)
 
-	if username != None:
-		message = username+': '+update.message.text
-		pprint(str(room['id'])+" - "+str(message))
-	
-		name = get_name(update.message.from_user)
-		timestamp = datetime.datetime.utcnow()
+	elif info.kind == 'gif' and room['is_log'] == 1:
+		if info.username == None:
+			return False
+		document = logschema.document(user_id=info.user_id, chat_id=room['id'], message_id=info.message_id, file_id=info.message.document.file_id, timestamp=info.timestamp)
+		log_db.natalia_gifs.insert(document)
 
-		info = { 'user_id': user_id, 'chat_id': room['id'], 'message_id':message_id, 'message': message, 'timestamp': timestamp }
-		db.natalia_textmessages.insert(info)
+	else:
+		if info.kind == 'video':
+			live_feed(str(room['id'])+" - video")
+		return False
 
-		info = { 'user_id': user_id, 'name': name, 'username': username, 'last_seen': timestamp }
-		db.users.update_one( { 'user_id': user_id }, { "$set": info }, upsert=True)
+	user = { 'user_id': info.user_id, 'name': info.name, 'username': info.username, 'last_seen': info.timestamp }
+	log_db.users.update_one( { 'user_id': info.user_id }, { "$set": user }, upsert=True)
+	return False
 
-	else:
-		print("Person chatted without a username")
 
+# Flood and cross room duplicates, a duplicate is deleted everywhere
+def moderate(bot, info):
+	if info.kind in ('text', 'sticker') or (info.kind == 'gif' and info.room['is_log'] == 1):
+		check_flood(bot, info)
+	return info.kind == 'text' and check_duplicate(bot, info)
 
-def photo_message(bot, update):
-	user_id = update.message.from_user.id 
-	message_id = update.message.message_id 
-	room = get_room(update.message.chat.id)
-	caption = update.message.caption
 
-	# Picture has a caption ? 
-	if caption != None:
+# Shill logic : stop and counter reflinks
+def counter_shill(bot, info):
+	config = info.config
+	room = info.room
+	if info.kind != 'text' or len(info.urls) == 0 or not room['is_countershill'] or not config.SHILL_DETECTOR.search(info.text):
+		return False
 
-		# Find hashtags in the caption
-		hashtags = re.findall(r'#\w*', caption)
+	countershillReply = config.MESSAGES['countershillReplyStart']
 
-		# Did we find any ? 
-		if len(hashtags) > 0:
+	for s in config.COUNTER_SHILL: 
 
-			# Any matching ones, default = False
-			legit_hashtag = False
+		found = s['regex'].findall(info.text) 
+		if len(found) > 0: 
+			countershillReply += config.MESSAGES['countershillReplyCenter'].format(info.name, s['title'], s['link'])
 
-			# Itterate hashtags 
-			for e in hashtags:
-				if legit_hashtag == False:
-					legit_hashtag = forward_hashtags.get(e,False)
+	# Send message to mod chat that soemeone has shilled
+	OUTBOX.send(bot, outbox.MODERATION, 'sendMessage', chat_id=room['admin_room_id'], text= config.MESSAGES['countershillAdminWarning'].format(info.name, room['name']),parse_mode="Markdown",disable_web_page_preview=1)
 
-			# Post is allowed to be forwarded 
-			if legit_hashtag != False:
-				bot.forwardMessage(chat_id=legit_hashtag, from_chat_id=room['id'], message_id=message_id)
+	# Forward the offending message to the mod room
+	forwarded = OUTBOX.send(bot, outbox.MODERATION, 'forwardMessage', chat_id=room['admin_room_id'], from_chat_id=room['id'], message_id=info.message_id)
 
-	if user_id == 61697695:
-		pprint('Photo / Picture')
-		pprint(update.message.__dict__)
-		for p in update.message.photo:
-			pprint(p.__dict__)
+	# Delete the offending message, once forwarded (or not)
+	forwarded.add_done_callback(lambda future: OUTBOX.send(bot, outbox.MODERATION, 'delete_message', chat_id=room['id'], message_id=info.message_id))
 
+	# Replace with the new replacement message
+	OUTBOX.send(bot, outbox.MODERATION, 'sendMessage', chat_id=room['id'], text=countershillReply, disable_web_page_preview=1)
 
-def sticker_message(bot, update):
-	user_id = update.message.from_user.id
-	message_id = update.message.message_id 
-	room = get_room(update.message.chat.id)
-	timestamp = datetime.datetime.utcnow()
-	username = update.message.from_user.username 
-	name = get_name(update.message.from_user)
+	# Ban the bad actor
+	OUTBOX.send(bot, outbox.MODERATION, 'kick_chat_member', chat_id=room['id'], user_id=info.user_id)
+	return True
 
-	# if chat_id in LOG_ROOMS: 
-	if chat_id: 
 
-		pprint('STICKER')
-		
-		sticker_id = update.message.sticker.file_id
-		
-		# file = bot.getFile(sticker_id)
-		pprint(update.message.sticker.__dict__)
-		# pprint(file.__dict__)
-		
-		if username != None:
-			info = { 'user_id': user_id, 'chat_id': room['id'], 'message_id': message_id, 'sticker_id': sticker_id, 'timestamp': timestamp }
-			db.natalia_stickers.insert(info)
+# Forward to channels logic : links to FORWARD_URLS sites, once per article and channel
+def forward_links(bot, info):
+	config = info.config
+	room = info.room
+	if info.kind != 'text' or len(info.urls) == 0:
+		return False
+	forwarded = [url for url in info.urls if config.FORWARD_URLS.search(url)]
+	if len(forwarded) == 0:
+		return False
 
-			info = { 'user_id': user_id, 'name': name, 'username': username, 'last_seen': timestamp }
-			db.users.update_one( { 'user_id': user_id }, { "$set": info }, upsert=True)
+	channel = room['forward_channel']
+	window  = float(config.FORWARD_DEDUP.get('hours', 24)) * 3600
+	claimed = FORWARDED_LINKS.claim(channel, forwarded, window) if window > 0 else []
+	if window > 0 and len(claimed) == 0:
+		metrics.REGISTRY.inc('natalia_forward_duplicates_total', (('channel', str(channel)),))
+		return False
 
+	# A failed forward doesn't count, the next copy of the link goes out
+	def forwarded_or_released(future):
+		if future.exception() is not None:
+			FORWARDED_LINKS.release(channel, claimed)
+	OUTBOX.send(bot, outbox.REPORT, 'forwardMessage', chat_id=channel, from_chat_id=room['id'], message_id=info.message_id).add_done_callback(forwarded_or_released)
+	return False
 
-def video_message(bot, update):
-	user_id = update.message.from_user.id 
-	message_id = update.message.message_id 
-	room = get_room(update.message.chat.id)
-	timestamp = datetime.datetime.utcnow()
-	name = get_name(update.message.from_user)
 
-	pprint('VIDEO')
+# Photos with a routed hashtag (FORWARD_HASHTAGS) in their caption go to the feed channels.
+# An album arrives as one update per photo (the caption is usually on one of them only), they
+# are collected for ALBUM_SECONDS then sent together, in order, as one album
+ALBUM_SECONDS = 1.5
+albums        = {}   # media_group_id : [(message_id, file_id, caption, hashtags)]
+albums_lock   = threading.Lock()
+
+def forward_channels(config, hashtags):
+	channels = []
+	for hashtag in hashtags:
+		for channel in config.FORWARD_HASHTAGS.get(hashtag, []):
+			if channel not in channels:
+				channels.append(channel)
+	return channels
+
+def forward_album(bot, media_group_id):
+	with albums_lock:
+		photos = sorted(albums.pop(media_group_id))
+	channels = forward_channels(CONFIG, (hashtag for photo in photos for hashtag in photo[3]))
+	if len(channels) == 0:
+		return
+	media = [telegram.InputMediaPhoto(media=file_id, caption=caption) for message_id, file_id, caption, hashtags in photos]
+	for channel in channels:
+		OUTBOX.send(bot, outbox.REPORT, 'sendMediaGroup', chat_id=channel, media=media)
+
+def forward_photos(bot, info):
+	if info.kind != 'photo':
+		return False
+	media_group_id = info.message.media_group_id
 
-	# Not doing anything with this yet
+	if media_group_id is not None:
+		with albums_lock:
+			album = albums.get(media_group_id)
+			if album is None:
+				album = albums[media_group_id] = []
+				threading.Timer(ALBUM_SECONDS, forward_album, args=(bot, media_group_id)).start()
+			album.append((info.message_id, info.message.photo[-1].file_id, info.message.caption, info.hashtags))
 
+	# Picture has a caption with a routed hashtag ? 
+	else:
+		for channel in forward_channels(info.config, info.hashtags):
+			OUTBOX.send(bot, outbox.REPORT, 'forwardMessage', chat_id=channel, from_chat_id=info.room['id'], message_id=info.message_id)
 
-def document_message(bot, update):
-	user_id = update.message.from_user.id 
-	message_id = update.message.message_id 
-	room = get_room(update.message.chat.id)
-	timestamp = datetime.datetime.utcnow()
-	username = update.message.from_user.username 
-	name = get_name(update.message.from_user)
+	if info.user_id == 61697695 and logger.isEnabledFor(logging.DEBUG):
+		logger.debug("Photo / Picture %s", str(info.message.to_dict()))
+	return False
 
-	if room['is_log'] == 1 : 
 
-		images = ['image/jpeg','image/png','image/jpg','image/tiff']
-		if update.message.document.mime_type in images:
+# Uncompressed images posted in the logged rooms are replaced by a warning
+def uncompressed_images(bot, info):
+	room = info.room
+	images = ['image/jpeg','image/png','image/jpg','image/tiff']
+	if info.kind != 'document' or room['is_log'] != 1 or info.message.document.mime_type not in images:
+		return False
 
-			if room['lastuncompressed_image_message_id'] > 0: 
-				bot.delete_message(chat_id=room['id'], message_id=room['lastuncompressed_image_message_id'])
+	state = info.config.state(room)
+	if state['lastuncompressed_image_message_id'] > 0: 
+		OUTBOX.send(bot, outbox.MODERATION, 'delete_message', chat_id=room['id'], message_id=state['lastuncompressed_image_message_id'])
+
+	OUTBOX.send(bot, outbox.MODERATION, 'delete_message', chat_id=room['id'], message_id=info.message_id)
+	message = OUTBOX.send(bot, outbox.MODERATION, 'sendMessage', chat_id=room['id'], text=(info.config.MESSAGES['uncompressedImage'] % info.name),parse_mode="Markdown",disable_web_page_preview=1)
+	def sent(future):
+		if future.exception() is None:
+			state['lastuncompressed_image_message_id'] = int(future.result().message_id)
+	message.add_done_callback(sent)
+	return True
+
+
+PIPELINE = [log_message, moderate, counter_shill, forward_links, forward_photos, uncompressed_images]
+
+metrics.REGISTRY.describe('natalia_stage_seconds', 'Time spent in a message pipeline stage')
+metrics.REGISTRY.describe('natalia_stage_errors_total', 'Exceptions raised by a message pipeline stage')
+
+def message_pipeline(bot, update):
+	""" Every message that isn't a command or a join / leave """
+	if update.message is None:
+		return
+	info = MessageInfo(update)
+
+	# Someone private messages Natalia
+	if info.private:
+		if info.kind == 'text':
+			log_message_private(bot, update)
+		return
+	if not info.room or info.command or info.kind is None:
+		return
+
+	for stage in PIPELINE:
+		labels  = (('stage', stage.__name__),)
+		started = time.perf_counter()
+		try:
+			stop = stage(bot, info)
+		except Exception as e:
+			# The next stages still run, a failed insert doesn't skip the moderation
+			metrics.REGISTRY.inc('natalia_stage_errors_total', labels)
+			logger.error("Stage %s failed on %s : %s", stage.__name__, info.message_id, str(e))
+			stop = False
+		finally:
+			metrics.REGISTRY.observe('natalia_stage_seconds', labels, time.perf_counter() - started)
+		if stop:
+			return
 
-			bot.delete_message(chat_id=room['id'], message_id=message_id)
-			message = bot.sendMessage(chat_id=room['id'], text=(MESSAGES['uncompressedImage'] % name),parse_mode="Markdown",disable_web_page_preview=1)
-			room['lastuncompressed_image_message_id'] = int(message.message_id)
 
-		if update.message.document.mime_type == 'video/mp4':
+#################################
+# Command Handlers
+# Threads of the dispatcher's run_async pool, the handlers themselves run one after another
+WORKERS = 10
+
+def register_handlers(dp):
+	""" Registers every command / message handler on the dispatcher """
+
+	# Commands
+	dp.add_handler(CommandHandler('id', getid))
+	for request in PM_PAGE_COMMANDS:
+		dp.add_handler(CommandHandler(request, pm_page(request)))
+	dp.add_handler(CommandHandler('special', special))
+
+	dp.add_handler(CommandHandler('topstickers', topstickers))
+	dp.add_handler(CommandHandler('topgif', topgif))
+	dp.add_handler(CommandHandler('topgifposters', topgifposters))
+	dp.add_handler(CommandHandler('todayinwords', todayinwords))
+	dp.add_handler(CommandHandler('roomwords', roomwords))
+	dp.add_handler(CommandHandler('todaysusers', todaysusers))
+	dp.add_handler(CommandHandler('promotets', promotets))
+	dp.add_handler(CommandHandler('shill', shill))
+	dp.add_handler(CommandHandler('commandstats',commandstats))
+	dp.add_handler(CommandHandler('joinstats',joinstats))
+	dp.add_handler(CommandHandler('whalepooloverprice',whalepooloverprice))
+	dp.add_handler(CommandHandler('perfstats',perfstats))
+	dp.add_handler(CommandHandler('reload',reload))
+	dp.add_handler(CommandHandler('export',export))
+
+	# Welcome
+	dp.add_handler(MessageHandler(Filters.status_update.new_chat_members, new_chat_member))
+
+	# Goodbye 
+	dp.add_handler(MessageHandler(Filters.status_update.left_chat_member, left_chat_member))
+
+	# Every other message (texts, links, photos, stickers, gifs, documents, private messages)
+	dp.add_handler(MessageHandler(Filters.all, message_pipeline))
+
+	# log all errors
+	dp.add_error_handler(error)
+
+	# Time every handler registered above
+	for group in dp.handlers.values():
+		for handler in group:
+			handler.callback = metrics.timed_handler(handler.callback)
 
-			pprint('VIDEO')
-			
-			file_id = update.message.document.file_id
-		
-			if username != None:
-				info = { 'user_id': user_id, 'chat_id': room['id'], 'message_id': message_id, 'file_id': file_id, 'timestamp': timestamp }
-				db.natalia_gifs.insert(info)
 
-				info = { 'user_id': user_id, 'name': name, 'username': username, 'last_seen': timestamp }
-				db.users.update_one( { 'user_id': user_id }, { "$set": info }, upsert=True)
+#################################
+# Dispatcher monitoring
+queue_alerts = { 'last_sent': 0 }
+
+metrics.REGISTRY.describe('natalia_update_queue_depth', 'Updates waiting in the dispatcher queue')
+metrics.REGISTRY.describe('natalia_update_queue_oldest_seconds', 'Age of the oldest update waiting in the dispatcher queue')
+metrics.REGISTRY.describe('natalia_dispatcher_busy_seconds', 'How long the dispatcher thread has been in its current handler, 0 when idle')
+
+def monitor_dispatcher(bot, job):
+	""" Samples queue depth / the handler holding the dispatcher / oldest pending update and warns the bot owner """
+	config = CONFIG
+	update_queue = job.context.update_queue
+	depth = update_queue.qsize()
+
+	# Peek the head of the queue without consuming it
+	oldest_age = 0
+	with update_queue.mutex:
+		head = update_queue.queue[0] if len(update_queue.queue) > 0 else None
+	message = getattr(head, 'effective_message', None)
+	if message is not None and message.date is not None:
+		oldest_age = max(0, (datetime.datetime.now() - message.date).total_seconds())
+
+	# Handlers run one after another on the dispatcher thread, a slow one holds every room up
+	busy = metrics.REGISTRY.busiest_handler()
+	busy_seconds = busy[1] if busy is not None else 0
+
+	metrics.REGISTRY.set_gauge('natalia_update_queue_depth', (), depth)
+	metrics.REGISTRY.set_gauge('natalia_update_queue_oldest_seconds', (), oldest_age)
+	metrics.REGISTRY.set_gauge('natalia_dispatcher_busy_seconds', (), busy_seconds)
+
+	problems = []
+	if depth >= config.QUEUE_MONITOR.get('max_queue', 100):
+		problems.append("queue depth "+str(depth))
+	if busy is not None and busy_seconds >= config.QUEUE_MONITOR.get('max_busy', 10):
+		problems.append("busy in "+busy[0]+" for {:.0f}s".format(busy_seconds))
+	if oldest_age >= config.QUEUE_MONITOR.get('max_age', 30):
+		problems.append("oldest update waiting {:.0f}s".format(oldest_age))
+
+	if len(problems) > 0:
+		text = "Dispatcher "+(SHARD_NAME+" " if SHARD_NAME else "")+"saturated: "+", ".join(problems)
+		logger.warning(text)
+		now = time.time()
+		if now - queue_alerts['last_sent'] >= config.QUEUE_MONITOR.get('alert_cooldown', 600):
+			queue_alerts['last_sent'] = now
+			OUTBOX.send(bot, outbox.REPORT, 'sendMessage', chat_id=config.FORWARD_PRIVATE_MESSAGES_TO, text=text)
 
 
+#################################
+# Maintenance jobs : each run goes in its own thread so the job queue isn't held up,
+# a run is skipped while the previous one is still going
 
-def links_and_hashtag_messages(bot, update):
-	user_id = update.message.from_user.id 
-	message_id = update.message.message_id 
-	room = get_room(update.message.chat.id)
-	name = get_name(update.message.from_user)
+def background_job(name, task):
+	""" Job queue callback running `task` in a `name` thread """
+	lock = threading.Lock()
 
-	# Shill logic : stop and counter reflinks
-	find_shill = re.findall(SHILL_DETECTOR, update.message.text)
-	if (len(find_shill) > 0) and room['is_countershill']:
+	def run():
+		if not lock.acquire(blocking=False):
+			return
+		try:
+			task()
+		except Exception as e:
+			logger.error("Job %s failed : %s", name, str(e))
+		finally:
+			lock.release()
 
-		countershillReply = MESSAGES['countershillReplyStart']
+	def start(bot, job):
+		threading.Thread(target=run, name=name, daemon=True).start()
+	start.__name__ = name+'_job'
+	return start
 
-		for s in COUNTER_SHILL: 
 
-			found = re.findall(s['regex'], update.message.text) 
-			if len(found) > 0: 
-				countershillReply += MESSAGES['countershillReplyCenter'].format(name, s['title'], s['link'])
+#################################
+# Parquet archive
 
-		# Send message to mod chat that soemeone has shilled
-		bot.sendMessage(chat_id=room['admin_room_id'], text= MESSAGES['countershillAdminWarning'].format(name, room['name']),parse_mode="Markdown",disable_web_page_preview=1)
+# Held while a day is exported, by the archive job or by the retention before it deletes one
+archive_lock = threading.Lock()
 
-		# Forward the offending message to the mod room
-		bot.forwardMessage(chat_id=room['admin_room_id'], from_chat_id=room['id'], message_id=message_id)
+def archive_closed_days():
+	""" Compacts closed days into the parquet archive """
+	config = CONFIG
+	with archive_lock:
+		archive.export_closed_days(analytics_db, config.ARCHIVE_PATH, config.ARCHIVE.get('backfill_days', 60), logger)
 
-		# Delete the offending message
-		bot.delete_message(chat_id=room['id'], message_id=message_id)
+archive_job = background_job('archive', archive_closed_days)
 
-		# Replace with the new replacement message
-		bot.sendMessage(chat_id=room['id'], text=countershillReply, disable_web_page_preview=1)
 
-		# Ban the bad actor
-		bot.kick_chat_member(chat_id=room['id'], user_id=user_id)
+#################################
+# Retention of the raw events
+
+def store_missing_reports(collection, day):
+	""" Stores the daily reports counted from `collection` on `day`, while its raw events are still there """
+	for report, (source, field, amount) in REPORTS.items():
+		if source == collection and db.daily_reports.find_one({ '_id': report+':'+day.strftime('%Y-%m-%d') }, { '_id': 1 }) is None:
+			store_day(report, day, count_day(report, day))
+
+def apply_retention():
+	""" Rolls up and deletes the raw events older than raw_days, oldest day first """
+	config = CONFIG
+	retention.create_indexes(db)
+	today  = archive.utc_today()
+	cutoff = today - int(config.RETENTION_CONFIG['raw_days']) * archive.ONE_DAY
+	batch  = int(config.RETENTION_CONFIG.get('batch', 5000))
+	pause  = float(config.RETENTION_CONFIG.get('pause', 0.2))
+
+	for collection in retention.COLLECTIONS:
+		day = retention.rolled_until(db, collection) or retention.first_day(log_db, collection)
+		while day is not None and day < cutoff:
+			# Past the archive's backfill_days, the day is exported here before it goes
+			if config.ARCHIVE_PATH and collection in archive.COLUMNS:
+				with archive_lock:
+					if not archive.is_archived(config.ARCHIVE_PATH, collection, day):
+						rows = archive.export_day(log_db, config.ARCHIVE_PATH, collection, day)
+						logger.info("Archived %s %s before its retention (%d rows)", collection, day.strftime('%Y-%m-%d'), rows)
+			store_missing_reports(collection, day)
+			if collection in logschema.COLLECTIONS:
+				retention.rollup_day(log_db, db, collection, day)
+			deleted = retention.delete_day(log_db, collection, day, batch, pause)
+			retention.set_rolled_until(db, collection, day + archive.ONE_DAY, deleted)
+			metrics.REGISTRY.inc('natalia_retention_rolled_days_total', (('collection', collection),))
+			logger.info("Retention : %s %s rolled up, %d raw documents deleted (%d days left)", collection, day.strftime('%Y-%m-%d'), deleted, (cutoff - day).days - 1)
+			day += archive.ONE_DAY
+
+	if config.RETENTION_CONFIG.get('hourly_days'):
+		pruned = retention.prune_hourly(db, today - int(config.RETENTION_CONFIG['hourly_days']) * archive.ONE_DAY)
+		if pruned > 0:
+			logger.info("Retention : %d hourly counts dropped", pruned)
+
+retention_job = background_job('retention', apply_retention)
 
-	# Forward to channels logic
-	urls = [] 
-	legit_hashtag = False
-	for entity in update.message.entities:
-		message_text = update.message.text[entity.offset:(entity.length+entity.offset)]
-		if entity.type == 'hashtag':
-			if message_text == room['forward_hashtag']:
-				legit_hashtag = True
-		if entity.type == 'url':
-			urls.append(message_text)
 
-	furlcnt = re.findall(FORWARD_URLS, update.message.text)
-	if len(furlcnt) > 0 :
-		bot.forwardMessage(chat_id=room['forward_channel'], from_chat_id=room['id'], message_id=message_id)
+#################################
+# Daily reports precomputation
+
+def create_report_indexes():
+	""" Indexes the reports look days up with, in the raw commands and in the store """
+	log_db.pm_requests.create_index([('timestamp', 1)])
+	db.daily_reports.create_index([('report', 1), ('day', 1)])
+
+def precompute_reports():
+	""" Stores the closed days missing from daily_reports, up to backfill_days back, newest first
+
+	At most max_days reports per run with a pause between two, a backfill is spread over
+	the next runs instead of scanning a year of raw events at once.
+	"""
+	config   = CONFIG
+	today    = archive.utc_today()
+	first    = leaderboard_start()
+	max_days = int(config.REPORTS_CONFIG.get('max_days', 30))
+	pause    = float(config.REPORTS_CONFIG.get('pause', 0.5))
+	missing  = []
+	for report in REPORTS:
+		stored = set(d['day'] for d in db.daily_reports.find({ 'report': report, 'day': { '$gte': first } }, { 'day': 1 }))
+		day = first
+		while day < today:
+			if day not in stored:
+				missing.append((day, report))
+			day += archive.ONE_DAY
+	# The recent days first, they are the ones the commands ask for
+	missing.sort(reverse=True)
+
+	for day, report in missing[:max_days]:
+		store_day(report, day, count_day(report, day))
+		time.sleep(pause)
+	if len(missing) > 0:
+		logger.info("Precomputed %d daily reports (%d left)", min(len(missing), max_days), max(0, len(missing) - max_days))
+
+reports_job = background_job('reports', precompute_reports)
 
 
 #################################
-# Command Handlers
-logger.info("Setting command handlers")
-updater = Updater(bot=bot,workers=10)
-dp      = updater.dispatcher
-
-# Commands
-dp.add_handler(CommandHandler('id', getid))
-dp.add_handler(CommandHandler('start', start))
-dp.add_handler(CommandHandler('about', about))
-dp.add_handler(CommandHandler('rules', rules))
-dp.add_handler(CommandHandler('admins', admins))
-dp.add_handler(CommandHandler('teamspeak', teamspeak))
-dp.add_handler(CommandHandler('telegram', telegram))
-dp.add_handler(CommandHandler('livestream', livestream))
-# dp.add_handler(CommandHandler('fomobot', fomobot))
-dp.add_handler(CommandHandler('teamspeakbadges', teamspeakbadges))
-dp.add_handler(CommandHandler('exchanges', exchanges))
-dp.add_handler(CommandHandler('donation', donation))
-dp.add_handler(CommandHandler('special', special))
-
-dp.add_handler(CommandHandler('topstickers', topstickers))
-dp.add_handler(CommandHandler('topgif', topgif))
-dp.add_handler(CommandHandler('topgifposters', topgifposters))
-dp.add_handler(CommandHandler('todayinwords', todayinwords))
-dp.add_handler(CommandHandler('todaysusers', todaysusers))
-dp.add_handler(CommandHandler('promotets', promotets))
-dp.add_handler(CommandHandler('shill', shill))
-dp.add_handler(CommandHandler('commandstats',commandstats))
-dp.add_handler(CommandHandler('joinstats',joinstats))
-dp.add_handler(CommandHandler('whalepooloverprice',whalepooloverprice))
-
-# Welcome
-dp.add_handler(MessageHandler(Filters.status_update.new_chat_members, new_chat_member))
-
-# Goodbye 
-dp.add_handler(MessageHandler(Filters.status_update.left_chat_member, left_chat_member))
-
-# Photo message
-dp.add_handler(MessageHandler(Filters.photo, photo_message))
-
-# Sticker message
-dp.add_handler(MessageHandler(Filters.sticker, sticker_message))
-
-# Video
-dp.add_handler(MessageHandler(Filters.video, video_message))
-
-# Links & Hashtags
-dp.add_handler(MessageHandler((Filters.entity(MessageEntity.HASHTAG) | Filters.entity(MessageEntity.URL)), links_and_hashtag_messages))
-
-# Documents 
-dp.add_handler(MessageHandler(Filters.document, document_message))
-
-# Someone private messages Natalia
-dp.add_handler(MessageHandler(Filters.private, log_message_private))
-
-# Normal Text chat
-dp.add_handler(MessageHandler(Filters.text, echo))
-
-# log all errors
-dp.add_error_handler(error)
+# Restarts : the warm in memory state is written to RESTART.snapshot on stop (and every
+# RESTART.interval seconds) and loaded back at start, with the next update offset
+snapshot_lock = threading.Lock()
+
+def snapshot_path(config):
+	""" RESTART.snapshot, one per worker process in sharded mode """
+	return config.SNAPSHOT_PATH if SHARD_NAME is None else config.SNAPSHOT_PATH+'.'+SHARD_NAME
+
+def save_snapshot(offset=None):
+	""" Writes the warm state, `offset` only once the updates before it are handled """
+	config = CONFIG
+	with snapshot_lock:
+		with profile_photos_lock:
+			photos = list(profile_photos.items())
+		with PHOTO_CACHE.lock:
+			file_ids = list(PHOTO_CACHE.entries.items())
+		state = {
+			'written'       : datetime.datetime.utcnow(),
+			'offset'        : offset,
+			'rooms'         : dict((name, dict([('id', room['id'])] + list(config.state(room).items()))) for name, room in config.ROOMS.items()),
+			'profile_photos': photos,
+			'file_ids'      : file_ids,
+			'flood'         : FLOOD_DETECTOR.dump(),
+			'duplicates'    : DUPLICATE_DETECTOR.dump(),
+			'links'         : FORWARDED_LINKS.dump(),
+		}
+		# Written aside then renamed, a stop while writing keeps the previous one
+		path = snapshot_path(config)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path+'.tmp', 'wb') as fp:
+			pickle.dump(state, fp, pickle.HIGHEST_PROTOCOL)
+		os.replace(path+'.tmp', path)
+
+def load_snapshot():
+	""" Warms the caches up from the last snapshot, returns its update offset (None if unknown) """
+	config = CONFIG
+	path = snapshot_path(config)
+	try:
+		with open(path, 'rb') as fp:
+			state = pickle.load(fp)
+	except FileNotFoundError:
+		return None
+	except Exception as e:
+		logger.warning("Ignoring the snapshot %s : %s", path, str(e))
+		return None
+
+	for name, saved in state['rooms'].items():
+		room = config.ROOMS.get(name)
+		if room is not None and room['id'] == saved['id']:
+			config.state(room).update((key, saved[key]) for key in ROOM_STATE_KEYS if key in saved)
+	for user_id, (has_photo, checked) in state['profile_photos']:
+		remember_profile_photo(user_id, has_photo, checked)
+	for key, file_id in state['file_ids']:
+		PHOTO_CACHE.remember(key, file_id)
+	FLOOD_DETECTOR.load(state['flood'])
+	DUPLICATE_DETECTOR.load(state['duplicates'])
+	FORWARDED_LINKS.load(state.get('links', []))
+
+	logger.info("Loaded the snapshot of %s (%d profile photos, %d file ids)", state['written'].strftime('%Y-%m-%d %H:%M:%S'), len(state['profile_photos']), len(state['file_ids']))
+	return state['offset']
+
+def snapshot_job(bot, job):
+	# The updates fetched may not be handled yet, only a clean stop saves the offset
+	try:
+		save_snapshot()
+	except Exception as e:
+		logger.error("Writing the snapshot failed : %s", str(e))
+
+def poll(update_queue, offset, running):
+	""" Long polls telegram into the dispatcher queue until running['polling'] is cleared """
+	timeout = int(CONFIG.RESTART.get('poll_timeout', 5))
+	while running['polling']:
+		try:
+			updates = bot.get_updates(offset=offset, timeout=timeout)
+		except telegram.error.TelegramError as e:
+			logger.warning("Polling failed : %s", str(e))
+			time.sleep(1)
+			continue
+		for update in updates:
+			offset = update.update_id + 1
+			update_queue.put(update)
+	return offset
+
+def shutdown(updater, offset):
+	""" Handles the updates already fetched, lets the queued writes and api calls go out, saves the state """
+	config = CONFIG
+	deadline = time.monotonic() + float(config.RESTART.get('drain_timeout', 30))
+	updater.job_queue.stop()
+
+	dp = updater.dispatcher
+	while (dp.update_queue.qsize() > 0 or metrics.REGISTRY.get_gauge('natalia_handlers_in_flight') > 0) and time.monotonic() < deadline:
+		time.sleep(0.05)
+	if dp.update_queue.qsize() > 0:
+		# Left unconfirmed, telegram sends them again after the restart
+		logger.warning("Stopping with %d updates not handled", dp.update_queue.qsize())
+		offset = None
+	dp.stop()
+
+	# Telegram won't send the handled updates again
+	if offset is not None:
+		try:
+			bot.get_updates(offset=offset, timeout=0)
+		except telegram.error.TelegramError as e:
+			logger.warning("Confirming the update offset failed : %s", str(e))
+	OUTBOX.stop(max(1.0, deadline - time.monotonic()))
+	PM_REQUESTS.flush()
+	USER_UPDATES.flush()
+	PHOTO_CACHE.flush()
+
+	if config.SNAPSHOT_PATH:
+		save_snapshot(offset)
+	db.softlog.insert({'comment' : 'Natalia stopped', 'timestamp' :datetime.datetime.utcnow()})
+	logger.info("Stopped")
+
+
+def handle_stop(running):
+	""" SIGINT / SIGTERM clear running['polling'] instead of killing the process, the caller drains """
+	def stop(signum, frame):
+		logger.info("Stopping")
+		running['polling'] = False
+	signal.signal(signal.SIGINT, stop)
+	signal.signal(signal.SIGTERM, stop)
+
+def schedule_jobs(job_queue, dp, maintenance=True):
+	""" The queue monitor and snapshots of this process, and unless another process runs
+	them the maintenance jobs (archive, retention, daily reports) """
+	config = CONFIG
+	job_queue.run_repeating(monitor_dispatcher, interval=config.QUEUE_MONITOR.get('interval', 10), first=config.QUEUE_MONITOR.get('interval', 10), context=dp)
+
+	if config.SNAPSHOT_PATH and config.RESTART.get('interval', 300):
+		job_queue.run_repeating(snapshot_job, interval=config.RESTART.get('interval', 300), first=config.RESTART.get('interval', 300))
+
+	if not maintenance:
+		return
+
+	if config.ARCHIVE_PATH:
+		job_queue.run_repeating(archive_job, interval=config.ARCHIVE.get('interval', 3600), first=60)
+
+	if config.RETENTION_CONFIG.get('raw_days'):
+		job_queue.run_repeating(retention_job, interval=config.RETENTION_CONFIG.get('interval', 3600), first=300)
+
+	# Daily reports : stores the days closed since the last run, a backfill a few days per run
+	job_queue.run_repeating(reports_job, interval=config.REPORTS_CONFIG.get('interval', 3600), first=30)
 
 
 #################################
 # Polling 
-logger.info("Starting polling")
-updater.start_polling()
-
-# PikaWrapper()
\ No newline at end of file
+if __name__ == '__main__':
+	db.softlog.insert({'comment' : 'Natalia started', 'timestamp' :datetime.datetime.utcnow()})
+	logschema.create_indexes(log_db)
+	create_report_indexes()
+	offset = load_snapshot() if CONFIG.SNAPSHOT_PATH else None
+
+	logger.info("Setting command handlers")
+	updater = Updater(bot=bot,workers=WORKERS)
+	dp      = updater.dispatcher
+	register_handlers(dp)
+	PM_REQUESTS.start()
+	USER_UPDATES.start()
+	PHOTO_CACHE.start()
+	OUTBOX.start()
+
+	schedule_jobs(updater.job_queue, dp)
+	start_render_pool()
+
+	# Prometheus scrape endpoint
+	if CONFIG.METRICS_CONFIG.get('port'):
+		logger.info("Serving metrics on port "+str(CONFIG.METRICS_CONFIG['port']))
+		metrics.start_http_server(CONFIG.METRICS_CONFIG['port'], CONFIG.METRICS_CONFIG.get('host', '127.0.0.1'))
+
+	# kill -HUP reloads config.yaml
+	signal.signal(signal.SIGHUP, lambda signum, frame: reload_config())
+
+	# Stopping ends the polling loop, the rest is drained in shutdown()
+	running = { 'polling': True }
+	handle_stop(running)
+
+	logger.info("Starting polling")
+	bot.delete_webhook()
+	updater.job_queue.start()
+	threading.Thread(target=dp.start, name='dispatcher', daemon=True).start()
+	offset = poll(dp.update_queue, offset, running)
+	shutdown(updater, offset)
+
+	# PikaWrapper()
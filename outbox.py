@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Outbound queue for the telegram api calls : handlers enqueue a call and move on, a few
+# sender threads run them by priority (moderation, then welcomes, then reports/broadcasts)
+# while keeping under telegram's rate limits, honouring RetryAfter and retrying network errors.
+#
+#   OUTBOX.send(bot, MODERATION, 'delete_message', chat_id=..., message_id=...)   fire and forget
+#   OUTBOX.send(bot, REPORT, 'sendMessage', ...).add_done_callback(posted)        posted(future) once answered
+#   OUTBOX.call(bot, REPORT, 'sendMessage', chat_id=..., text=...)                waits for the result (scripts only,
+#                                                                                 a handler waiting holds up every room)
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+import metrics
+
+MODERATION = 0
+WELCOME    = 1
+REPORT     = 2
+
+PRIORITY_NAMES = { MODERATION: 'moderation', WELCOME: 'welcome', REPORT: 'report' }
+
+logger = logging.getLogger('natalia.outbox')
+
+metrics.REGISTRY.describe('natalia_outbox_pending', 'Telegram api calls waiting in the outbox')
+metrics.REGISTRY.describe('natalia_outbox_retries_total', 'Telegram api calls retried (flood control or network)')
+metrics.REGISTRY.describe('natalia_outbox_failed_total', 'Telegram api calls given up on')
+
+
+class Stopped(Exception):
+	""" Set on the calls still queued when the outbox stops """
+
+
+def is_message(method):
+	""" Calls posting a message, the ones telegram rate limits """
+	method = method.replace('_', '').lower()
+	return method.startswith('send') or method.startswith('forward')
+
+
+class Call(object):
+
+	def __init__(self, bot, priority, method, kwargs):
+		self.bot      = bot
+		self.priority = priority
+		self.method   = method
+		self.kwargs   = kwargs
+		self.chat_id  = kwargs.get('chat_id')
+		self.attempts = 0
+		self.future   = Future()
+
+	def run(self):
+		# A file sent by an earlier attempt has been read to the end
+		for value in self.kwargs.values():
+			if hasattr(value, 'seek'):
+				value.seek(0)
+		return getattr(self.bot, self.method)(**self.kwargs)
+
+
+class Outbox(object):
+	""" Priority queue of api calls, run by `workers` sender threads """
+
+	def __init__(self, workers=4, chat_interval=1.0, group_interval=3.0, global_rate=30.0, retries=5, max_backoff=60.0):
+		self.workers        = workers
+		self.chat_interval  = chat_interval
+		self.group_interval = group_interval
+		self.global_rate    = global_rate
+		self.retries        = retries
+		self.max_backoff    = max_backoff
+
+		self.ready     = []   # (priority, seq, call)
+		self.waiting   = []   # (not before, seq, call)
+		self.chat_next = {}   # chat_id : when the next message may go out
+		self.next_send = 0.0  # when the next message may go out at all
+		self.sequence  = itertools.count()
+		self.condition = threading.Condition()
+		self.threads   = []
+		self.running   = False
+
+	def send(self, bot, priority, method, **kwargs):
+		""" Queues `bot.method(**kwargs)`, returns a Future of its result """
+		call = Call(bot, priority, method, kwargs)
+		with self.condition:
+			queued = self.running
+			if queued:
+				heapq.heappush(self.ready, (priority, next(self.sequence), call))
+				metrics.REGISTRY.add_gauge('natalia_outbox_pending', (('priority', PRIORITY_NAMES[priority]),), 1)
+				self.condition.notify()
+		if not queued:
+			# No sender threads (scripts, benchmarks, stopped) : run it here
+			self.execute(call, inline=True)
+		return call.future
+
+	def call(self, bot, priority, method, **kwargs):
+		""" Queues the call and waits for its result, raises what the api raised """
+		return self.send(bot, priority, method, **kwargs).result()
+
+	def interval(self, chat_id):
+		""" Seconds between two messages to a chat : 1/s in private chats, 20/min in groups """
+		try:
+			return self.chat_interval if int(chat_id) > 0 else self.group_interval
+		except (TypeError, ValueError):
+			# @channelusername
+			return self.group_interval
+
+	def next_call(self):
+		""" Blocks until a call may go out, None once stopped """
+		with self.condition:
+			while self.running:
+				now = time.monotonic()
+				while len(self.waiting) > 0 and self.waiting[0][0] <= now:
+					not_before, seq, call = heapq.heappop(self.waiting)
+					heapq.heappush(self.ready, (call.priority, seq, call))
+
+				timeout = self.waiting[0][0] - now if len(self.waiting) > 0 else None
+				if len(self.ready) > 0:
+					priority, seq, call = self.ready[0]
+					if not is_message(call.method):
+						heapq.heappop(self.ready)
+						return call
+					chat_free = self.chat_next.get(call.chat_id, 0.0)
+					if chat_free > now:
+						# This chat is busy, the others go first
+						heapq.heappop(self.ready)
+						heapq.heappush(self.waiting, (chat_free, seq, call))
+						continue
+					if self.next_send <= now:
+						heapq.heappop(self.ready)
+						self.chat_next[call.chat_id] = now + self.interval(call.chat_id)
+						self.next_send = max(self.next_send, now) + 1.0 / self.global_rate
+						return call
+					timeout = self.next_send - now if timeout is None else min(timeout, self.next_send - now)
+				self.condition.wait(timeout)
+			return None
+
+	def retry(self, call, delay):
+		call.attempts += 1
+		with self.condition:
+			queued = self.running
+			if queued:
+				heapq.heappush(self.waiting, (time.monotonic() + delay, next(self.sequence), call))
+				self.condition.notify()
+		if not queued:
+			self.fail([call])
+			return
+		metrics.REGISTRY.inc('natalia_outbox_retries_total', (('method', call.method),))
+		metrics.REGISTRY.add_gauge('natalia_outbox_pending', (('priority', PRIORITY_NAMES[call.priority]),), 1)
+
+	def fail(self, calls):
+		""" Resolves the calls the outbox stopped before, so nothing waits on them forever """
+		for call in calls:
+			metrics.REGISTRY.inc('natalia_outbox_failed_total', (('method', call.method),))
+			call.future.set_exception(Stopped(call.method+" to "+str(call.chat_id)+" dropped, the outbox stopped"))
+		if len(calls) > 0:
+			logger.warning("Outbox stopped, %d calls dropped", len(calls))
+
+	def execute(self, call, inline=False):
+		try:
+			call.future.set_result(call.run())
+			return
+		except RetryAfter as e:
+			# Flood control : nothing goes to that chat until telegram says so
+			if not inline and call.attempts < self.retries:
+				logger.warning("Flood control on %s %s, retrying in %ss", call.method, call.chat_id, e.retry_after)
+				with self.condition:
+					self.chat_next[call.chat_id] = time.monotonic() + e.retry_after
+				self.retry(call, e.retry_after)
+				return
+			error = e
+		except BadRequest as e:
+			# A NetworkError subclass, but retrying won't help
+			error = e
+		except NetworkError as e:
+			# Timeouts and connection errors, backing off exponentially
+			if not inline and call.attempts < self.retries:
+				self.retry(call, min(self.max_backoff, 2 ** call.attempts))
+				return
+			error = e
+		except TelegramError as e:
+			# Unauthorized, chat migrated etc.
+			error = e
+		except Exception as e:
+			error = e
+
+		metrics.REGISTRY.inc('natalia_outbox_failed_total', (('method', call.method),))
+		logger.warning("%s to %s failed : %s", call.method, call.chat_id, str(error))
+		call.future.set_exception(error)
+
+	def sender(self):
+		while True:
+			call = self.next_call()
+			if call is None:
+				return
+			metrics.REGISTRY.add_gauge('natalia_outbox_pending', (('priority', PRIORITY_NAMES[call.priority]),), -1)
+			self.execute(call)
+
+	def start(self):
+		self.running = True
+		for i in range(self.workers):
+			thread = threading.Thread(target=self.sender, name='outbox-'+str(i), daemon=True)
+			thread.start()
+			self.threads.append(thread)
+
+	def stop(self, timeout=10.0):
+		""" Lets the queued calls go out (up to `timeout` seconds) then stops the senders, the calls left fail with Stopped """
+		deadline = time.monotonic() + timeout
+		while time.monotonic() < deadline:
+			with self.condition:
+				if len(self.ready) == 0 and len(self.waiting) == 0:
+					break
+			time.sleep(0.05)
+		with self.condition:
+			self.running = False
+			dropped      = [entry[2] for entry in self.ready + self.waiting]
+			self.ready   = []
+			self.waiting = []
+			self.condition.notify_all()
+		for call in dropped:
+			metrics.REGISTRY.add_gauge('natalia_outbox_pending', (('priority', PRIORITY_NAMES[call.priority]),), -1)
+		self.fail(dropped)
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+
+	def pending(self):
+		with self.condition:
+			return len(self.ready) + len(self.waiting)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Tiered retention of the raw events : past RETENTION.raw_days a day of a log collection is
+# rolled up into per room hourly and daily counts (the activity collection), then its raw
+# documents are deleted by small batches. Hourly counts are dropped after hourly_days, the
+# daily ones are kept.
+#
+#   activity { collection, c: chat id, period: 'hour' | 'day', start, count }
+#   retention { _id: collection, rolled_until, deleted, updated }     (progress, resumable)
+import datetime
+import time
+from collections import Counter
+
+from pymongo import ReplaceOne
+
+import archive
+import logschema
+import metrics
+
+# Raw collections, pm_requests only lives on in the daily reports
+COLLECTIONS = logschema.COLLECTIONS + ['pm_requests']
+
+metrics.REGISTRY.describe('natalia_retention_deleted_total', 'Raw event documents deleted once rolled up')
+metrics.REGISTRY.describe('natalia_retention_rolled_days_total', 'Days of raw events rolled up')
+
+
+def day_filter(collection, day):
+	if collection in logschema.COLLECTIONS:
+		return logschema.match(day, day + archive.ONE_DAY)
+	return { 'timestamp': { '$gte': day, '$lt': day + archive.ONE_DAY } }
+
+
+def rolled_until(db, collection):
+	""" First day still kept raw, None before the first run """
+	state = db.retention.find_one({ '_id': collection })
+	return state['rolled_until'] if state is not None else None
+
+
+def first_day(db, collection):
+	""" Day of the oldest raw document (ObjectIds grow with the insertion time), None when empty """
+	for doc in db[collection].find().sort('_id', 1).limit(1):
+		return archive.day_start(doc.get('ts') or doc['timestamp'])
+	return None
+
+
+def create_indexes(db):
+	db.activity.create_index([('collection', 1), ('c', 1), ('period', 1), ('start', 1)])
+
+
+#################################
+#           ROLLING UP
+
+def rollup_day(source, db, collection, day):
+	""" Stores the hourly and daily counts per room of a day, safe to run again """
+	pipe = [
+		{ '$match': logschema.match(day, day + archive.ONE_DAY) },
+		{ '$group': { '_id': { 'c': logschema.field('chat_id'), 'h': { '$hour': logschema.field('timestamp') } }, 'count': { '$sum': 1 } } }
+	]
+	hours = Counter()
+	days  = Counter()
+	for r in source[collection].aggregate(pipe):
+		# Chat ids are int or str until the logs are migrated
+		chat = logschema.chat_id(r['_id']['c'])
+		hours[(chat, r['_id']['h'])] += r['count']
+		days[chat] += r['count']
+
+	requests = []
+	for (chat, hour), count in hours.items():
+		start = day + datetime.timedelta(hours=hour)
+		requests.append(ReplaceOne({ '_id': collection+':'+str(chat)+':hour:'+start.isoformat() }, { 'collection': collection, 'c': chat, 'period': 'hour', 'start': start, 'count': count }, upsert=True))
+	for chat, count in days.items():
+		requests.append(ReplaceOne({ '_id': collection+':'+str(chat)+':day:'+day.isoformat() }, { 'collection': collection, 'c': chat, 'period': 'day', 'start': day, 'count': count }, upsert=True))
+	if len(requests) > 0:
+		db.activity.bulk_write(requests, ordered=False)
+
+
+def delete_day(db, collection, day, batch=5000, pause=0.2):
+	""" Deletes the raw documents of a day, `batch` at a time with a pause in between """
+	deleted = 0
+	while True:
+		ids = [doc['_id'] for doc in db[collection].find(day_filter(collection, day), { '_id': 1 }).limit(batch)]
+		if len(ids) == 0:
+			return deleted
+		db[collection].delete_many({ '_id': { '$in': ids } })
+		deleted += len(ids)
+		metrics.REGISTRY.inc('natalia_retention_deleted_total', (('collection', collection),), len(ids))
+		if pause > 0:
+			time.sleep(pause)
+
+
+def set_rolled_until(db, collection, day, deleted):
+	db.retention.update_one({ '_id': collection }, { '$set': { 'rolled_until': day, 'updated': datetime.datetime.utcnow() }, '$inc': { 'deleted': deleted } }, upsert=True)
+
+
+def prune_hourly(db, before):
+	return db.activity.delete_many({ 'period': 'hour', 'start': { '$lt': before } }).deleted_count
+
+
+#################################
+#           READING
+
+def activity(db, collection, chat, start, end, date_group_format):
+	""" Rows of {'_id': period, 'count': n} from the rolled up counts of [start, end) """
+	# Hourly counts for an hourly format, as long as they are kept
+	period = 'hour' if '%H' in date_group_format else 'day'
+	counts = Counter()
+	for doc in db.activity.find({ 'collection': collection, 'c': logschema.chat_id(chat), 'period': period, 'start': { '$gte': start, '$lt': end } }):
+		counts[doc['start'].strftime(date_group_format)] += doc['count']
+	return [{ '_id': key, 'count': count } for key, count in counts.items()]
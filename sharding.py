@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Sharded mode : one ingress process polls telegram and routes every update by
+# hashed chat id to one of N worker processes, admin commands go to a dedicated
+# analytics worker. A room always lands on the same worker so its updates keep
+# their order and its runtime state (prior welcome message etc.) lives in one place.
+#
+#   python3.6 sharding.py         (number of workers from SHARDING in config.yaml)
+import datetime
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import zlib
+from queue import Empty, Queue
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Dispatcher, JobQueue
+
+import links
+import logschema
+import metrics
+import natalia
+
+logger = natalia.logger
+
+metrics.REGISTRY.describe('natalia_shard_queue_depth', 'Updates waiting for a worker process')
+metrics.REGISTRY.describe('natalia_shard_routed_total', 'Updates routed to a worker process')
+
+
+def route(update, processes):
+	""" Index of the worker for an update, `processes` being the analytics worker """
+	message = update.effective_message
+	if message is not None and message.text and message.text.startswith('/'):
+		command = message.text.split()[0][1:].split('@')[0].lower()
+		if command in natalia.ADMIN_COMMANDS:
+			return processes
+
+	chat = update.effective_chat
+	if chat is None:
+		return 0
+	return zlib.crc32(str(chat.id).encode()) % processes
+
+
+#################################
+#           WORKER
+
+def worker(index, name, inbox):
+	""" Runs natalia's handlers on the updates routed to this process """
+	natalia.SHARDED_WORKER = True
+	natalia.SHARD_NAME     = name
+	# The rooms forwarding to a feed channel can be on different workers
+	natalia.FORWARDED_LINKS = links.SharedLinks(natalia.db.forwarded_links)
+	natalia.FORWARDED_LINKS.create_indexes()
+	config = natalia.CONFIG
+	if config.SNAPSHOT_PATH:
+		natalia.load_snapshot()
+
+	update_queue = Queue()
+	dp = Dispatcher(natalia.bot, update_queue, workers=natalia.WORKERS)
+	natalia.register_handlers(dp)
+	natalia.PM_REQUESTS.start()
+	natalia.USER_UPDATES.start()
+	natalia.PHOTO_CACHE.start()
+	natalia.OUTBOX.start()
+
+	# Every worker monitors its dispatcher and snapshots its rooms, the analytics worker
+	# (which has no rooms to keep up with) runs the archive, retention and daily reports
+	job_queue = JobQueue(natalia.bot)
+	natalia.schedule_jobs(job_queue, dp, maintenance=(name == 'analytics'))
+	job_queue.start()
+	if name == 'analytics':
+		natalia.start_render_pool()
+
+	# Each process has its own registry, so its own scrape port
+	if natalia.CONFIG.METRICS_CONFIG.get('port'):
+		metrics.start_http_server(natalia.CONFIG.METRICS_CONFIG['port'] + 1 + index, natalia.CONFIG.METRICS_CONFIG.get('host', '127.0.0.1'))
+
+	# A stop signal (the whole process group gets it) only flags it, the ingress decides
+	# when to stop and forwards SIGHUP (config reload)
+	running = { 'polling': True }
+	natalia.handle_stop(running)
+	signal.signal(signal.SIGHUP, lambda signum, frame: natalia.reload_config())
+
+	threading.Thread(target=dp.start, name='dispatcher', daemon=True).start()
+	logger.info("Worker %s started", name)
+
+	ingress = os.getppid()
+	while True:
+		try:
+			data = inbox.get(timeout=1)
+		except Empty:
+			# Stopped while the ingress is gone, nothing more will come
+			if not running['polling'] and os.getppid() != ingress:
+				break
+			continue
+		if data is None:
+			break
+		update_queue.put(Update.de_json(data, natalia.bot))
+
+	# Let the dispatcher finish what it has queued
+	deadline = time.monotonic() + float(config.RESTART.get('drain_timeout', 30))
+	job_queue.stop()
+	while (update_queue.qsize() > 0 or metrics.REGISTRY.get_gauge('natalia_handlers_in_flight') > 0) and time.monotonic() < deadline:
+		time.sleep(0.05)
+	dp.stop()
+	natalia.OUTBOX.stop(max(1.0, deadline - time.monotonic()))
+	natalia.PM_REQUESTS.flush()
+	natalia.USER_UPDATES.flush()
+	natalia.PHOTO_CACHE.flush()
+	if config.SNAPSHOT_PATH:
+		natalia.save_snapshot()
+	logger.info("Worker %s stopped", name)
+
+
+#################################
+#           INGRESS
+
+def main():
+	processes = int(natalia.CONFIG.SHARDING.get('processes', 4))
+	timeout   = int(natalia.CONFIG.SHARDING.get('poll_timeout', 30))
+	context   = multiprocessing.get_context('spawn')
+
+	names   = ['shard-'+str(i) for i in range(processes)] + ['analytics']
+	inboxes = [context.Queue() for _ in names]
+	workers = []
+	for index, name in enumerate(names):
+		process = context.Process(target=worker, args=(index, name, inboxes[index]), name=name)
+		process.start()
+		workers.append(process)
+
+	if natalia.CONFIG.METRICS_CONFIG.get('port'):
+		metrics.start_http_server(natalia.CONFIG.METRICS_CONFIG['port'], natalia.CONFIG.METRICS_CONFIG.get('host', '127.0.0.1'))
+
+	running = { 'polling': True }
+	def stop(signum, frame):
+		logger.info("Stopping ingress")
+		running['polling'] = False
+	signal.signal(signal.SIGINT, stop)
+	signal.signal(signal.SIGTERM, stop)
+
+	def reload(signum, frame):
+		natalia.reload_config()
+		for process in workers:
+			os.kill(process.pid, signal.SIGHUP)
+	signal.signal(signal.SIGHUP, reload)
+
+	natalia.db.softlog.insert({'comment' : 'Natalia started (sharded, '+str(processes)+' workers)', 'timestamp' : datetime.datetime.utcnow()})
+	logschema.create_indexes(natalia.log_db)
+	natalia.create_report_indexes()
+	natalia.bot.delete_webhook()
+	logger.info("Polling, routing to %d workers + analytics", processes)
+
+	offset = None
+	while running['polling']:
+		try:
+			updates = natalia.bot.get_updates(offset=offset, timeout=timeout)
+		except TelegramError as e:
+			logger.warning("Polling failed : %s", str(e))
+			time.sleep(1)
+			continue
+
+		for update in updates:
+			offset = update.update_id + 1
+			index  = route(update, processes)
+			inboxes[index].put(update.to_dict())
+			metrics.REGISTRY.inc('natalia_shard_routed_total', (('shard', names[index]),))
+
+		for index, inbox in enumerate(inboxes):
+			metrics.REGISTRY.set_gauge('natalia_shard_queue_depth', (('shard', names[index]),), inbox.qsize())
+
+	# Confirm the last offset so these updates are not fetched again, then drain the workers
+	if offset is not None:
+		natalia.bot.get_updates(offset=offset, timeout=0)
+	for inbox in inboxes:
+		inbox.put(None)
+	for process in workers:
+		process.join()
+
+
+if __name__ == '__main__':
+	main()
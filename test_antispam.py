@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# python3.6 -m unittest test_antispam
+import os
+import pickle
+import subprocess
+import sys
+import time
+import unittest
+
+import antispam
+
+SPAM    = "Join the best pump group on telegram, 10x signals every day, free entry for the first 100 members today"
+VARIANT = "Join the best pump group on telegram, 10x signals every week, free entry for the first 100 members today!!"
+OTHER   = "Funding just flipped negative on bitmex, shorts are paying longs again for the third time this week"
+
+
+class DuplicateDetectorTest(unittest.TestCase):
+
+	def setUp(self):
+		self.detector = antispam.DuplicateDetector()
+
+	def add(self, room, user, message, text, now):
+		return self.detector.add(room, user, message, text, 3, 120, now=now)
+
+	def test_exact_copies(self):
+		self.assertEqual(self.add('-1', 7, 1, SPAM, 0), [])
+		self.assertEqual(self.add('-2', 7, 2, SPAM, 1), [])
+		self.assertEqual(sorted(self.add('-3', 7, 3, SPAM, 2)), [('-1', 7, 1), ('-2', 7, 2), ('-3', 7, 3)])
+		# Already reported, only the new copy
+		self.assertEqual(self.add('-4', 7, 4, SPAM, 3), [('-4', 7, 4)])
+
+	def test_near_copies(self):
+		self.assertEqual(self.add('-1', 7, 1, SPAM, 0), [])
+		self.assertEqual(self.add('-2', 7, 2, VARIANT, 1), [])
+		self.assertEqual(len(self.add('-3', 7, 3, SPAM.upper(), 2)), 3)
+
+	def test_long_texts(self):
+		# Only the first MAX_WORDS words are signed, the copies differ after them
+		words = OTHER.split() * 30
+		for room in range(3):
+			tail = ['room'+str(room)+'word'+str(i) for i in range(300)]
+			sightings = self.add('-'+str(room), 7, room, ' '.join(words + tail), room)
+		self.assertEqual(len(sightings), 3)
+
+	def test_different_texts(self):
+		self.assertEqual(self.add('-1', 7, 1, SPAM, 0), [])
+		self.assertEqual(self.add('-2', 7, 2, OTHER, 1), [])
+		self.assertEqual(self.add('-3', 7, 3, SPAM, 2), [])
+
+	def test_different_users(self):
+		for user in range(3):
+			self.assertEqual(self.add('-'+str(user), user, user, SPAM, user), [])
+
+	def test_shared_links(self):
+		for room in range(3):
+			self.assertEqual(self.add('-'+str(room), 7, room, 'https://www.bloomberg.com/news/articles/2018-01-01/bitcoin-falls wow', room), [])
+
+	def test_window(self):
+		self.add('-1', 7, 1, SPAM, 0)
+		self.add('-2', 7, 2, SPAM, 1)
+		self.assertEqual(self.add('-3', 7, 3, SPAM, 200), [])
+
+	def test_snapshot(self):
+		self.add('-1', 7, 1, SPAM, 0)
+		self.add('-2', 7, 2, VARIANT, 1)
+		restored = antispam.DuplicateDetector()
+		restored.load(self.detector.dump())
+		self.assertEqual(len(restored), 1)
+
+	def test_restart(self):
+		self.add('-1', 7, 1, SPAM, time.monotonic())
+		self.add('-2', 7, 2, SPAM, time.monotonic())
+		# Loaded by another process, with another str hash salt
+		script = 'import pickle, sys, time, antispam\n'\
+			'detector = antispam.DuplicateDetector()\n'\
+			'detector.load(pickle.load(sys.stdin.buffer))\n'\
+			'print(len(detector.add("-3", 7, 3, sys.argv[1], 3, 120, now=time.monotonic())))\n'
+		env = dict(os.environ, PYTHONHASHSEED='1234')
+		out = subprocess.run([sys.executable, '-c', script, VARIANT], input=pickle.dumps(self.detector.dump()), stdout=subprocess.PIPE, env=env, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+		self.assertEqual(out.stdout.strip(), b'3')
+
+
+if __name__ == '__main__':
+	unittest.main()